@@ -1,11 +1,14 @@
 import streamlit as st
 import requests
+import json
 import time
 
 # --- CONFIGURATION DES PORTS ---
 # Mettez ici les URLs de vos microservices
 API_INGEST_URL = "http://127.0.0.1:8000/ingest/"
+API_STATUS_URL = "http://127.0.0.1:8000/documents/{doc_id}/status"
 API_LLM_URL = "http://127.0.0.1:8001/ask/"
+API_LLM_STREAM_URL = "http://127.0.0.1:8001/ask/stream"
 
 # Configuration de la page
 # Simple status checks for services
@@ -48,15 +51,24 @@ with st.sidebar:
                     # Appel API Service 1
                     response = requests.post(API_INGEST_URL, files=files, data=data)
                     
-                    if response.status_code == 200:
+                    if response.status_code in (200, 202):
                         st.success("✅ Document transmis !")
-                        st.info("Le pipeline asynchrone (DeID -> Indexer) est en cours...")
-                        # Petit délai pour laisser le temps aux services de fond de bosser
+                        # L'extraction Tika se fait en arrière-plan : suivi via l'endpoint de statut
+                        doc_id = response.json()["doc_id"]
+                        status = "PENDING"
                         progress_bar = st.progress(0)
-                        for i in range(100):
-                            time.sleep(0.05) # Simulation d'attente 5s
-                            progress_bar.progress(i + 1)
-                        st.success("Document prêt pour interrogation !")
+                        for i in range(120):
+                            status = requests.get(API_STATUS_URL.format(doc_id=doc_id)).json().get("status")
+                            if status not in ("PENDING", "EXTRACTING"):
+                                break
+                            time.sleep(0.5)
+                            progress_bar.progress(min(i + 1, 99))
+                        progress_bar.progress(100)
+                        if status == "PROCESSED":
+                            st.info("Le pipeline asynchrone (DeID -> Indexer) est en cours...")
+                            st.success("Document prêt pour interrogation !")
+                        else:
+                            st.error(f"Erreur Ingestion : statut {status}")
                     else:
                         st.error(f"Erreur Ingestion : {response.text}")
                         
@@ -93,19 +105,29 @@ if prompt := st.chat_input("Posez votre question sur le dossier patient..."):
         message_placeholder.markdown("⏳ *Analyse du dossier en cours...*")
         
         try:
-            # Appel API Service 4
+            # Appel API Service 4 en streaming (NDJSON) : sources d'abord, puis les tokens
             payload = {"question": prompt}
-            response = requests.post(API_LLM_URL, json=payload)
+            response = requests.post(API_LLM_STREAM_URL, json=payload, stream=True)
             
             if response.status_code == 200:
-                data = response.json()
-                answer = data.get("answer", "Pas de réponse.")
-                sources = data.get("sources", [])
+                answer = ""
+                sources_footer = ""
+                for line in response.iter_lines(decode_unicode=True):
+                    if not line:
+                        continue
+                    event = json.loads(line)
+                    if event["type"] == "sources" and event["sources"]:
+                        sources_footer = "\n\n---\n**Sources :** " + ", ".join(event["sources"])
+                        message_placeholder.markdown("⏳ *Rédaction de la réponse...*" + sources_footer)
+                    elif event["type"] == "token":
+                        answer += event["content"]
+                        # Affichage incrémental avec un curseur pendant la génération
+                        message_placeholder.markdown(answer + "▌" + sources_footer)
+                    elif event["type"] == "error":
+                        raise RuntimeError(event["detail"])
                 
                 # Formatage de la réponse avec les sources
-                full_response = f"{answer}\n\n"
-                if sources:
-                    full_response += "---\n**Sources :** " + ", ".join(sources)
+                full_response = (answer or "Pas de réponse.") + sources_footer
                 
                 message_placeholder.markdown(full_response)
                 st.session_state.messages.append({"role": "assistant", "content": full_response})
@@ -4,10 +4,17 @@ import time
 import sys
 import os
 import logging # <--- AMÉLIORATION 1
+import multiprocessing
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 # Import Presidio
-from presidio_analyzer import AnalyzerEngine
+from presidio_analyzer import AnalyzerEngine, BatchAnalyzerEngine
 from presidio_anonymizer import AnonymizerEngine
+# Claim-check commun aux services, maintenu dans doc-ingestor (producteur des références)
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "doc-ingestor"))
+from blob_store import pack_text, unpack_text, release_text
+from fast_path import NER_ENTITIES, load_dictionary, structured_results, dictionary_results, ner_spans
 
 # --- CONFIGURATION LOGGING ---
 logging.basicConfig(
@@ -22,61 +29,215 @@ INPUT_QUEUE = os.getenv("INPUT_QUEUE", "raw_documents_queue")
 OUTPUT_QUEUE = os.getenv("OUTPUT_QUEUE", "clean_documents_queue")
 # Choix du modèle de langue (fr recommandé pour la France)
 NLP_LANG = os.getenv("NLP_LANG", "en") 
+# Pool de processus : chaque worker importe ce module et garde donc son propre analyzer préchargé
+DEID_WORKERS = int(os.getenv("DEID_WORKERS", "1"))
+# Messages non acquittés autorisés : de quoi occuper tous les workers
+PREFETCH_COUNT = int(os.getenv("PREFETCH_COUNT", str(max(1, DEID_WORKERS * 2))))
+
+# Documents longs : analyse par fenêtres de DEID_CHUNK_SIZE caractères (0 = jamais de découpage)
+DEID_CHUNK_SIZE = int(os.getenv("DEID_CHUNK_SIZE", "20000"))
+DEID_CHUNK_OVERLAP = int(os.getenv("DEID_CHUNK_OVERLAP", "200"))
+DEID_CHUNK_THREADS = int(os.getenv("DEID_CHUNK_THREADS", "1"))
+
+# Micro-lots : jusqu'à DEID_BATCH_SIZE messages déjà arrivés sont analysés ensemble (nlp.pipe)
+# 1 = un document par appel, comme avant
+DEID_BATCH_SIZE = int(os.getenv("DEID_BATCH_SIZE", "16"))
+DEID_BATCH_MAX_WAIT_MS = int(os.getenv("DEID_BATCH_MAX_WAIT_MS", "100"))
+
+# "full" : Presidio complet sur tout le texte ; "tiered" : regex + dictionnaire d'abord,
+# NER uniquement sur les segments pouvant contenir PERSON / LOCATION / NRP (cf. fast_path.py)
+DEID_MODE = os.getenv("DEID_MODE", "full")
+
+ENTITIES = ["PERSON", "PHONE_NUMBER", "EMAIL_ADDRESS", "DATE_TIME", "NRP", "LOCATION"]
 
 # Initialisation
 logger.info(f"Chargement du modèle IA (Presidio) en langue '{NLP_LANG}'...")
 try:
     analyzer = AnalyzerEngine()
     anonymizer = AnonymizerEngine()
+    batch_analyzer = BatchAnalyzerEngine(analyzer_engine=analyzer)
+    dictionary = load_dictionary()
     logger.info("Modèle chargé avec succès.")
 except Exception as e:
     logger.critical(f"Erreur chargement modèle: {e}")
     logger.critical(f"Avez-vous installé le modèle Spacy ? (python -m spacy download {NLP_LANG}_core_web_lg)")
     sys.exit(1)
 
-def process_text_anonymization(text):
-    if not text: return ""
-    
+def iter_text_chunks(text, size, overlap):
+    """Découpe le texte en fenêtres (offset, texte) d'au plus size caractères.
+
+    La coupure se fait de préférence en fin de paragraphe, sinon en fin de phrase ou de ligne.
+    Chaque fenêtre reprend les ~overlap derniers caractères de la précédente (à partir d'un
+    espace) pour qu'une entité coupée à la frontière soit vue entière au moins une fois.
+    """
+    start, length = 0, len(text)
+    while start < length:
+        end = min(start + size, length)
+        if end < length:
+            floor = start + size // 2
+            cut = text.rfind("\n\n", floor, end)
+            if cut == -1:
+                cut = max(text.rfind(". ", floor, end), text.rfind("\n", floor, end))
+            if cut != -1:
+                end = cut + 1
+        yield start, text[start:end]
+        if end >= length:
+            break
+        next_start = max(end - overlap, start + 1)
+        # Démarre sur un début de mot pour ne pas présenter un nom tronqué au NER
+        space = text.find(" ", next_start, end)
+        if space == -1:
+            space = text.rfind(" ", start + 1, next_start)
+        start = space + 1 if space != -1 else next_start
+
+def merge_results(results):
+    """Fusionne les entités de même type qui se chevauchent (doublons des zones de recouvrement)"""
+    merged = []
+    for result in sorted(results, key=lambda r: (r.entity_type, r.start, -r.end)):
+        last = merged[-1] if merged else None
+        if last and last.entity_type == result.entity_type and result.start <= last.end:
+            last.end = max(last.end, result.end)
+            last.score = max(last.score, result.score)
+        else:
+            merged.append(result)
+    return sorted(merged, key=lambda r: r.start)
+
+def analyze_chunk(offset_and_chunk):
+    offset, chunk = offset_and_chunk
+    results = analyzer.analyze(text=chunk, entities=ENTITIES, language=NLP_LANG)
+    # Positions ramenées dans le texte complet
+    for result in results:
+        result.start += offset
+        result.end += offset
+    return results
+
+def analyze_chunked(text):
+    """Analyse fenêtre par fenêtre : la mémoire spaCy dépend de DEID_CHUNK_SIZE, pas de la taille du document"""
+    chunks = iter_text_chunks(text, DEID_CHUNK_SIZE, DEID_CHUNK_OVERLAP)
+    results = []
+    if DEID_CHUNK_THREADS > 1:
+        with ThreadPoolExecutor(max_workers=DEID_CHUNK_THREADS) as executor:
+            for chunk_results in executor.map(analyze_chunk, chunks):
+                results.extend(chunk_results)
+    else:
+        for chunk in chunks:
+            results.extend(analyze_chunk(chunk))
+    return merge_results(results)
+
+def analyze_full(text):
+    if DEID_CHUNK_SIZE and len(text) > DEID_CHUNK_SIZE:
+        return analyze_chunked(text)
     # AMÉLIORATION 2 : Utilisation de la variable de langue
-    results = analyzer.analyze(
+    return analyzer.analyze(
         text=text, 
-        entities=["PERSON", "PHONE_NUMBER", "EMAIL_ADDRESS", "DATE_TIME", "NRP", "LOCATION"],
+        entities=ENTITIES,
         language=NLP_LANG
     )
+
+def analyze_tiered_batch(texts):
+    """Mode "tiered" : regex et dictionnaire sur tout le texte, NER sur les seuls segments candidats.
+
+    Les segments de tous les textes passent ensemble dans un même nlp.pipe.
+    """
+    all_results = [structured_results(text) + dictionary_results(text, dictionary) for text in texts]
+    owners, segments = [], []
+    for i, text in enumerate(texts):
+        for start, end in ner_spans(text):
+            for offset, chunk in iter_text_chunks(text[start:end], DEID_CHUNK_SIZE or len(text), DEID_CHUNK_OVERLAP):
+                owners.append((i, start + offset))
+                segments.append(chunk)
+    if segments:
+        batch_results = batch_analyzer.analyze_iterator(
+            segments,
+            language=NLP_LANG,
+            batch_size=max(1, DEID_BATCH_SIZE),
+            entities=NER_ENTITIES
+        )
+        for (i, offset), results in zip(owners, batch_results):
+            for result in results:
+                result.start += offset
+                result.end += offset
+            all_results[i].extend(results)
+    return [merge_results(results) for results in all_results]
+
+def process_text_anonymization(text):
+    if not text: return ""
+    
+    if DEID_MODE == "tiered":
+        results = analyze_tiered_batch([text])[0]
+    else:
+        results = analyze_full(text)
     
+    # Un seul passage d'anonymisation sur le texte complet : pas de double masquage aux frontières
     anonymized_result = anonymizer.anonymize(text=text, analyzer_results=results)
     return anonymized_result.text
 
+def anonymize_batch(texts):
+    """Anonymise plusieurs textes avec un seul passage spaCy (nlp.pipe) pour tout le lot.
+
+    Les documents longs gardent l'analyse par fenêtres de process_text_anonymization.
+    Retourne les textes anonymisés dans le même ordre.
+    """
+    texts = [text or "" for text in texts]
+    if DEID_MODE == "tiered":
+        return [
+            anonymizer.anonymize(text=text, analyzer_results=results).text if text else ""
+            for text, results in zip(texts, analyze_tiered_batch(texts))
+        ]
+    clean = [""] * len(texts)
+    short = []
+    for i, text in enumerate(texts):
+        if DEID_CHUNK_SIZE and len(text) > DEID_CHUNK_SIZE:
+            clean[i] = process_text_anonymization(text)
+        elif text:
+            short.append(i)
+    if short:
+        batch_results = batch_analyzer.analyze_iterator(
+            [texts[i] for i in short],
+            language=NLP_LANG,
+            batch_size=max(1, DEID_BATCH_SIZE),
+            entities=ENTITIES
+        )
+        for i, results in zip(short, batch_results):
+            clean[i] = anonymizer.anonymize(text=texts[i], analyzer_results=results).text
+    return clean
+
+def publish_clean_document(ch, message, clean_text):
+    doc_id = message.get("doc_id", "UNKNOWN")
+    output_message = {
+        "doc_id": doc_id,
+        # Texte en clair, compressé, ou référence vers le store de blobs selon sa taille
+        **pack_text("original_text_masked", clean_text),
+        "metadata": message.get("metadata", {}),
+        "processed_at": time.time()
+    }
+
+    # AMÉLIORATION 3 : Déclaration de la queue de sortie ici aussi par sécurité
+    ch.queue_declare(queue=OUTPUT_QUEUE, durable=True)
+    
+    ch.basic_publish(
+        exchange='',
+        routing_key=OUTPUT_QUEUE,
+        body=json.dumps(output_message),
+        properties=pika.BasicProperties(delivery_mode=2)
+    )
+    
+    logger.info(f"[<-] Doc ID {doc_id} anonymisé -> '{OUTPUT_QUEUE}'")
+
 def callback(ch, method, properties, body):
     try:
         message = json.loads(body)
         doc_id = message.get("doc_id", "UNKNOWN")
-        raw_text = message.get("text", "")
+        raw_text = unpack_text(message, "text")
         
         logger.info(f"[->] Reçu Doc ID {doc_id} ({len(raw_text)} chars)")
 
         # Traitement
         clean_text = process_text_anonymization(raw_text)
 
-        output_message = {
-            "doc_id": doc_id,
-            "original_text_masked": clean_text,
-            "metadata": message.get("metadata", {}),
-            "processed_at": time.time()
-        }
-
-        # AMÉLIORATION 3 : Déclaration de la queue de sortie ici aussi par sécurité
-        ch.queue_declare(queue=OUTPUT_QUEUE, durable=True)
-        
-        ch.basic_publish(
-            exchange='',
-            routing_key=OUTPUT_QUEUE,
-            body=json.dumps(output_message),
-            properties=pika.BasicProperties(delivery_mode=2)
-        )
-        
-        logger.info(f"[<-] Doc ID {doc_id} anonymisé -> '{OUTPUT_QUEUE}'")
+        publish_clean_document(ch, message, clean_text)
         ch.basic_ack(delivery_tag=method.delivery_tag)
+        release_text(message, "text")
 
     except json.JSONDecodeError:
         logger.error("Message reçu invalide (pas un JSON)")
@@ -86,7 +247,107 @@ def callback(ch, method, properties, body):
         # En prod, on pourrait mettre requeue=True avec un compteur d'essais
         ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
 
+# --- MODE MICRO-LOTS ---
+def handle_batch(ch, deliveries):
+    """Anonymise ensemble les messages reçus, puis publie et acquitte chacun d'eux"""
+    messages, texts = [], []
+    for method, body in deliveries:
+        try:
+            message = json.loads(body)
+            texts.append(unpack_text(message, "text"))
+            messages.append((method.delivery_tag, message))
+        except json.JSONDecodeError:
+            logger.error("Message reçu invalide (pas un JSON)")
+            ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
+        except Exception as e:
+            logger.error(f"Texte du message illisible: {e}")
+            ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
+    if not messages: return
+
+    try:
+        clean_texts = anonymize_batch(texts)
+    except Exception as e:
+        logger.error(f"Erreur traitement du lot: {e}")
+        for delivery_tag, _ in messages:
+            ch.basic_nack(delivery_tag=delivery_tag, requeue=False)
+        return
+
+    logger.info(f"[->] Lot de {len(messages)} documents analysé")
+    for (delivery_tag, message), clean_text in zip(messages, clean_texts):
+        try:
+            publish_clean_document(ch, message, clean_text)
+            ch.basic_ack(delivery_tag=delivery_tag)
+            release_text(message, "text")
+        except Exception as e:
+            logger.error(f"Erreur traitement: {e}")
+            ch.basic_nack(delivery_tag=delivery_tag, requeue=False)
+
+def consume_batches(channel):
+    """Regroupe les messages disponibles, jusqu'à DEID_BATCH_SIZE ou DEID_BATCH_MAX_WAIT_MS d'attente"""
+    max_wait = DEID_BATCH_MAX_WAIT_MS / 1000
+    deliveries = []
+    deadline = 0
+    for method, properties, body in channel.consume(INPUT_QUEUE, inactivity_timeout=max_wait):
+        if method is not None:
+            if not deliveries:
+                deadline = time.monotonic() + max_wait
+            deliveries.append((method, body))
+
+        if deliveries and (method is None or len(deliveries) >= DEID_BATCH_SIZE or time.monotonic() >= deadline):
+            handle_batch(channel, deliveries)
+            deliveries = []
+
+# --- MODE POOL DE WORKERS ---
+def dispatch_to_pool(ch, method, body, pool, pending):
+    """Envoie le document à un worker ; le résultat est publié plus tard, dans l'ordre de réception"""
+    try:
+        message = json.loads(body)
+        raw_text = unpack_text(message, "text")
+    except json.JSONDecodeError:
+        logger.error("Message reçu invalide (pas un JSON)")
+        ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
+        return
+    except Exception as e:
+        logger.error(f"Texte du message illisible: {e}")
+        ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
+        return
+
+    logger.info(f"[->] Reçu Doc ID {message.get('doc_id', 'UNKNOWN')} ({len(raw_text)} chars)")
+    pending.append((method.delivery_tag, message, pool.apply_async(process_text_anonymization, (raw_text,))))
+
+def flush_completed(ch, pending):
+    """Publie et acquitte les documents terminés, dans l'ordre de réception.
+
+    Un document long en tête de file retient les suivants déjà terminés : sortie et acks
+    restent ordonnés comme en mode mono-processus. Toutes les opérations pika restent
+    dans le thread de la connexion (pika n'est pas thread-safe).
+    """
+    done = 0
+    while pending and pending[0][2].ready():
+        delivery_tag, message, result = pending.popleft()
+        try:
+            publish_clean_document(ch, message, result.get())
+            ch.basic_ack(delivery_tag=delivery_tag)
+            release_text(message, "text")
+        except Exception as e:
+            logger.error(f"Erreur traitement: {e}")
+            ch.basic_nack(delivery_tag=delivery_tag, requeue=False)
+        done += 1
+    return done
+
+def consume_with_pool(connection, channel, pool):
+    pending = deque()
+    channel.basic_consume(
+        queue=INPUT_QUEUE,
+        on_message_callback=lambda ch, method, properties, body: dispatch_to_pool(ch, method, body, pool, pending)
+    )
+    while True:
+        connection.process_data_events(time_limit=0.05)
+        flush_completed(channel, pending)
+
 def start_service():
+    # Les workers sont créés une seule fois : une reconnexion RabbitMQ ne recharge pas spaCy
+    pool = multiprocessing.Pool(DEID_WORKERS) if DEID_WORKERS > 1 else None
     while True:
         try:
             logger.info(f"Connexion à RabbitMQ ({RABBITMQ_HOST})...")
@@ -94,11 +355,22 @@ def start_service():
             channel = connection.channel()
 
             channel.queue_declare(queue=INPUT_QUEUE, durable=True)
-            channel.basic_qos(prefetch_count=1)
-            channel.basic_consume(queue=INPUT_QUEUE, on_message_callback=callback)
+            if pool:
+                # Les messages non acquittés au moment d'une coupure sont redistribués par RabbitMQ
+                channel.basic_qos(prefetch_count=PREFETCH_COUNT)
+                logger.info(f'Service DeID démarré ({DEID_WORKERS} workers). En attente de documents...')
+                consume_with_pool(connection, channel, pool)
+            elif DEID_BATCH_SIZE > 1:
+                # Le prefetch doit couvrir un lot complet, sinon le broker limite la taille des lots
+                channel.basic_qos(prefetch_count=DEID_BATCH_SIZE)
+                logger.info(f'Service DeID démarré (lots de {DEID_BATCH_SIZE}). En attente de documents...')
+                consume_batches(channel)
+            else:
+                channel.basic_qos(prefetch_count=1)
+                channel.basic_consume(queue=INPUT_QUEUE, on_message_callback=callback)
 
-            logger.info('Service DeID démarré. En attente de documents...')
-            channel.start_consuming()
+                logger.info('Service DeID démarré. En attente de documents...')
+                channel.start_consuming()
             
         except pika.exceptions.AMQPConnectionError:
             logger.warning("RabbitMQ indisponible. Retentative dans 5s...")
@@ -107,6 +379,8 @@ def start_service():
             logger.info("Arrêt du service.")
             try: connection.close()
             except: pass
+            if pool:
+                pool.terminate()
             break
 
 if __name__ == "__main__":
@@ -0,0 +1,70 @@
+"""Compare le mode "tiered" (regex + dictionnaire + NER ciblé) au Presidio complet.
+
+Le mode complet sert de référence : le rappel est la part de ses entités retrouvées
+(même type, positions qui se chevauchent) par le mode "tiered".
+
+Usage : python benchmark_deid.py [fichier_textes]
+(documents séparés par une ligne vide ; sans fichier, des comptes rendus synthétiques sont générés)
+"""
+import sys
+import time
+import random
+from collections import Counter
+from anonymizer import ENTITIES, analyze_full, analyze_tiered_batch
+
+NAMES = ["Jean Dupont", "Marie Curie", "Paul Martin", "Sophie Bernard", "Ahmed Benali", "Claire Moreau"]
+CITIES = ["Lyon", "Marseille", "Toulouse", "Paris", "Bordeaux"]
+
+
+def synthetic_documents(count=200):
+    rng = random.Random(0)
+    documents = []
+    for _ in range(count):
+        documents.append(
+            f"Compte rendu de consultation du {rng.randint(1, 28)}/{rng.randint(1, 12):02d}/2023.\n"
+            f"Le patient {rng.choice(NAMES)}, domicilié à {rng.choice(CITIES)}, consulte pour une asthénie.\n"
+            f"Il est joignable au 06 {rng.randint(10, 99)} {rng.randint(10, 99)} {rng.randint(10, 99)} "
+            f"{rng.randint(10, 99)} ou par mail a.b{rng.randint(1, 999)}@exemple.fr.\n"
+            "La langue est pâle, le pouls est faible. Aucune fièvre.\n"
+            f"Adressé par le Dr {rng.choice(NAMES).split()[1]}. Contrôle prévu le 12 mars 2024."
+        )
+    return documents
+
+
+def read_documents(path):
+    with open(path, encoding='utf-8') as f:
+        return [block.strip() for block in f.read().split("\n\n") if block.strip()]
+
+
+def found(reference, results):
+    return any(r.entity_type == reference.entity_type and r.start < reference.end and reference.start < r.end
+               for r in results)
+
+
+if __name__ == "__main__":
+    documents = read_documents(sys.argv[1]) if len(sys.argv) > 1 else synthetic_documents()
+    print(f"{len(documents)} documents, {sum(len(d) for d in documents)} caractères\n")
+
+    start = time.perf_counter()
+    full = [analyze_full(document) for document in documents]
+    full_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    tiered = analyze_tiered_batch(documents)
+    tiered_time = time.perf_counter() - start
+
+    expected, retrieved = Counter(), Counter()
+    for references, results in zip(full, tiered):
+        for reference in references:
+            expected[reference.entity_type] += 1
+            retrieved[reference.entity_type] += found(reference, results)
+
+    print(f"{'entité':<15} {'référence':>10} {'rappel':>8}")
+    for entity_type in ENTITIES:
+        if expected[entity_type]:
+            print(f"{entity_type:<15} {expected[entity_type]:>10} {retrieved[entity_type] / expected[entity_type]:>8.3f}")
+    total = sum(expected.values())
+    if total:
+        print(f"{'total':<15} {total:>10} {sum(retrieved.values()) / total:>8.3f}")
+    print(f"\ncomplet : {len(documents) / full_time:.1f} docs/s")
+    print(f"tiered  : {len(documents) / tiered_time:.1f} docs/s")
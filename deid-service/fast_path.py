@@ -0,0 +1,172 @@
+import os
+import re
+from collections import deque
+from presidio_analyzer import RecognizerResult
+
+# Entités structurées : détectées par expressions régulières, sans passer par spaCy
+STRUCTURED_ENTITIES = ["PHONE_NUMBER", "EMAIL_ADDRESS", "DATE_TIME"]
+# Entités qui nécessitent encore le NER (hors dictionnaire)
+NER_ENTITIES = ["PERSON", "LOCATION", "NRP"]
+
+# Dictionnaire de noms / lieux connus : une entrée "ENTITE;terme" par ligne (ex. "PERSON;Dupont")
+DEID_DICTIONARY_FILE = os.getenv("DEID_DICTIONARY_FILE", "")
+
+_MONTHS = (
+    r"janvier|février|fevrier|mars|avril|mai|juin|juillet|août|aout|septembre|octobre|novembre|décembre|decembre"
+    r"|january|february|march|april|may|june|july|august|september|october|november|december"
+)
+
+PATTERNS = [
+    ("EMAIL_ADDRESS", 1.0, re.compile(r"\b[\w.+-]+@[\w-]+(?:\.[\w-]+)+\b")),
+    # 06 12 34 56 78, 06.12.34.56.78, +33 6 12 34 56 78, (555) 123-4567
+    ("PHONE_NUMBER", 0.75, re.compile(
+        r"(?<![\w+])(?:\+33\s?|0)[1-9](?:[\s.-]?\d{2}){4}\b"
+        r"|(?<![\w+])\+\d{1,3}[\s.-]?\(?\d{1,4}\)?(?:[\s.-]?\d{2,4}){2,4}\b"
+        r"|(?<!\w)\(\d{3}\)\s?\d{3}-\d{4}\b"
+    )),
+    ("DATE_TIME", 0.85, re.compile(
+        r"\b\d{1,2}[/.-]\d{1,2}[/.-](?:\d{4}|\d{2})\b"
+        r"|\b\d{4}-\d{2}-\d{2}(?:[T ]\d{2}:\d{2}(?::\d{2})?)?\b"
+        rf"|\b\d{{1,2}}(?:er)?\s+(?:{_MONTHS})(?:\s+\d{{4}})?\b"
+        rf"|\b(?:{_MONTHS})\s+\d{{1,2}}(?:,\s*\d{{4}})?\b"
+        r"|\b\d{1,2}h\d{2}\b|\b\d{1,2}:\d{2}\b",
+        re.IGNORECASE
+    )),
+]
+
+# Mots capitalisés fréquents en début de phrase, sans lien avec une entité
+_SENTENCE_STARTERS = {
+    "le", "la", "les", "un", "une", "des", "du", "de", "il", "elle", "ils", "elles", "on", "nous", "vous",
+    "je", "ce", "cet", "cette", "ces", "pas", "aucun", "aucune", "après", "avant", "depuis", "pendant",
+    "patient", "patiente", "examen", "traitement", "antécédents", "conclusion", "motif", "diagnostic",
+    "the", "a", "an", "he", "she", "they", "we", "it", "this", "that", "no", "after", "before", "since",
+}
+_SEGMENT_END = re.compile(r"(?<=[.!?])\s+|\n+")
+_CAPITALIZED = re.compile(r"\b[A-ZÀ-ÖØ-Þ][\w'-]*")
+_WORD_CHAR = re.compile(r"\w")
+
+
+class KeywordAutomaton:
+    """Automate d'Aho-Corasick : trouve tous les termes du dictionnaire en un seul parcours du texte.
+
+    La recherche ignore la casse et ne retient que les occurrences formant des mots entiers.
+    """
+
+    def __init__(self):
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [[]] # état -> [(longueur du terme, type d'entité)]
+        self._built = True
+
+    def __len__(self):
+        return sum(len(output) for output in self._output)
+
+    def add(self, term, entity_type):
+        term = term.strip().lower()
+        if not term:
+            return
+        state = 0
+        for char in term:
+            if char not in self._goto[state]:
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append([])
+                self._goto[state][char] = len(self._goto) - 1
+            state = self._goto[state][char]
+        self._output[state].append((len(term), entity_type))
+        self._built = False
+
+    def build(self):
+        # Liens d'échec calculés en largeur : chaque état hérite des sorties de son suffixe le plus long
+        queue = deque(self._goto[0].values())
+        for state in queue:
+            self._fail[state] = 0
+        while queue:
+            state = queue.popleft()
+            for char, child in self._goto[state].items():
+                queue.append(child)
+                fallback = self._fail[state]
+                while fallback and char not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                target = self._goto[fallback].get(char, 0)
+                self._fail[child] = target if target != child else 0
+                self._output[child] = self._output[child] + self._output[self._fail[child]]
+        self._built = True
+
+    def find(self, text):
+        """Retourne les occurrences (début, fin, type d'entité) trouvées dans le texte"""
+        if not self._built:
+            self.build()
+        lowered = text.lower()
+        # Quelques caractères changent de longueur en minuscules : positions alors invalides
+        if len(lowered) != len(text):
+            lowered = "".join(c if len(c.lower()) != 1 else c.lower() for c in text)
+        matches = []
+        state = 0
+        for i, char in enumerate(lowered):
+            while state and char not in self._goto[state]:
+                state = self._fail[state]
+            state = self._goto[state].get(char, 0)
+            for length, entity_type in self._output[state]:
+                start, end = i + 1 - length, i + 1
+                if _is_word_boundary(text, start) and _is_word_boundary(text, end):
+                    matches.append((start, end, entity_type))
+        return matches
+
+
+def _is_word_boundary(text, position):
+    if position <= 0 or position >= len(text):
+        return True
+    return not (_WORD_CHAR.match(text[position - 1]) and _WORD_CHAR.match(text[position]))
+
+
+def load_dictionary(path=DEID_DICTIONARY_FILE):
+    automaton = KeywordAutomaton()
+    if path and os.path.exists(path):
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                entity_type, _, term = line.strip().partition(";")
+                if term:
+                    automaton.add(term, entity_type.strip().upper())
+    automaton.build()
+    return automaton
+
+
+def structured_results(text):
+    """Entités structurées (téléphone, email, date) trouvées par expressions régulières"""
+    results = []
+    for entity_type, score, pattern in PATTERNS:
+        for match in pattern.finditer(text):
+            results.append(RecognizerResult(entity_type, match.start(), match.end(), score))
+    return results
+
+
+def dictionary_results(text, automaton):
+    return [RecognizerResult(entity_type, start, end, 1.0) for start, end, entity_type in automaton.find(text)]
+
+
+def may_contain_named_entity(segment):
+    """Vrai si le segment contient un mot capitalisé autre qu'un début de phrase banal"""
+    first_word_start = len(segment) - len(segment.lstrip())
+    for match in _CAPITALIZED.finditer(segment):
+        if not (match.start() == first_word_start and match.group().lower() in _SENTENCE_STARTERS):
+            return True
+    return False
+
+
+def ner_spans(text):
+    """Zones (début, fin) à confier au NER : segments candidats consécutifs regroupés"""
+    spans = []
+    start = 0
+    previous_kept = False
+    for separator in list(_SEGMENT_END.finditer(text)) + [None]:
+        end = separator.start() if separator else len(text)
+        kept = may_contain_named_entity(text[start:end])
+        if kept and previous_kept:
+            spans[-1] = (spans[-1][0], end)
+        elif kept:
+            spans.append((start, end))
+        previous_kept = kept
+        if separator:
+            start = separator.end()
+    return spans
@@ -2,11 +2,18 @@ import unittest
 from unittest.mock import MagicMock, patch
 import sys
 import os
+import json
+import tempfile
+from collections import deque
 
 # Add parent directory to path to allow importing modules
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-from anonymizer import process_text_anonymization
+from presidio_analyzer import RecognizerResult
+from anonymizer import (
+    process_text_anonymization, flush_completed, iter_text_chunks, merge_results, anonymize_batch, handle_batch, callback
+)
+from blob_store import pack_text, unpack_text
 
 class TestAnonymizer(unittest.TestCase):
 
@@ -40,5 +47,147 @@ class TestAnonymizer(unittest.TestCase):
         result = process_text_anonymization(None)
         self.assertEqual(result, "")
 
+    def test_iter_text_chunks_overlap_and_boundaries(self):
+        text = "Premier paragraphe du patient.\n\nDeuxième paragraphe. Suite du texte clinique."
+
+        chunks = list(iter_text_chunks(text, 40, 10))
+
+        # Coupure en fin de paragraphe, puis recouvrement avec la fenêtre précédente
+        self.assertEqual(chunks[0], (0, "Premier paragraphe du patient.\n"))
+        for offset, chunk in chunks:
+            self.assertEqual(text[offset:offset + len(chunk)], chunk)
+            self.assertLessEqual(len(chunk), 40)
+        self.assertLess(chunks[1][0], len(chunks[0][1]))
+        self.assertEqual(chunks[-1][0] + len(chunks[-1][1]), len(text))
+
+    def test_merge_results_deduplicates_overlap(self):
+        results = [
+            RecognizerResult("PERSON", 10, 18, 0.85),
+            RecognizerResult("PERSON", 10, 18, 0.6), # même entité vue dans la fenêtre suivante
+            RecognizerResult("PERSON", 14, 22, 0.7), # entité coupée à la frontière
+            RecognizerResult("DATE_TIME", 30, 40, 0.9),
+        ]
+
+        merged = merge_results(results)
+
+        self.assertEqual([(r.entity_type, r.start, r.end) for r in merged], [("PERSON", 10, 22), ("DATE_TIME", 30, 40)])
+        self.assertEqual(merged[0].score, 0.85)
+
+    @patch('anonymizer.DEID_CHUNK_SIZE', 20)
+    @patch('anonymizer.DEID_CHUNK_OVERLAP', 12)
+    @patch('anonymizer.analyzer')
+    @patch('anonymizer.anonymizer')
+    def test_process_text_anonymization_chunked(self, mock_anonymizer_engine, mock_analyzer_engine):
+        text = "Patient Jean Dupont. Revu par Jean Dupont."
+        mock_analyzer_engine.analyze.side_effect = lambda text, **kwargs: [
+            RecognizerResult("PERSON", text.find("Jean Dupont"), text.find("Jean Dupont") + 11, 0.85)
+        ] if "Jean Dupont" in text else []
+
+        process_text_anonymization(text)
+
+        self.assertGreater(mock_analyzer_engine.analyze.call_count, 1)
+        results = mock_anonymizer_engine.anonymize.call_args.kwargs['analyzer_results']
+        # Positions exprimées dans le texte complet, une seule fois par occurrence
+        self.assertEqual([text[r.start:r.end] for r in results], ["Jean Dupont", "Jean Dupont"])
+        self.assertEqual([r.start for r in results], [8, 30])
+
+    @patch('anonymizer.DEID_MODE', 'tiered')
+    @patch('anonymizer.batch_analyzer')
+    @patch('anonymizer.anonymizer')
+    def test_tiered_mode_runs_ner_on_candidate_segments(self, mock_anonymizer_engine, mock_batch_analyzer):
+        text = "Le rappel se fait au 06 12 34 56 78.\nAdressé par le Dr Martin."
+        mock_batch_analyzer.analyze_iterator.return_value = [[RecognizerResult("PERSON", 18, 24, 0.85)]]
+
+        process_text_anonymization(text)
+
+        # Le NER ne voit que la phrase contenant un nom, limité aux entités non structurées
+        segments = mock_batch_analyzer.analyze_iterator.call_args.args[0]
+        self.assertEqual(segments, ["Adressé par le Dr Martin."])
+        self.assertEqual(mock_batch_analyzer.analyze_iterator.call_args.kwargs['entities'], ["PERSON", "LOCATION", "NRP"])
+        results = mock_anonymizer_engine.anonymize.call_args.kwargs['analyzer_results']
+        self.assertEqual([(r.entity_type, text[r.start:r.end]) for r in results],
+                         [("PHONE_NUMBER", "06 12 34 56 78"), ("PERSON", "Martin")])
+
+    @patch('anonymizer.batch_analyzer')
+    @patch('anonymizer.anonymizer')
+    def test_anonymize_batch_single_pipe(self, mock_anonymizer_engine, mock_batch_analyzer):
+        mock_batch_analyzer.analyze_iterator.return_value = [["r1"], ["r2"]]
+        mock_anonymizer_engine.anonymize.side_effect = lambda text, analyzer_results: MagicMock(text=f"<{text}>")
+
+        result = anonymize_batch(["Doc 1", "", None, "Doc 2"])
+
+        # Un seul appel pour tout le lot, les textes vides ne passent pas par spaCy
+        mock_batch_analyzer.analyze_iterator.assert_called_once()
+        self.assertEqual(mock_batch_analyzer.analyze_iterator.call_args.args[0], ["Doc 1", "Doc 2"])
+        self.assertEqual(result, ["<Doc 1>", "", "", "<Doc 2>"])
+
+    @patch('anonymizer.publish_clean_document')
+    @patch('anonymizer.anonymize_batch')
+    def test_handle_batch_nacks_invalid_message(self, mock_anonymize_batch, mock_publish):
+        channel = MagicMock()
+        mock_anonymize_batch.return_value = ["<A>", "<B>"]
+        deliveries = [
+            (MagicMock(delivery_tag=1), b'{"doc_id": 1, "text": "A"}'),
+            (MagicMock(delivery_tag=2), b'pas du json'),
+            (MagicMock(delivery_tag=3), b'{"doc_id": 3, "text": "B"}'),
+        ]
+
+        handle_batch(channel, deliveries)
+
+        mock_anonymize_batch.assert_called_once_with(["A", "B"])
+        channel.basic_nack.assert_called_once_with(delivery_tag=2, requeue=False)
+        self.assertEqual([c.kwargs['delivery_tag'] for c in channel.basic_ack.call_args_list], [1, 3])
+        self.assertEqual([c.args[2] for c in mock_publish.call_args_list], ["<A>", "<B>"])
+
+    @patch('anonymizer.publish_clean_document')
+    def test_flush_completed_keeps_reception_order(self, mock_publish):
+        channel = MagicMock()
+        first, second = MagicMock(), MagicMock()
+        first.ready.return_value = False
+        second.ready.return_value = True
+        second.get.return_value = "Doc <PERSON> 2"
+        pending = deque([(1, {"doc_id": 1}, first), (2, {"doc_id": 2}, second)])
+
+        # Le premier document n'est pas fini : le second, déjà prêt, attend son tour
+        self.assertEqual(flush_completed(channel, pending), 0)
+        channel.basic_ack.assert_not_called()
+
+        first.ready.return_value = True
+        first.get.return_value = "Doc <PERSON> 1"
+        self.assertEqual(flush_completed(channel, pending), 2)
+
+        self.assertEqual([c.kwargs['delivery_tag'] for c in channel.basic_ack.call_args_list], [1, 2])
+        self.assertEqual([c.args[2] for c in mock_publish.call_args_list], ["Doc <PERSON> 1", "Doc <PERSON> 2"])
+        self.assertEqual(len(pending), 0)
+
+    @patch('anonymizer.publish_clean_document')
+    def test_flush_completed_nacks_worker_error(self, mock_publish):
+        channel = MagicMock()
+        failed = MagicMock()
+        failed.ready.return_value = True
+        failed.get.side_effect = RuntimeError("spaCy error")
+
+        flush_completed(channel, deque([(7, {"doc_id": 7}, failed)]))
+
+        mock_publish.assert_not_called()
+        channel.basic_nack.assert_called_once_with(delivery_tag=7, requeue=False)
+
+    @patch('blob_store.CLAIM_CHECK_THRESHOLD', 1024)
+    @patch('anonymizer.process_text_anonymization', side_effect=lambda text: text)
+    def test_claim_check_without_pii_keeps_published_blob(self, mock_process):
+        # Texte long sans donnée à masquer : le texte publié est identique au texte reçu
+        text = "Pouls faible, langue pâle. " * 100
+        channel = MagicMock()
+        with tempfile.TemporaryDirectory() as tmp, patch('blob_store.BLOB_STORE_DIR', tmp):
+            body = json.dumps({"doc_id": 1, **pack_text("text", text)})
+
+            callback(channel, MagicMock(delivery_tag=1), None, body)
+
+            channel.basic_ack.assert_called_once_with(delivery_tag=1)
+            published = json.loads(channel.basic_publish.call_args.kwargs['body'])
+            # Le blob reçu est libéré, celui référencé par le message publié reste lisible
+            self.assertIn("original_text_masked_ref", published)
+            self.assertEqual(unpack_text(published, "original_text_masked"), text)
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,56 @@
+import unittest
+import sys
+import os
+import tempfile
+
+# Add parent directory to path to allow importing modules
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from fast_path import KeywordAutomaton, load_dictionary, structured_results, ner_spans
+
+class TestFastPath(unittest.TestCase):
+
+    def test_structured_results(self):
+        text = "Vu le 12/03/2023 à 14h30. Tél : 06 12 34 56 78, mail jean.dupont@chu-lyon.fr"
+
+        found = {(r.entity_type, text[r.start:r.end]) for r in structured_results(text)}
+
+        self.assertEqual(found, {
+            ("DATE_TIME", "12/03/2023"),
+            ("DATE_TIME", "14h30"),
+            ("PHONE_NUMBER", "06 12 34 56 78"),
+            ("EMAIL_ADDRESS", "jean.dupont@chu-lyon.fr"),
+        })
+
+    def test_automaton_whole_words_ignoring_case(self):
+        automaton = KeywordAutomaton()
+        automaton.add("Dupont", "PERSON")
+        automaton.add("Jean Dupont", "PERSON")
+        automaton.add("Lyon", "LOCATION")
+        text = "JEAN DUPONT habite Lyon, pas Lyonnais ni Dupontel."
+
+        found = [(text[start:end], entity_type) for start, end, entity_type in automaton.find(text)]
+
+        self.assertEqual(found, [("JEAN DUPONT", "PERSON"), ("DUPONT", "PERSON"), ("Lyon", "LOCATION")])
+
+    def test_load_dictionary(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False, encoding='utf-8') as f:
+            f.write("person;Martin\nLOCATION;Saint-Étienne\nligne invalide\n")
+        try:
+            automaton = load_dictionary(f.name)
+        finally:
+            os.remove(f.name)
+
+        self.assertEqual(len(automaton), 2)
+        self.assertEqual(automaton.find("Dr Martin, Saint-Étienne")[0][2], "PERSON")
+
+    def test_ner_spans_skip_segments_without_names(self):
+        text = "La langue est pâle. Le pouls est faible.\nAdressé par le Dr Martin. Vu à Lyon.\nAucune fièvre."
+
+        spans = [text[start:end] for start, end in ner_spans(text)]
+
+        # Les deux phrases candidates consécutives forment une seule zone
+        self.assertEqual(spans, ["Adressé par le Dr Martin. Vu à Lyon."])
+
+if __name__ == '__main__':
+    unittest.main()
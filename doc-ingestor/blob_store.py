@@ -0,0 +1,111 @@
+"""Claim-check des textes transportés par RabbitMQ.
+
+Au-delà de CLAIM_CHECK_THRESHOLD octets, le texte est écrit dans un store de blobs local
+et le message ne porte qu'une référence "<champ>_ref". Chaque message a son propre blob
+(SHA-256 du contenu + suffixe aléatoire) : le supprimer après ack n'affecte aucun autre message,
+même de texte identique (texte sans donnée à masquer, redélivrance, doublon en vol).
+En dessous, il reste dans le message, compressé si INLINE_COMPRESSION est activé ("<champ>_b64").
+Un message avec le champ texte en clair reste lisible : les anciens producteurs sont compatibles.
+
+Module unique : deid-service et semantic-indexer l'importent depuis le dossier de doc-ingestor.
+"""
+import os
+import gzip
+import base64
+import hashlib
+import uuid
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Dossier partagé par les services (même machine), relatif au dossier du service
+BLOB_STORE_DIR = os.getenv("BLOB_STORE_DIR", "../blob_store")
+# Taille (octets UTF-8) à partir de laquelle le texte passe par le store ; 0 = jamais
+CLAIM_CHECK_THRESHOLD = int(os.getenv("CLAIM_CHECK_THRESHOLD", str(256 * 1024)))
+# Compression des textes : "none", "gzip" ou "zstd" (paquet zstandard, sinon gzip)
+INLINE_COMPRESSION = os.getenv("INLINE_COMPRESSION", "none")
+INLINE_COMPRESSION_MIN = int(os.getenv("INLINE_COMPRESSION_MIN", "4096"))
+# Suppression du blob lu une fois le message acquitté (le texte brut contient des données patient)
+BLOB_DELETE_ON_ACK = os.getenv("BLOB_DELETE_ON_ACK", "true").lower() == "true"
+
+
+def _codec():
+    if INLINE_COMPRESSION == "zstd" and zstandard is None:
+        return "gzip"
+    return INLINE_COMPRESSION
+
+
+def compress(data: bytes, encoding: str):
+    if encoding == "gzip":
+        return gzip.compress(data, compresslevel=6)
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor(level=3).compress(data)
+    return data
+
+
+def decompress(data: bytes, encoding: str):
+    if encoding == "gzip":
+        return gzip.decompress(data)
+    if encoding == "zstd":
+        if zstandard is None:
+            raise RuntimeError("Message compressé en zstd : installer le paquet zstandard")
+        return zstandard.ZstdDecompressor().decompress(data)
+    return data
+
+
+def blob_path(key: str, encoding: str, store_dir=None):
+    suffix = {"gzip": ".gz", "zstd": ".zst"}.get(encoding, ".txt")
+    return os.path.join(store_dir or BLOB_STORE_DIR, key[:2], key + suffix)
+
+
+def put_blob(data: bytes, encoding: str, store_dir=None):
+    """Écrit un nouveau blob (fichier temporaire puis os.replace), jamais partagé avec un autre message"""
+    key = f"{hashlib.sha256(data).hexdigest()}-{uuid.uuid4().hex}"
+    path = blob_path(key, encoding, store_dir)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(compress(data, encoding))
+    os.replace(tmp, path)
+    return key
+
+
+def pack_text(field: str, text: str):
+    """Champs à placer dans le message pour transporter text sous le nom field"""
+    data = (text or "").encode("utf-8")
+    encoding = _codec()
+    if CLAIM_CHECK_THRESHOLD and len(data) >= CLAIM_CHECK_THRESHOLD:
+        key = put_blob(data, encoding)
+        return {f"{field}_ref": {"key": key, "encoding": encoding, "size": len(data)}}
+    if encoding != "none" and len(data) >= INLINE_COMPRESSION_MIN:
+        return {
+            f"{field}_b64": base64.b64encode(compress(data, encoding)).decode("ascii"),
+            f"{field}_encoding": encoding,
+        }
+    return {field: text}
+
+
+def unpack_text(message: dict, field: str, default=""):
+    """Texte transporté par le message, quel que soit son mode (clair, compressé ou référence)"""
+    ref = message.get(f"{field}_ref")
+    if ref:
+        with open(blob_path(ref["key"], ref["encoding"]), "rb") as f:
+            return decompress(f.read(), ref["encoding"]).decode("utf-8")
+    if f"{field}_b64" in message:
+        data = base64.b64decode(message[f"{field}_b64"])
+        return decompress(data, message.get(f"{field}_encoding", "none")).decode("utf-8")
+    return message.get(field, default)
+
+
+def release_text(message: dict, field: str):
+    """Supprime le blob référencé une fois le message acquitté (plus aucun lecteur)"""
+    ref = message.get(f"{field}_ref")
+    if not ref or not BLOB_DELETE_ON_ACK:
+        return
+    try:
+        os.remove(blob_path(ref["key"], ref["encoding"]))
+    except OSError:
+        # Déjà supprimé (message redélivré) ou verrouillé : sans conséquence pour le message déjà acquitté
+        pass
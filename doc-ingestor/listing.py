@@ -0,0 +1,93 @@
+import json
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Optional
+
+from sqlalchemy import select
+
+from database import SessionLocal
+import models
+
+MAX_PAGE_SIZE = 1000
+EXPORT_BATCH_SIZE = 1000
+
+Document = models.DocumentMetadata
+# Colonnes exposées par le listing, dans l'ordre de la réponse
+COLUMNS = {
+    "id": Document.id,
+    "filename": Document.filename,
+    "upload_date": Document.upload_date,
+    "status": Document.status,
+    "doc_type": Document.doc_type,
+    "content_hash": Document.content_hash,
+}
+
+
+@dataclass
+class DocumentFilters:
+    status: Optional[str] = None
+    doc_type: Optional[str] = None
+    uploaded_after: Optional[datetime] = None
+    uploaded_before: Optional[datetime] = None
+
+
+def parse_fields(fields: Optional[str]):
+    """Colonnes demandées (toutes par défaut) ; id est toujours inclus, il sert de curseur"""
+    if not fields:
+        return list(COLUMNS)
+    names = [name.strip() for name in fields.split(",") if name.strip()]
+    unknown = [name for name in names if name not in COLUMNS]
+    if unknown:
+        raise ValueError(f"Colonnes inconnues : {', '.join(unknown)} (disponibles : {', '.join(COLUMNS)})")
+    return ["id"] + [name for name in names if name != "id"]
+
+
+def select_documents(columns, filters: DocumentFilters, after_id: int = 0):
+    """SELECT des seules colonnes demandées, filtré et trié par id (index status/doc_type + id)"""
+    query = select(*(COLUMNS[name] for name in columns)).where(Document.id > after_id)
+    if filters.status:
+        query = query.where(Document.status == filters.status)
+    if filters.doc_type:
+        query = query.where(Document.doc_type == filters.doc_type)
+    if filters.uploaded_after:
+        query = query.where(Document.upload_date >= filters.uploaded_after)
+    if filters.uploaded_before:
+        query = query.where(Document.upload_date < filters.uploaded_before)
+    return query.order_by(Document.id)
+
+
+def list_page(db, columns, filters: DocumentFilters, after_id: int = 0, limit: int = 100):
+    """Une page de documents ; next_after_id vaut None sur la dernière page"""
+    rows = db.execute(select_documents(columns, filters, after_id).limit(limit)).mappings().all()
+    items = [dict(row) for row in rows]
+    return {
+        "items": items,
+        "next_after_id": items[-1]["id"] if len(items) == limit else None,
+    }
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+
+def iter_export(columns, filters: DocumentFilters):
+    """Tableau JSON produit ligne à ligne, lu par blocs via un curseur serveur (stream_results).
+
+    La session est ouverte ici : le générateur vit plus longtemps que la requête FastAPI.
+    """
+    db = SessionLocal()
+    try:
+        result = db.execute(
+            select_documents(columns, filters),
+            execution_options={"stream_results": True, "yield_per": EXPORT_BATCH_SIZE}
+        ).mappings()
+        yield "["
+        separator = ""
+        for row in result:
+            yield separator + json.dumps(dict(row), default=_json_default, ensure_ascii=False)
+            separator = ",\n"
+        yield "]\n"
+    finally:
+        db.close()
@@ -1,14 +1,26 @@
-from fastapi import FastAPI, UploadFile, File, Depends, Form
+from fastapi import FastAPI, UploadFile, File, Depends, Form, HTTPException, Query
+from fastapi.responses import StreamingResponse
+from datetime import datetime
+from typing import List, Optional
+from sqlalchemy import text
 from sqlalchemy.orm import Session
-import shutil
 import os
+import uuid
 
 from database import engine, Base, get_db
 import models
-from processing import extract_text_from_file, publish_to_queue
+from processing import close_publisher, copy_with_hash
+import pipeline
+import listing
 
 # Création des tables dans la BDD
 models.Base.metadata.create_all(bind=engine)
+# Colonne et index ajoutés après coup : create_all ne modifie pas une table déjà créée
+with engine.begin() as conn:
+    conn.execute(text("ALTER TABLE documents ADD COLUMN IF NOT EXISTS content_hash VARCHAR(64)"))
+    conn.execute(text("ALTER TABLE documents ADD COLUMN IF NOT EXISTS patient_id VARCHAR"))
+for table_index in models.DocumentMetadata.__table__.indexes:
+    table_index.create(bind=engine, checkfirst=True)
 
 app = FastAPI(title="DocIngestor Service")
 
@@ -16,57 +28,105 @@ app = FastAPI(title="DocIngestor Service")
 UPLOAD_DIR = "temp_uploads"
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 
-@app.post("/ingest/")
-async def ingest_document(
+@app.on_event("startup")
+def startup():
+    pipeline.resume_pending(UPLOAD_DIR)
+
+@app.on_event("shutdown")
+def shutdown():
+    # Termine les extractions en cours, puis ferme les connexions RabbitMQ du publisher
+    pipeline.shutdown()
+    close_publisher()
+
+# Endpoint synchrone : FastAPI l'exécute dans son threadpool, la boucle d'événements n'est jamais bloquée.
+# L'extraction Tika (lente sur les gros PDF) est confiée au pool de pipeline.py.
+@app.post("/ingest/", status_code=202)
+def ingest_document(
     file: UploadFile = File(...), 
     doc_type: str = Form(...), # ex: "CR_HOSPITALISATION"
+    patient_id: Optional[str] = Form(None), # ex: "P123" ; sans lui, le document constitue seul son dossier
     db: Session = Depends(get_db)
 ):
-    # 1. Sauvegarder métadonnées en BDD (Status: PENDING)
+    # 1. Sauvegarder le fichier physiquement (temporaire), empreinte calculée pendant la copie
+    staging_path = f"{UPLOAD_DIR}/upload_{uuid.uuid4().hex}_{file.filename}"
+    content_hash = copy_with_hash(file.file, staging_path)
+
+    # 2. Contenu déjà reçu : pas de nouvelle extraction, anonymisation ni indexation
+    existing = pipeline.find_duplicates(db, [content_hash]).get(content_hash)
+    if existing is not None:
+        os.remove(staging_path)
+        return {"message": "Document déjà ingéré", "doc_id": existing.id, "status": existing.status, "duplicate": True}
+
+    # 3. Sauvegarder métadonnées en BDD (Status: PENDING)
     new_doc = models.DocumentMetadata(
         filename=file.filename,
         status="PENDING",
-        doc_type=doc_type
+        doc_type=doc_type,
+        content_hash=content_hash,
+        patient_id=patient_id or None
     )
     db.add(new_doc)
     db.commit()
     db.refresh(new_doc)
-    
-    # 2. Sauvegarder le fichier physiquement (temporaire)
     file_path = f"{UPLOAD_DIR}/{new_doc.id}_{file.filename}"
-    with open(file_path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
-        
-    # 3. Extraire le texte via Tika
-    extracted_text = extract_text_from_file(file_path)
-    
-    if not extracted_text:
-        new_doc.status = "ERROR_EXTRACTION"
-        db.commit()
-        return {"error": "Impossible d'extraire le texte"}
-    
-    # 4. Envoyer dans RabbitMQ
-    try:
-        payload_meta = {"filename": file.filename, "type": doc_type}
-        publish_to_queue(new_doc.id, extracted_text, payload_meta)
-        
-        # 5. Mise à jour statut (Status: PROCESSED)
-        new_doc.status = "PROCESSED"
-        db.commit()
+    os.replace(staging_path, file_path)
         
-        # Nettoyage (optionnel : supprimer le fichier temp)
-        # os.remove(file_path)
-        
-        return {"message": "Ingestion réussie", "doc_id": new_doc.id}
-        
-    except Exception as e:
+    # 4. Extraction Tika + envoi RabbitMQ en arrière-plan (suivi via /documents/{id}/status)
+    if not pipeline.submit_document(new_doc.id, file_path):
         new_doc.status = "ERROR_QUEUE"
         db.commit()
-        return {"error": str(e)}
+        raise HTTPException(status_code=503, detail="File d'extraction pleine, réessayez plus tard")
+
+    return {"message": "Ingestion en cours", "doc_id": new_doc.id, "status": "PENDING"}
 
+# Reprise d'un historique : plusieurs fichiers et/ou archives zip / tar en un appel.
+# Traitement complet dans la requête, la réponse indique le débit obtenu.
+@app.post("/ingest/bulk/")
+def ingest_bulk(
+    files: List[UploadFile] = File(...),
+    doc_type: str = Form(...),
+    patient_id: Optional[str] = Form(None), # Même patient pour tous les fichiers du lot
+    db: Session = Depends(get_db)
+):
+    return pipeline.ingest_bulk(db, [(f.filename, f.file) for f in files], doc_type, UPLOAD_DIR, patient_id or None)
+
+def document_filters(
+    status: Optional[str] = None,
+    doc_type: Optional[str] = None,
+    uploaded_after: Optional[datetime] = None,
+    uploaded_before: Optional[datetime] = None,
+    fields: Optional[str] = Query(None, description="Colonnes renvoyées, ex. id,filename,status"),
+):
+    try:
+        columns = listing.parse_fields(fields)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return columns, listing.DocumentFilters(status, doc_type, uploaded_after, uploaded_before)
+
+# Pagination par curseur (keyset) : ?after_id=<next_after_id de la page précédente>
 @app.get("/documents/")
-def list_documents(db: Session = Depends(get_db)):
-    return db.query(models.DocumentMetadata).all()
+def list_documents(
+    after_id: int = 0,
+    limit: int = Query(100, ge=1, le=listing.MAX_PAGE_SIZE),
+    params=Depends(document_filters),
+    db: Session = Depends(get_db)
+):
+    columns, filters = params
+    return listing.list_page(db, columns, filters, after_id, limit)
+
+# Export complet en JSON, envoyé au fil de la lecture (curseur serveur, sans tout charger)
+@app.get("/documents/export")
+def export_documents(params=Depends(document_filters)):
+    columns, filters = params
+    return StreamingResponse(listing.iter_export(columns, filters), media_type="application/json")
+
+
+@app.get("/documents/{doc_id}/status")
+def document_status(doc_id: int, db: Session = Depends(get_db)):
+    doc = db.get(models.DocumentMetadata, doc_id)
+    if doc is None:
+        raise HTTPException(status_code=404, detail="Document inconnu")
+    return {"doc_id": doc.id, "filename": doc.filename, "status": doc.status}
 
 
 @app.get("/health")
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, DateTime
+from sqlalchemy import Column, Integer, String, DateTime, Index
 from sqlalchemy.sql import func
 from database import Base
 
@@ -9,4 +9,13 @@ class DocumentMetadata(Base):
     filename = Column(String, index=True)
     upload_date = Column(DateTime(timezone=True), server_default=func.now())
     status = Column(String) # "PENDING", "PROCESSED", "ERROR"
-    doc_type = Column(String) # "ORDONNANCE", "COMPTE-RENDU", etc.
\ No newline at end of file
+    doc_type = Column(String) # "ORDONNANCE", "COMPTE-RENDU", etc.
+    content_hash = Column(String(64), index=True) # SHA-256 du fichier : détection des doublons
+    patient_id = Column(String, index=True) # Dossier patient (ex. "P123"), transmis à l'indexeur pour la recherche par patient
+
+    # Listing paginé (/documents/) : filtre + tri par id servis par un même index
+    __table_args__ = (
+        Index("ix_documents_status_id", "status", "id"),
+        Index("ix_documents_doc_type_id", "doc_type", "id"),
+        Index("ix_documents_upload_date", "upload_date"),
+    )
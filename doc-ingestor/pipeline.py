@@ -0,0 +1,254 @@
+import os
+import time
+import uuid
+import tarfile
+import zipfile
+import threading
+from datetime import date
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import update
+
+from database import SessionLocal
+import models
+from processing import extract_text_from_file, publish_to_queue, publish_batch, copy_with_hash
+
+# Extractions Tika simultanées ; au-delà de EXTRACTION_QUEUE_MAX documents en attente, l'upload est refusé
+EXTRACTION_WORKERS = int(os.getenv("EXTRACTION_WORKERS", "4"))
+EXTRACTION_QUEUE_MAX = int(os.getenv("EXTRACTION_QUEUE_MAX", "100"))
+
+# Ingestion en masse : extractions parallèles par requête et taille des lots publiés
+BULK_EXTRACTION_WORKERS = int(os.getenv("BULK_EXTRACTION_WORKERS", str(EXTRACTION_WORKERS)))
+BULK_PUBLISH_BATCH = int(os.getenv("BULK_PUBLISH_BATCH", "100"))
+TAR_EXTENSIONS = (".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tar.xz")
+
+executor = ThreadPoolExecutor(max_workers=EXTRACTION_WORKERS, thread_name_prefix="extraction")
+_backlog = threading.BoundedSemaphore(EXTRACTION_QUEUE_MAX)
+
+
+def find_duplicates(db, content_hashes):
+    """Documents déjà reçus avec le même contenu, par empreinte (ceux en erreur peuvent être renvoyés)"""
+    if not content_hashes:
+        return {}
+    docs = db.query(models.DocumentMetadata).filter(
+        models.DocumentMetadata.content_hash.in_(set(content_hashes)),
+        ~models.DocumentMetadata.status.like("ERROR%")
+    ).order_by(models.DocumentMetadata.id).all()
+    duplicates = {}
+    for doc in docs:
+        duplicates.setdefault(doc.content_hash, doc)
+    return duplicates
+
+
+def set_status(db, doc, status):
+    doc.status = status
+    db.commit()
+
+
+def process_document(doc_id: int, file_path: str):
+    """Extraction Tika puis publication RabbitMQ, exécutée par un worker (session BDD propre au thread)"""
+    db = SessionLocal()
+    try:
+        doc = db.get(models.DocumentMetadata, doc_id)
+        if doc is None:
+            return
+        set_status(db, doc, "EXTRACTING")
+
+        extracted_text = extract_text_from_file(file_path)
+        if not extracted_text:
+            set_status(db, doc, "ERROR_EXTRACTION")
+            return
+
+        try:
+            # Date du document (jour d'upload) et patient : filtres de la recherche (API de l'indexeur)
+            payload_meta = {
+                "filename": doc.filename,
+                "type": doc.doc_type,
+                "date": doc.upload_date.date().isoformat() if doc.upload_date else None,
+                "patient_id": doc.patient_id
+            }
+            publish_to_queue(doc.id, extracted_text, payload_meta)
+            set_status(db, doc, "PROCESSED")
+        except Exception as e:
+            print(f"Erreur publication document {doc_id}: {e}")
+            set_status(db, doc, "ERROR_QUEUE")
+    finally:
+        db.close()
+
+
+def _run(doc_id, file_path):
+    try:
+        process_document(doc_id, file_path)
+    except Exception as e:
+        print(f"Erreur traitement document {doc_id}: {e}")
+    finally:
+        _backlog.release()
+
+
+def submit_document(doc_id: int, file_path: str):
+    """Confie le document au pool d'extraction. Retourne False si la file d'attente est pleine."""
+    if not _backlog.acquire(blocking=False):
+        return False
+    executor.submit(_run, doc_id, file_path)
+    return True
+
+
+def resume_pending(upload_dir: str):
+    """Au démarrage : relance les documents restés en cours lors de l'arrêt précédent"""
+    db = SessionLocal()
+    try:
+        docs = db.query(models.DocumentMetadata).filter(
+            models.DocumentMetadata.status.in_(["PENDING", "EXTRACTING"])
+        ).all()
+        for doc in docs:
+            file_path = f"{upload_dir}/{doc.id}_{doc.filename}"
+            if not os.path.exists(file_path):
+                set_status(db, doc, "ERROR_EXTRACTION")
+            elif not submit_document(doc.id, file_path):
+                break
+    finally:
+        db.close()
+
+
+def _copy_member(source, path):
+    with source:
+        return copy_with_hash(source, path)
+
+
+def expand_upload(path: str, filename: str, staging_prefix: str, content_hash: str):
+    """Liste (nom, chemin, empreinte) des documents d'un upload : lui-même, ou le contenu d'une archive zip / tar.
+
+    Les membres sont copiés un par un depuis l'archive sur disque, sans la charger en mémoire.
+    Seul le nom de base des membres est conservé (pas de chemin relatif hors du dossier d'upload).
+    """
+    lowered = filename.lower()
+    # Par extension : un .docx est aussi un zip, mais c'est un document à envoyer à Tika
+    if lowered.endswith(".zip"):
+        with zipfile.ZipFile(path) as archive:
+            for n, info in enumerate(archive.infolist()):
+                name = os.path.basename(info.filename)
+                if info.is_dir() or not name or info.filename.startswith("__MACOSX/"):
+                    continue
+                member_path = f"{staging_prefix}_{n}_{name}"
+                yield name, member_path, _copy_member(archive.open(info), member_path)
+        os.remove(path)
+    elif lowered.endswith(TAR_EXTENSIONS):
+        with tarfile.open(path, "r:*") as archive:
+            for n, member in enumerate(archive):
+                name = os.path.basename(member.name)
+                if not member.isfile() or not name:
+                    continue
+                member_path = f"{staging_prefix}_{n}_{name}"
+                yield name, member_path, _copy_member(archive.extractfile(member), member_path)
+        os.remove(path)
+    else:
+        yield filename, path, content_hash
+
+
+def ingest_bulk(db, uploads, doc_type: str, upload_dir: str, patient_id: str = None):
+    """Ingestion en masse, traitée dans la requête pour pouvoir rendre un rapport de débit.
+
+    uploads : liste (nom, fichier) des fichiers reçus, tous rattachés à patient_id s'il est donné. Une seule insertion pour toutes les lignes,
+    extractions Tika en parallèle, publication RabbitMQ par lots de BULK_PUBLISH_BATCH.
+    """
+    start = time.perf_counter()
+    batch_id = uuid.uuid4().hex[:8]
+
+    # 1. Fichiers (et contenu des archives) sur disque
+    staged = []
+    for n, (filename, fileobj) in enumerate(uploads):
+        staging_prefix = f"{upload_dir}/bulk_{batch_id}_{n}"
+        path = f"{staging_prefix}_{os.path.basename(filename)}"
+        content_hash = copy_with_hash(fileobj, path)
+        staged.extend(expand_upload(path, os.path.basename(filename), staging_prefix, content_hash))
+
+    # Contenus déjà ingérés (ou présents deux fois dans le lot) : ni ligne, ni extraction
+    existing = find_duplicates(db, [content_hash for _, _, content_hash in staged])
+    unique, skipped, first_seen = [], [], {}
+    for name, path, content_hash in staged:
+        if content_hash in existing or content_hash in first_seen:
+            os.remove(path)
+            skipped.append((name, content_hash))
+        else:
+            first_seen[content_hash] = len(unique)
+            unique.append((name, path, content_hash))
+    staged = unique
+
+    # 2. Une seule insertion pour toutes les lignes (insertmanyvalues + RETURNING des ids).
+    # Les ids sont lus avant le commit, qui expire les objets (sinon un SELECT par document).
+    rows = [
+        models.DocumentMetadata(
+            filename=name, status="EXTRACTING", doc_type=doc_type, content_hash=content_hash, patient_id=patient_id
+        )
+        for name, _, content_hash in staged
+    ]
+    db.add_all(rows)
+    db.flush()
+    docs = [(row.id, row.filename) for row in rows]
+    db.commit()
+    paths = []
+    for (doc_id, name), (_, path, _) in zip(docs, staged):
+        # Même convention de nommage que /ingest/ (reprise au redémarrage)
+        final_path = f"{upload_dir}/{doc_id}_{name}"
+        os.replace(path, final_path)
+        paths.append(final_path)
+    total_bytes = sum(os.path.getsize(path) for path in paths)
+    upload_day = date.today().isoformat()
+
+    # 3. Extraction parallèle, publication par lots au fil des résultats
+    statuses = {}
+    batch = []
+
+    def flush():
+        try:
+            publish_batch([
+                (doc_id, text, {"filename": name, "type": doc_type, "date": upload_day, "patient_id": patient_id})
+                for (doc_id, name), text in batch
+            ])
+            statuses.update({doc_id: "PROCESSED" for (doc_id, _), _ in batch})
+        except Exception as e:
+            print(f"Erreur publication lot: {e}")
+            statuses.update({doc_id: "ERROR_QUEUE" for (doc_id, _), _ in batch})
+        batch.clear()
+
+    with ThreadPoolExecutor(max_workers=BULK_EXTRACTION_WORKERS) as pool:
+        for doc, text in zip(docs, pool.map(extract_text_from_file, paths)):
+            if not text:
+                statuses[doc[0]] = "ERROR_EXTRACTION"
+                continue
+            batch.append((doc, text))
+            if len(batch) >= BULK_PUBLISH_BATCH:
+                flush()
+    if batch:
+        flush()
+
+    # 4. Statuts mis à jour par valeur (un UPDATE par statut, pas par document)
+    for status in set(statuses.values()):
+        ids = [doc_id for doc_id, s in statuses.items() if s == status]
+        db.execute(update(models.DocumentMetadata).where(models.DocumentMetadata.id.in_(ids)).values(status=status))
+    db.commit()
+
+    elapsed = time.perf_counter() - start
+    processed = sum(1 for s in statuses.values() if s == "PROCESSED")
+    return {
+        "documents": len(docs),
+        "processed": processed,
+        "errors": [
+            {"doc_id": doc_id, "filename": name, "status": statuses[doc_id]}
+            for doc_id, name in docs if statuses[doc_id] != "PROCESSED"
+        ],
+        "duplicates": [
+            {
+                "filename": name,
+                "doc_id": existing[content_hash].id if content_hash in existing else docs[first_seen[content_hash]][0]
+            }
+            for name, content_hash in skipped
+        ],
+        "elapsed_s": round(elapsed, 3),
+        "docs_per_s": round(len(docs) / elapsed, 2) if elapsed else None,
+        "mb_per_s": round(total_bytes / 1e6 / elapsed, 2) if elapsed else None,
+    }
+
+
+def shutdown():
+    executor.shutdown(wait=True)
@@ -1,11 +1,31 @@
 import pika
 import json
+import hashlib
+import time
+import functools
+import threading
 from tika import parser
+from blob_store import pack_text
 import os
 
 # Configuration RabbitMQ
 RABBITMQ_HOST = os.getenv('RABBITMQ_HOST', 'localhost')
 QUEUE_NAME = 'raw_documents_queue'
+PUBLISH_RETRIES = int(os.getenv('PUBLISH_RETRIES', '3'))
+# Délai (s) d'ouverture de la connexion, puis d'attente des accusés d'un lot
+PUBLISH_TIMEOUT = float(os.getenv('PUBLISH_TIMEOUT', '30'))
+
+def copy_with_hash(source, path: str):
+    """Copie un flux vers path par blocs en calculant son SHA-256 au passage (pas de relecture)"""
+    digest = hashlib.sha256()
+    with open(path, "wb") as out:
+        while True:
+            block = source.read(1024 * 1024)
+            if not block:
+                break
+            digest.update(block)
+            out.write(block)
+    return digest.hexdigest()
 
 def extract_text_from_file(file_path: str):
     """Envoie le fichier au serveur Tika (port 9998) pour extraire le texte"""
@@ -18,27 +38,225 @@ def extract_text_from_file(file_path: str):
         print(f"Erreur Tika: {e}")
         return None
 
+class _Batch:
+    """Messages d'un lot en attente d'accusé ; confirmed est partagé entre les tentatives"""
+
+    def __init__(self, confirmed):
+        self.confirmed = confirmed
+        self.positions = [i for i, ok in enumerate(confirmed) if not ok]
+        self.remaining = len(self.positions)
+        self.error = None
+        self.done = threading.Event()
+        if not self.remaining:
+            self.done.set()
+
+    def confirm(self, i):
+        if not self.confirmed[i]:
+            self.confirmed[i] = True
+            self.remaining -= 1
+        if self.remaining == 0:
+            self.done.set()
+
+    def fail(self, error):
+        self.error = self.error or error
+        self.done.set()
+
+
+class _Link:
+    """SelectConnection + canal en mode confirm, pilotés par leur propre thread (boucle d'événements pika).
+
+    La boucle traite les heartbeats en continu : la connexion reste valide entre deux uploads.
+    Les méthodes préfixées par _on ne s'exécutent que dans ce thread.
+    """
+
+    def __init__(self):
+        self.ready = threading.Event()
+        self.error = None
+        self.channel = None
+        self.next_tag = 1
+        self.pending = {} # delivery_tag -> (lot, position), par tag croissant
+        self.connection = pika.SelectConnection(
+            pika.ConnectionParameters(host=RABBITMQ_HOST),
+            on_open_callback=self._on_open,
+            on_open_error_callback=self._on_closed,
+            on_close_callback=self._on_closed
+        )
+        self.thread = threading.Thread(target=self.connection.ioloop.start, name="rabbitmq-publisher", daemon=True)
+        self.thread.start()
+
+    def _on_open(self, connection):
+        connection.channel(on_open_callback=self._on_channel_open)
+
+    def _on_channel_open(self, channel):
+        self.channel = channel
+        channel.add_on_close_callback(self._on_channel_closed)
+        # Publisher confirms, puis déclaration de la queue (une fois par connexion)
+        channel.confirm_delivery(ack_nack_callback=self._on_confirm, callback=lambda _: channel.queue_declare(
+            queue=QUEUE_NAME, durable=True, callback=lambda _: self.ready.set()
+        ))
+
+    def _on_channel_closed(self, channel, reason):
+        self._fail(reason if isinstance(reason, pika.exceptions.AMQPError) else pika.exceptions.AMQPChannelError(reason))
+        if self.connection.is_open:
+            self.connection.close()
+
+    def _on_closed(self, connection, reason):
+        self._fail(reason if isinstance(reason, pika.exceptions.AMQPError) else pika.exceptions.AMQPConnectionError(reason))
+        connection.ioloop.stop()
+
+    def _fail(self, error):
+        # Les messages non confirmés sont republiés par l'appelant, sur une nouvelle connexion
+        self.error = self.error or error
+        self.ready.set()
+        for batch, _ in self.pending.values():
+            batch.fail(self.error)
+        self.pending.clear()
+
+    def _on_confirm(self, frame):
+        method = frame.method
+        tags = [tag for tag in self.pending if tag <= method.delivery_tag] if method.multiple else [method.delivery_tag]
+        for tag in tags:
+            batch, i = self.pending.pop(tag, (None, None))
+            if batch is None:
+                continue
+            if isinstance(method, pika.spec.Basic.Ack):
+                batch.confirm(i)
+            else:
+                batch.fail(pika.exceptions.NackError([i]))
+
+    def _on_publish(self, bodies, batch):
+        # Tout le lot d'un trait, sans attendre les accusés entre deux messages
+        try:
+            for i in batch.positions:
+                if self.error is not None:
+                    raise self.error
+                self.pending[self.next_tag] = (batch, i)
+                self.next_tag += 1
+                self.channel.basic_publish(
+                    exchange='',
+                    routing_key=QUEUE_NAME,
+                    body=bodies[i],
+                    properties=pika.BasicProperties(
+                        delivery_mode=2,  # Rend le message persistant (ne se perd pas si RabbitMQ crash)
+                    )
+                )
+        except Exception as e:
+            batch.fail(e)
+            self._fail(e)
+
+    def publish(self, bodies, batch):
+        """Confie le lot à la boucle de la connexion (appelable depuis n'importe quel thread)"""
+        self.connection.ioloop.add_callback_threadsafe(functools.partial(self._on_publish, bodies, batch))
+
+    def _on_close(self):
+        if self.connection.is_open:
+            self.connection.close() # _on_closed arrête la boucle
+        elif not self.connection.is_closing:
+            self.connection.ioloop.stop()
+
+    def close(self):
+        # Plus réutilisable, même si la boucle ne répond plus
+        self.error = self.error or pika.exceptions.AMQPConnectionError("Connexion fermée")
+        if self.thread.is_alive():
+            self.connection.ioloop.add_callback_threadsafe(self._on_close)
+            self.thread.join(timeout=PUBLISH_TIMEOUT)
+
+
+class RabbitPublisher:
+    """Publisher RabbitMQ persistant, partagé par tous les threads.
+
+    Une seule connexion asynchrone (SelectConnection) : les threads y déposent leurs lots, publiés
+    sans attente entre les messages, puis attendent une seule fois les accusés du broker pour tout le lot.
+    """
+
+    def __init__(self, retries=PUBLISH_RETRIES):
+        self.retries = retries
+        self._link = None
+        self._lock = threading.Lock()
+
+    def _open(self):
+        with self._lock:
+            link = self._link
+            if link is None or link.error is not None:
+                if link is not None:
+                    link.close()
+                link = self._link = _Link()
+        if not link.ready.wait(PUBLISH_TIMEOUT):
+            link.close()
+            raise pika.exceptions.AMQPConnectionError("Connexion RabbitMQ : délai dépassé")
+        if link.error is not None:
+            raise link.error
+        return link
+
+    def _send(self, bodies, confirmed):
+        link = self._open()
+        batch = _Batch(confirmed)
+        link.publish(bodies, batch)
+        if not batch.done.wait(PUBLISH_TIMEOUT):
+            link.close()
+            raise pika.exceptions.AMQPConnectionError("Accusés RabbitMQ : délai dépassé")
+        if batch.error is not None:
+            raise batch.error
+
+    def publish_many(self, messages):
+        """Publie plusieurs messages d'un trait puis attend leurs accusés (publisher confirms).
+
+        Après une coupure, seuls les messages non confirmés sont republiés (au moins une fois).
+        """
+        bodies = [json.dumps(message) for message in messages]
+        confirmed = [False] * len(bodies)
+        for attempt in range(self.retries):
+            try:
+                self._send(bodies, confirmed)
+                return len(bodies)
+            except (pika.exceptions.AMQPConnectionError, pika.exceptions.AMQPChannelError) as e:
+                if attempt == self.retries - 1:
+                    raise
+                print(f" [!] RabbitMQ indisponible ({e!r}), reconnexion...")
+                time.sleep(0.5 * 2 ** attempt)
+        return len(bodies)
+
+    def publish(self, message):
+        self.publish_many([message])
+
+    def close(self):
+        with self._lock:
+            if self._link is not None:
+                self._link.close()
+                self._link = None
+
+
+_publisher = None
+_publisher_lock = threading.Lock()
+
+def get_publisher():
+    global _publisher
+    with _publisher_lock:
+        if _publisher is None:
+            _publisher = RabbitPublisher()
+        return _publisher
+
+def close_publisher():
+    global _publisher
+    with _publisher_lock:
+        if _publisher is not None:
+            _publisher.close()
+            _publisher = None
+
 def publish_to_queue(doc_id: int, text: str, metadata: dict):
     """Envoie le JSON dans RabbitMQ"""
-    connection = pika.BlockingConnection(pika.ConnectionParameters(host=RABBITMQ_HOST))
-    channel = connection.channel()
-    
-    # On s'assure que la queue existe
-    channel.queue_declare(queue=QUEUE_NAME, durable=True)
-    
+    # Texte en clair, compressé, ou référence vers le store de blobs selon sa taille (blob_store.py)
     message = {
         "doc_id": doc_id,
-        "text": text,
+        **pack_text("text", text),
         "metadata": metadata
     }
-    
-    channel.basic_publish(
-        exchange='',
-        routing_key=QUEUE_NAME,
-        body=json.dumps(message),
-        properties=pika.BasicProperties(
-            delivery_mode=2,  # Rend le message persistant (ne se perd pas si RabbitMQ crash)
-        )
-    )
+    get_publisher().publish(message)
     print(f" [x] Envoyé document ID {doc_id} vers RabbitMQ")
-    connection.close()
\ No newline at end of file
+
+def publish_batch(documents):
+    """Envoie plusieurs documents (doc_id, text, metadata) d'un coup, pour l'ingestion en masse"""
+    messages = [{"doc_id": doc_id, **pack_text("text", text), "metadata": metadata} for doc_id, text, metadata in documents]
+    sent = get_publisher().publish_many(messages)
+    print(f" [x] Envoyé {sent} documents vers RabbitMQ")
+    return sent
@@ -0,0 +1,16 @@
+"""Remplace le module database (PostgreSQL) par une base SQLite en mémoire pour les tests"""
+import sys
+import types
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import declarative_base, sessionmaker
+from sqlalchemy.pool import StaticPool
+
+engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+database = types.ModuleType("database")
+database.engine = engine
+database.Base = declarative_base()
+database.SessionLocal = SessionLocal
+sys.modules['database'] = database
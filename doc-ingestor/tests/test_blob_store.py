@@ -0,0 +1,70 @@
+import unittest
+from unittest.mock import patch
+import sys
+import os
+import json
+import tempfile
+
+# Add parent directory to path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import blob_store
+from blob_store import pack_text, unpack_text, release_text
+
+TEXT = "Compte rendu : patient <PERSON>, pouls faible, langue pâle. " * 200
+
+class TestBlobStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        patcher = patch('blob_store.BLOB_STORE_DIR', self.tmp.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.tmp.cleanup)
+
+    def roundtrip(self, fields):
+        # Passage par JSON comme dans RabbitMQ
+        return json.loads(json.dumps({"doc_id": 1, **fields}))
+
+    @patch('blob_store.INLINE_COMPRESSION', 'none')
+    @patch('blob_store.CLAIM_CHECK_THRESHOLD', 1024)
+    def test_small_text_stays_inline(self):
+        self.assertEqual(pack_text("text", "court"), {"text": "court"})
+        self.assertEqual(unpack_text({"text": "court"}, "text"), "court")
+
+    @patch('blob_store.INLINE_COMPRESSION', 'gzip')
+    @patch('blob_store.CLAIM_CHECK_THRESHOLD', 0)
+    def test_inline_compression(self):
+        fields = pack_text("text", TEXT)
+
+        self.assertEqual(set(fields), {"text_b64", "text_encoding"})
+        self.assertLess(len(fields["text_b64"]), len(TEXT) // 4)
+        self.assertEqual(unpack_text(self.roundtrip(fields), "text"), TEXT)
+
+    @patch('blob_store.INLINE_COMPRESSION', 'gzip')
+    @patch('blob_store.CLAIM_CHECK_THRESHOLD', 1024)
+    def test_claim_check_released(self):
+        fields = self.roundtrip(pack_text("text", TEXT))
+
+        self.assertNotIn("text", fields)
+        self.assertEqual(unpack_text(fields, "text"), TEXT)
+
+        release_text(fields, "text")
+        release_text(fields, "text") # Redélivrance : déjà supprimé
+        with self.assertRaises(FileNotFoundError):
+            unpack_text(fields, "text")
+
+    @patch('blob_store.INLINE_COMPRESSION', 'none')
+    @patch('blob_store.CLAIM_CHECK_THRESHOLD', 1024)
+    def test_identical_texts_do_not_share_blob(self):
+        # Texte sans donnée à masquer : la sortie de deid-service est identique à l'entrée
+        incoming = self.roundtrip(pack_text("text", TEXT))
+        outgoing = self.roundtrip(pack_text("original_text_masked", TEXT))
+
+        self.assertNotEqual(incoming["text_ref"]["key"], outgoing["original_text_masked_ref"]["key"])
+        # deid-service libère le texte reçu après avoir publié le texte masqué
+        release_text(incoming, "text")
+        self.assertEqual(unpack_text(outgoing, "original_text_masked"), TEXT)
+
+if __name__ == '__main__':
+    unittest.main()
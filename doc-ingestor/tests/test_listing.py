@@ -0,0 +1,72 @@
+import unittest
+import sys
+import os
+import json
+from datetime import datetime
+
+# Add parent directory to path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# Base SQLite en mémoire à la place de PostgreSQL
+from sqlite_database import engine, SessionLocal
+
+import models
+import listing
+from listing import DocumentFilters
+
+class TestListing(unittest.TestCase):
+
+    def setUp(self):
+        models.Base.metadata.drop_all(bind=engine)
+        models.Base.metadata.create_all(bind=engine)
+        self.db = SessionLocal()
+        self.db.add_all([
+            models.DocumentMetadata(
+                filename=f"doc{i}.pdf",
+                status="PROCESSED" if i % 2 else "ERROR_EXTRACTION",
+                doc_type="ordonnance" if i < 6 else "compte-rendu",
+                upload_date=datetime(2024, 1, i + 1)
+            )
+            for i in range(10)
+        ])
+        self.db.commit()
+
+    def tearDown(self):
+        self.db.close()
+
+    def test_keyset_pages_cover_all_rows(self):
+        columns = listing.parse_fields("filename")
+        ids = []
+        after_id = 0
+        while after_id is not None:
+            page = listing.list_page(self.db, columns, DocumentFilters(), after_id, limit=4)
+            ids.extend(item["id"] for item in page["items"])
+            after_id = page["next_after_id"]
+
+        self.assertEqual(ids, list(range(1, 11)))
+        self.assertEqual(set(page["items"][0]), {"id", "filename"})
+
+    def test_filters(self):
+        filters = DocumentFilters(status="PROCESSED", doc_type="ordonnance", uploaded_after=datetime(2024, 1, 3))
+
+        page = listing.list_page(self.db, listing.parse_fields("id,status"), filters)
+
+        self.assertEqual([item["id"] for item in page["items"]], [4, 6])
+        self.assertIsNone(page["next_after_id"])
+
+    def test_parse_fields_rejects_unknown_column(self):
+        with self.assertRaises(ValueError):
+            listing.parse_fields("id,password")
+
+    def test_export_is_valid_json(self):
+        chunks = list(listing.iter_export(listing.parse_fields("filename,upload_date"), DocumentFilters(doc_type="compte-rendu")))
+
+        rows = json.loads("".join(chunks))
+        self.assertEqual([row["filename"] for row in rows], ["doc6.pdf", "doc7.pdf", "doc8.pdf", "doc9.pdf"])
+        self.assertTrue(rows[0]["upload_date"].startswith("2024-01-07"))
+        # Une ligne par morceau envoyé (plus ouverture / fermeture du tableau)
+        self.assertEqual(len(chunks), 6)
+
+if __name__ == '__main__':
+    unittest.main()
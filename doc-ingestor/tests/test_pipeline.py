@@ -0,0 +1,169 @@
+import unittest
+from unittest.mock import patch
+import sys
+import os
+import io
+import hashlib
+import tarfile
+import zipfile
+import tempfile
+from datetime import datetime
+
+# Add parent directory to path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# Base SQLite en mémoire à la place de PostgreSQL
+from sqlite_database import engine, SessionLocal
+import models
+import pipeline
+
+class TestPipeline(unittest.TestCase):
+
+    def setUp(self):
+        models.Base.metadata.drop_all(bind=engine)
+        models.Base.metadata.create_all(bind=engine)
+        self.db = SessionLocal()
+        self.doc = models.DocumentMetadata(
+            filename="cr.pdf", status="PENDING", doc_type="compte-rendu", upload_date=datetime(2024, 3, 5, 14, 30)
+        )
+        self.db.add(self.doc)
+        self.db.commit()
+
+    def tearDown(self):
+        self.db.close()
+
+    def status(self):
+        self.db.expire_all()
+        return self.db.get(models.DocumentMetadata, self.doc.id).status
+
+    @patch('pipeline.publish_to_queue')
+    @patch('pipeline.extract_text_from_file')
+    def test_process_document_publishes(self, mock_extract, mock_publish):
+        mock_extract.return_value = "Texte extrait"
+
+        pipeline.process_document(self.doc.id, "temp_uploads/1_cr.pdf")
+
+        mock_publish.assert_called_once_with(
+            self.doc.id, "Texte extrait", {"filename": "cr.pdf", "type": "compte-rendu", "date": "2024-03-05", "patient_id": None}
+        )
+        self.assertEqual(self.status(), "PROCESSED")
+
+    @patch('pipeline.publish_to_queue')
+    @patch('pipeline.extract_text_from_file')
+    def test_process_document_publishes_patient_id(self, mock_extract, mock_publish):
+        mock_extract.return_value = "Texte extrait"
+        self.doc.patient_id = "P123"
+        self.db.commit()
+
+        pipeline.process_document(self.doc.id, "temp_uploads/1_cr.pdf")
+
+        # Lu par patient_records dans l'indexeur : filtre patient_id de /api/search/patient-snippets
+        self.assertEqual(mock_publish.call_args.args[2]["patient_id"], "P123")
+
+    @patch('pipeline.publish_to_queue')
+    @patch('pipeline.extract_text_from_file')
+    def test_process_document_extraction_error(self, mock_extract, mock_publish):
+        mock_extract.return_value = None
+
+        pipeline.process_document(self.doc.id, "temp_uploads/1_cr.pdf")
+
+        mock_publish.assert_not_called()
+        self.assertEqual(self.status(), "ERROR_EXTRACTION")
+
+    @patch('pipeline.executor')
+    def test_submit_document_bounded_backlog(self, mock_executor):
+        with patch('pipeline._backlog', pipeline.threading.BoundedSemaphore(1)):
+            self.assertTrue(pipeline.submit_document(1, "a.pdf"))
+            # File pleine tant que le premier document n'est pas terminé
+            self.assertFalse(pipeline.submit_document(2, "b.pdf"))
+            mock_executor.submit.assert_called_once()
+
+    @patch('pipeline.BULK_PUBLISH_BATCH', 2)
+    @patch('pipeline.publish_batch')
+    @patch('pipeline.extract_text_from_file')
+    def test_ingest_bulk_archives(self, mock_extract, mock_publish_batch):
+        mock_extract.side_effect = lambda path: None if path.endswith("vide.txt") else f"texte {os.path.basename(path)}"
+        archive = io.BytesIO()
+        with zipfile.ZipFile(archive, "w") as z:
+            z.writestr("dossier/a.txt", "A")
+            z.writestr("dossier/", "")
+            z.writestr("vide.txt", "")
+        tar_archive = io.BytesIO()
+        with tarfile.open(fileobj=tar_archive, mode="w:gz") as t:
+            info = tarfile.TarInfo("b.txt")
+            info.size = 1
+            t.addfile(info, io.BytesIO(b"B"))
+        archive.seek(0)
+        tar_archive.seek(0)
+
+        with tempfile.TemporaryDirectory() as upload_dir:
+            report = pipeline.ingest_bulk(
+                self.db,
+                [("lot.zip", archive), ("lot.tar.gz", tar_archive), ("c.docx", io.BytesIO(b"PK zip docx"))],
+                "compte-rendu",
+                upload_dir
+            )
+            files = sorted(os.listdir(upload_dir))
+
+        self.assertEqual(report["documents"], 4)
+        self.assertEqual(report["processed"], 3)
+        self.assertEqual([e["filename"] for e in report["errors"]], ["vide.txt"])
+        # Le .docx n'est pas traité comme une archive ; seuls les documents restent dans le dossier
+        self.assertEqual(len(files), 4)
+        self.assertTrue(any(f.endswith("_c.docx") for f in files))
+        # Publication par lots de 2
+        self.assertEqual([len(c.args[0]) for c in mock_publish_batch.call_args_list], [2, 1])
+        statuses = {d.filename: d.status for d in self.db.query(models.DocumentMetadata).all() if d.id != self.doc.id}
+        self.assertEqual(statuses["vide.txt"], "ERROR_EXTRACTION")
+        self.assertEqual(statuses["b.txt"], "PROCESSED")
+
+    @patch('pipeline.publish_batch')
+    @patch('pipeline.extract_text_from_file')
+    def test_ingest_bulk_patient_id(self, mock_extract, mock_publish_batch):
+        mock_extract.return_value = "texte"
+
+        with tempfile.TemporaryDirectory() as upload_dir:
+            pipeline.ingest_bulk(self.db, [("a.pdf", io.BytesIO(b"a")), ("b.pdf", io.BytesIO(b"b"))], "ordonnance", upload_dir, "P123")
+
+        self.assertEqual([meta["patient_id"] for _, _, meta in mock_publish_batch.call_args.args[0]], ["P123", "P123"])
+        # Conservé en base : un document repris au redémarrage (resume_pending) garde son patient
+        self.assertEqual({d.patient_id for d in self.db.query(models.DocumentMetadata).filter_by(doc_type="ordonnance")}, {"P123"})
+
+    @patch('pipeline.publish_batch')
+    @patch('pipeline.extract_text_from_file')
+    def test_ingest_bulk_skips_known_content(self, mock_extract, mock_publish_batch):
+        mock_extract.return_value = "texte"
+        known = hashlib.sha256(b"deja vu").hexdigest()
+        self.doc.content_hash = known
+        self.db.commit()
+
+        with tempfile.TemporaryDirectory() as upload_dir:
+            report = pipeline.ingest_bulk(
+                self.db,
+                [("a.pdf", io.BytesIO(b"deja vu")), ("b.pdf", io.BytesIO(b"nouveau")), ("c.pdf", io.BytesIO(b"nouveau"))],
+                "compte-rendu",
+                upload_dir
+            )
+            files = os.listdir(upload_dir)
+
+        self.assertEqual(report["documents"], 1)
+        new_id = [d.id for d in self.db.query(models.DocumentMetadata).filter_by(filename="b.pdf")][0]
+        self.assertEqual(report["duplicates"], [
+            {"filename": "a.pdf", "doc_id": self.doc.id},
+            {"filename": "c.pdf", "doc_id": new_id},
+        ])
+        self.assertEqual(files, [f"{new_id}_b.pdf"])
+        mock_extract.assert_called_once()
+
+    def test_find_duplicates_ignores_errors(self):
+        self.doc.content_hash = "abc"
+        self.db.commit()
+        self.assertEqual(pipeline.find_duplicates(self.db, ["abc"])["abc"].id, self.doc.id)
+
+        self.doc.status = "ERROR_EXTRACTION"
+        self.db.commit()
+        self.assertEqual(pipeline.find_duplicates(self.db, ["abc"]), {})
+
+if __name__ == '__main__':
+    unittest.main()
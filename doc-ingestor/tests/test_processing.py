@@ -3,14 +3,111 @@ from unittest.mock import MagicMock, patch
 import sys
 import os
 import json
+import pika
+import io
+import hashlib
+import tempfile
+from types import SimpleNamespace
 
 # Add parent directory to path
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-from processing import extract_text_from_file, publish_to_queue
+import processing
+from processing import extract_text_from_file, publish_to_queue, publish_batch, copy_with_hash
+
+class FakeChannel:
+    """Canal pika asynchrone minimal : accusé immédiat (lost_at : connexion perdue à ce message)"""
+
+    def __init__(self, connection, lost_at):
+        self.connection = connection
+        self.lost_at = lost_at
+        self.declared, self.published, self.acks = [], [], []
+
+    def add_on_close_callback(self, callback):
+        pass
+
+    def confirm_delivery(self, ack_nack_callback, callback):
+        self.on_confirm = ack_nack_callback
+        callback(None)
+
+    def queue_declare(self, queue, durable, callback):
+        self.declared.append((queue, durable))
+        callback(None)
+
+    def basic_publish(self, exchange, routing_key, body, properties):
+        if len(self.published) + 1 == self.lost_at:
+            self.connection.lose()
+            raise pika.exceptions.ChannelWrongStateError("Canal fermé")
+        self.published.append((routing_key, body, properties.delivery_mode))
+        if self.lost_at:
+            # Messages confirmés un par un avant la coupure
+            self.ack(len(self.published), multiple=False)
+
+    def ack(self, tag, multiple=True):
+        self.acks.append(tag)
+        self.on_confirm(SimpleNamespace(method=pika.spec.Basic.Ack(delivery_tag=tag, multiple=multiple)))
+
+
+class FakeConnection:
+    """SelectConnection dont la boucle exécute les callbacks sur-le-champ ; les accusés arrivent après chaque lot"""
+
+    def __init__(self, parameters, on_open_callback, on_open_error_callback, on_close_callback, lost_at=None, refused=False):
+        self.on_open, self.on_open_error, self.on_close = on_open_callback, on_open_error_callback, on_close_callback
+        self.refused = refused
+        self.is_open, self.is_closing = False, False
+        self.channel_obj = FakeChannel(self, lost_at)
+        self.ioloop = self
+
+    # --- ioloop ---
+    def start(self):
+        if self.refused:
+            self.on_open_error(self, pika.exceptions.AMQPConnectionError("refusée"))
+            return
+        self.is_open = True
+        self.on_open(self)
+
+    def stop(self):
+        pass
+
+    def add_callback_threadsafe(self, callback):
+        callback()
+        if self.is_open and self.channel_obj.published and self.channel_obj.lost_at is None:
+            self.channel_obj.ack(len(self.channel_obj.published))
+
+    # --- connexion ---
+    def channel(self, on_open_callback):
+        on_open_callback(self.channel_obj)
+
+    def lose(self):
+        self.is_open = False
+        self.on_close(self, pika.exceptions.StreamLostError("perte"))
+
+    def close(self):
+        self.lose()
+
+
+def fake_connections(mock_connection, lost_at=(None,), refused=False):
+    """Remplace pika.SelectConnection ; retourne la liste des connexions créées"""
+    connections = []
+    lost_at = list(lost_at)
+
+    def connect(*args, **kwargs):
+        connection = FakeConnection(*args, **kwargs, lost_at=lost_at.pop(0) if lost_at else None, refused=refused)
+        connections.append(connection)
+        return connection
+    mock_connection.side_effect = connect
+    return connections
+
 
 class TestProcessing(unittest.TestCase):
 
+    def setUp(self):
+        # Publisher global recréé pour chaque test (connexions mockées)
+        processing._publisher = None
+
+    def tearDown(self):
+        processing.close_publisher()
+
     @patch('processing.parser')
     def test_extract_text_from_file_success(self, mock_parser):
         # Setup mock
@@ -34,13 +131,9 @@ class TestProcessing(unittest.TestCase):
         # Verify
         self.assertIsNone(result)
 
-    @patch('processing.pika')
-    def test_publish_to_queue(self, mock_pika):
-        # Setup mocks
-        mock_connection = MagicMock()
-        mock_channel = MagicMock()
-        mock_pika.BlockingConnection.return_value = mock_connection
-        mock_connection.channel.return_value = mock_channel
+    @patch('processing.pika.SelectConnection')
+    def test_publish_to_queue(self, mock_connection):
+        connections = fake_connections(mock_connection)
         
         doc_id = 123
         text = "Sample text"
@@ -50,21 +143,64 @@ class TestProcessing(unittest.TestCase):
         publish_to_queue(doc_id, text, metadata)
         
         # Verify
-        mock_pika.BlockingConnection.assert_called_once()
-        mock_channel.queue_declare.assert_called_once_with(queue='raw_documents_queue', durable=True)
+        mock_connection.assert_called_once()
+        channel = connections[0].channel_obj
+        self.assertEqual(channel.declared, [('raw_documents_queue', True)])
         
         expected_body = json.dumps({
             "doc_id": doc_id,
             "text": text,
             "metadata": metadata
         })
+        self.assertEqual(channel.published, [('raw_documents_queue', expected_body, 2)])
         
-        mock_channel.basic_publish.assert_called_once()
-        args, kwargs = mock_channel.basic_publish.call_args
-        self.assertEqual(kwargs['routing_key'], 'raw_documents_queue')
-        self.assertEqual(kwargs['body'], expected_body)
-        
-        mock_connection.close.assert_called_once()
+        # La connexion reste ouverte pour les publications suivantes
+        self.assertTrue(connections[0].is_open)
+
+    @patch('processing.pika.SelectConnection')
+    def test_publish_batch_waits_once_for_confirms(self, mock_connection):
+        connections = fake_connections(mock_connection)
+
+        publish_to_queue(1, "a", {})
+        publish_batch([(2, "b", {}), (3, "c", {}), (4, "d", {})])
+
+        mock_connection.assert_called_once()
+        channel = connections[0].channel_obj
+        self.assertEqual(len(channel.published), 4)
+        # Lot publié d'un trait puis un seul accusé (multiple) : pas d'aller-retour par message
+        self.assertEqual(channel.acks, [1, 4])
+
+    @patch('processing.time.sleep')
+    @patch('processing.pika.SelectConnection')
+    def test_publish_batch_resumes_after_reconnect(self, mock_connection, mock_sleep):
+        connections = fake_connections(mock_connection, lost_at=[2, None])
+
+        sent = publish_batch([(1, "a", {}), (2, "b", {}), (3, "c", {})])
+
+        self.assertEqual(sent, 3)
+        self.assertEqual(mock_connection.call_count, 2)
+        # Seuls les messages non confirmés sont republiés sur la nouvelle connexion
+        bodies = [json.loads(body)["doc_id"] for _, body, _ in connections[1].channel_obj.published]
+        self.assertEqual(bodies, [2, 3])
+
+    @patch('processing.time.sleep')
+    @patch('processing.pika.SelectConnection')
+    def test_publish_fails_after_retries(self, mock_connection, mock_sleep):
+        fake_connections(mock_connection, refused=True)
+        processing._publisher = processing.RabbitPublisher(retries=2)
+
+        with self.assertRaises(pika.exceptions.AMQPConnectionError):
+            publish_to_queue(1, "a", {})
+        self.assertEqual(mock_connection.call_count, 2)
+
+    def test_copy_with_hash(self):
+        data = b"%PDF" + os.urandom(3 * 1024 * 1024)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "doc.pdf")
+            digest = copy_with_hash(io.BytesIO(data), path)
+            with open(path, 'rb') as f:
+                self.assertEqual(f.read(), data)
+        self.assertEqual(digest, hashlib.sha256(data).hexdigest())
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,109 @@
+import re
+import time
+import threading
+import unicodedata
+from collections import OrderedDict
+import numpy as np
+
+
+def normalize_question(question):
+    """Clé de cache : casse, espaces et ponctuation finale ne distinguent pas deux questions"""
+    text = unicodedata.normalize("NFKC", question).lower()
+    text = re.sub(r"\s+", " ", text).strip()
+    return text.rstrip(" ?!.;:")
+
+
+class AnswerCache:
+    """Cache LRU + TTL des réponses du RAG.
+
+    Les entrées sont liées à une version de l'index : dès qu'une version plus récente est vue,
+    le cache est vidé. Si un seuil de similarité est fourni, une question différente mais dont
+    l'embedding est assez proche (cosinus) d'une question en cache est aussi un hit.
+    """
+
+    def __init__(self, max_size=256, ttl=3600, similarity_threshold=0.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.similarity_threshold = similarity_threshold
+        self._entries = OrderedDict() # clé -> (expiration, embedding normalisé ou None, valeur)
+        self._version = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def _sync_version(self, version):
+        # Appelé sous verrou. Retourne False si la version demandée est déjà périmée.
+        if self._version is None or version > self._version:
+            if self._entries:
+                self.invalidations += 1
+            self._entries.clear()
+            self._version = version
+        return version == self._version
+
+    def _unit(self, embedding):
+        if embedding is None:
+            return None
+        vector = np.asarray(embedding, dtype='float32')
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else None
+
+    def get(self, question, version, embedding=None):
+        key = normalize_question(question)
+        now = time.monotonic()
+        with self._lock:
+            if not self._sync_version(version):
+                self.misses += 1
+                return None
+
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] <= now:
+                del self._entries[key]
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[2]
+
+            query = self._unit(embedding) if self.similarity_threshold > 0 else None
+            if query is not None:
+                best_key, best_score = None, self.similarity_threshold
+                for other_key, (expires, vector, _) in self._entries.items():
+                    if vector is None or expires <= now:
+                        continue
+                    score = float(np.dot(query, vector))
+                    if score >= best_score:
+                        best_key, best_score = other_key, score
+                if best_key is not None:
+                    self._entries.move_to_end(best_key)
+                    self.hits += 1
+                    self.semantic_hits += 1
+                    return self._entries[best_key][2]
+
+            self.misses += 1
+            return None
+
+    def put(self, question, version, value, embedding=None):
+        key = normalize_question(question)
+        with self._lock:
+            # Réponse calculée sur un index déjà remplacé : on ne la garde pas
+            if not self._sync_version(version):
+                return
+            self._entries[key] = (time.monotonic() + self.ttl, self._unit(embedding), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "semantic_hits": self.semantic_hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+                "invalidations": self.invalidations,
+                "index_version": self._version,
+            }
@@ -1,62 +1,176 @@
 import os
-import pickle
-import faiss
+import sys
+import json
+import time
+import asyncio
+import threading
+from functools import lru_cache
+from contextlib import asynccontextmanager
+import numpy as np
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 
 # --- CHANGEMENT CLÉ : On importe ChatOllama au lieu de ChatOpenAI ---
 from langchain_community.chat_models import ChatOllama 
 
-from langchain.chains import RetrievalQA
 from langchain_community.vectorstores import FAISS
 from langchain_community.embeddings import HuggingFaceEmbeddings
 from langchain.prompts import PromptTemplate
-from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.docstore.base import Docstore
 from langchain_community.docstore.document import Document
 
 app = FastAPI(title="Health LLM Assistant (Local Version)")
 
 # Chemins vers les fichiers créés par l'indexeur
-FAISS_PATH = "../semantic-indexer/vector_store.faiss"
-META_PATH = "../semantic-indexer/metadata_store.pkl"
+INDEXER_DIR = "../semantic-indexer"
+FAISS_PATH = f"{INDEXER_DIR}/vector_store.faiss"
+META_PATH = f"{INDEXER_DIR}/metadata_store.db"
+LOG_PATH = f"{INDEXER_DIR}/vector_store.log"
+BM25_PATH = f"{INDEXER_DIR}/bm25_index.pkl"
+RAW_VECTORS_PATH = f"{INDEXER_DIR}/vector_store.f32"
+
+# Le format de stockage (checkpoint + journal de deltas) est défini par l'indexeur
+sys.path.insert(0, INDEXER_DIR)
+from persistence import load_state, read_deltas, collect_deltas, open_raw_vectors
+from index_factory import configure_search, index_type_of, rerank, QUANTIZED_TYPES
+from bm25 import load_bm25, reciprocal_rank_fusion
+from metadata_db import deleted_ids
+from metadata_filter import exclusion_parameters
+from answer_cache import AnswerCache
+
+# Période (s) de vérification des nouvelles versions de l'index (0 = rechargement désactivé)
+INDEX_RELOAD_INTERVAL = float(os.getenv("INDEX_RELOAD_INTERVAL", "5"))
+# Checkpoint FAISS mappé en lecture seule plutôt que copié en RAM (sauf le graphe HNSW) : seules les pages
+# parcourues par les recherches sont lues ; les deltas du journal restent en mémoire (LayeredIndex)
+INDEX_MMAP = os.getenv("INDEX_MMAP", "true").lower() in ("1", "true", "yes")
+# Nombre d'extraits injectés dans le prompt, et taille du cache LRU des embeddings de questions
+RETRIEVAL_K = int(os.getenv("RETRIEVAL_K", "3"))
+QUERY_EMBED_CACHE_SIZE = int(os.getenv("QUERY_EMBED_CACHE_SIZE", "1024"))
+# Recherche "dense" (FAISS seul) ou "hybrid" : FAISS + BM25 fusionnés par rang (RRF),
+# utile pour les noms latins de plantes et de syndromes mal rendus par les embeddings
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "dense")
+# Candidats retenus par chaque moteur avant la fusion
+HYBRID_CANDIDATES = int(os.getenv("HYBRID_CANDIDATES", "20"))
+# Index quantifié (sq8, fp16, ivf_pq) : candidats relus en pleine précision pour le reclassement (0 = désactivé)
+RERANK_CANDIDATES = int(os.getenv("RERANK_CANDIDATES", "30"))
 
 print("1. Chargement du modèle d'embedding...")
 # On garde le même modèle d'embedding que l'indexeur (HuggingFace)
 embeddings = HuggingFaceEmbeddings(model_name="all-MiniLM-L6-v2")
 
-print("2. Reconstruction de la base vectorielle...")
-vector_store = None
+def checkpoint_signature():
+    """Identifie la version du checkpoint (remplacé en entier à chaque compaction)"""
+    st = os.stat(FAISS_PATH)
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
 
-try:
-    if not os.path.exists(FAISS_PATH):
-        raise FileNotFoundError(f"Fichier introuvable: {FAISS_PATH}")
-    
-    # Lecture manuelle des fichiers de l'indexeur
-    raw_index = faiss.read_index(FAISS_PATH)
-    
-    with open(META_PATH, "rb") as f:
-        metadata_store = pickle.load(f)
-    
-    # Reconstruction du lien Index <-> Texte pour LangChain
-    docstore = InMemoryDocstore({})
-    index_to_docstore_id = {}
-    
-    for i, meta in enumerate(metadata_store):
-        doc_id = str(i)
-        doc = Document(
+def log_size():
+    return os.path.getsize(LOG_PATH) if os.path.exists(LOG_PATH) else 0
+
+class LazyDocstore(Docstore):
+    """Docstore LangChain adossé aux métadonnées de l'indexeur.
+
+    Le Document n'est construit (et le texte décodé) que pour les positions renvoyées par FAISS.
+    """
+
+    def __init__(self, metadata, bm25=None, raw_vectors=None, deleted=None, search_params=None):
+        self.metadata = metadata
+        self.bm25 = bm25 # Index lexical aligné sur les positions FAISS (mode hybrid)
+        self.raw_vectors = raw_vectors # Vecteurs pleine précision (memmap), si l'index est quantifié
+        # Documents supprimés : vecteurs encore dans l'index, écartés pendant la recherche FAISS
+        # (search_params) et du classement BM25. Relus au rechargement qui suit chaque suppression.
+        self.deleted = deleted if deleted is not None else np.empty(0, dtype='int64')
+        self.search_params = search_params
+
+    def search(self, search):
+        meta = self.metadata[int(search)]
+        if meta is None:
+            # Convention Docstore : une chaîne quand l'id est introuvable (document supprimé)
+            return f"ID {search} supprimé."
+        return Document(
             page_content=meta["text_content"],
             metadata={"source": meta["source"], "original_id": meta["doc_id"]}
         )
-        docstore.add({doc_id: doc})
-        index_to_docstore_id[i] = doc_id
-        
-    vector_store = FAISS(
+
+class PositionIds(dict):
+    """index_to_docstore_id sans dictionnaire de N entrées : l'id docstore est la position FAISS"""
+
+    def __missing__(self, i):
+        return str(i)
+
+def load_vector_store():
+    """Chargement complet : checkpoint + journal. Retourne (vector_store, signature, offset du journal)"""
+    if not os.path.exists(FAISS_PATH):
+        raise FileNotFoundError(f"Fichier introuvable: {FAISS_PATH}")
+
+    # Version relevée avant lecture : au pire un delta déjà chargé est relu puis ignoré
+    signature, offset = checkpoint_signature(), log_size()
+
+    # Lecture du checkpoint de l'indexeur + rejeu des deltas non encore compactés
+    raw_index, metadata_store, _ = load_state(FAISS_PATH, META_PATH, LOG_PATH, use_mmap=INDEX_MMAP, readonly=True)
+    # nprobe / efSearch si l'indexeur a construit un index approximatif (IVF, HNSW)
+    configure_search(raw_index)
+    raw_vectors = None
+    if RERANK_CANDIDATES > 0 and index_type_of(raw_index) in QUANTIZED_TYPES:
+        raw_vectors = open_raw_vectors(RAW_VECTORS_PATH, raw_index.d)
+    deleted = deleted_ids(metadata_store)
+
+    store = FAISS(
         embedding_function=embeddings,
         index=raw_index,
-        docstore=docstore,
-        index_to_docstore_id=index_to_docstore_id
+        docstore=LazyDocstore(
+            metadata_store,
+            load_bm25(BM25_PATH, metadata_store) if RETRIEVAL_MODE == "hybrid" else None,
+            raw_vectors,
+            deleted,
+            exclusion_parameters(raw_index, deleted)
+        ),
+        index_to_docstore_id=PositionIds()
+    )
+    return store, signature, offset
+
+def load_vector_store_delta(store, offset):
+    """Applique uniquement les deltas ajoutés au journal depuis offset.
+
+    Les requêtes en cours continuent sur l'ancien index : le nouveau partage son checkpoint et n'y ajoute
+    que les vecteurs du journal (LayeredIndex.extended, sans copie de l'index). Les métadonnées et le BM25
+    (partagés) ne reçoivent que de nouvelles positions, invisibles pour l'ancien index.
+    """
+    deltas = list(read_deltas(LOG_PATH, offset))
+    if not deltas:
+        return store, offset
+
+    start = store.index.ntotal
+    batch = collect_deltas(start, deltas)
+    if batch is None:
+        raise RuntimeError(f"Trou dans le journal après l'id {start}")
+    vectors, records = batch
+    new_index = store.index.extended(vectors)
+    # Index construit avant de toucher aux structures partagées ; après un échec à mi-chemin,
+    # seules les positions qui leur manquent encore sont ajoutées (pas de décalage au nouvel essai)
+    store.docstore.metadata.extend(records[len(store.docstore.metadata) - start:])
+    if store.docstore.bm25 is not None:
+        store.docstore.bm25.add(record["text_content"] for record in records[len(store.docstore.bm25) - start:])
+    if store.docstore.raw_vectors is not None:
+        # L'indexeur a ajouté les lignes des nouveaux vecteurs : nouveau mapping, plus long
+        store.docstore.raw_vectors = open_raw_vectors(RAW_VECTORS_PATH, new_index.d)
+
+    new_store = FAISS(
+        embedding_function=embeddings,
+        index=new_index,
+        docstore=store.docstore,
+        index_to_docstore_id=store.index_to_docstore_id
     )
-    print(f"✅ Base locale chargée avec succès ! ({raw_index.ntotal} documents)")
+    return new_store, deltas[-1]["end_offset"]
+
+print("2. Reconstruction de la base vectorielle...")
+vector_store = None
+# Version de l'index servie : incrémentée à chaque rechargement
+index_version = {"generation": 0, "checkpoint": None, "log_offset": 0}
+
+try:
+    vector_store, index_version["checkpoint"], index_version["log_offset"] = load_vector_store()
+    print(f"✅ Base locale chargée avec succès ! ({vector_store.index.ntotal} documents)")
 
 except Exception as e:
     print(f"❌ ERREUR : Impossible de charger l'index. Détails: {e}")
@@ -67,6 +181,20 @@ OLLAMA_BASE_URL = os.getenv("OLLAMA_BASE_URL", "http://localhost:11434")
 
 print(f"3. Connexion au LLM Local (Ollama) sur {OLLAMA_BASE_URL}...")
 llm = ChatOllama(model="mistral", base_url=OLLAMA_BASE_URL, temperature=0)
+
+# Nombre de questions traitées simultanément (recherche + génération), et taille max de la file
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "4"))
+LLM_MAX_QUEUE = int(os.getenv("LLM_MAX_QUEUE", "32"))
+LLM_QUEUE_TIMEOUT = float(os.getenv("LLM_QUEUE_TIMEOUT", "120"))
+llm_slots = asyncio.Semaphore(LLM_MAX_CONCURRENCY)
+llm_load = {"active": 0, "waiting": 0}
+
+# Cache des réponses : clé = question normalisée, vidé à chaque nouvelle génération de l'index
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "256"))
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", "3600"))
+# Seuil de similarité cosinus entre questions pour un hit "sémantique" (0 = question identique uniquement)
+ANSWER_CACHE_SIMILARITY = float(os.getenv("ANSWER_CACHE_SIMILARITY", "0"))
+answer_cache = AnswerCache(ANSWER_CACHE_SIZE, ANSWER_CACHE_TTL, ANSWER_CACHE_SIMILARITY)
 # Le Prompt (Consignes données à l'IA)
 template = """
 Tu es un Expert en Pharmacopée Chinoise (MTC).
@@ -93,34 +221,237 @@ RÉPONSE EXPERT :
 """
 QA_CHAIN_PROMPT = PromptTemplate(input_variables=["context", "question"], template=template)
 
-# Création de la chaîne RAG
-if vector_store:
-    qa_chain = RetrievalQA.from_chain_type(
-        llm=llm,
-        chain_type="stuff",
-        retriever=vector_store.as_retriever(search_kwargs={"k": 3}),
-        return_source_documents=True,
-        chain_type_kwargs={"prompt": QA_CHAIN_PROMPT}
+# --- RECHERCHE DIRECTE (sans les wrappers LangChain par appel) ---
+@lru_cache(maxsize=QUERY_EMBED_CACHE_SIZE)
+def _embed_query(question):
+    vector = np.asarray(embeddings.embed_query(question), dtype='float32')
+    vector.setflags(write=False) # Partagé entre requêtes via le cache
+    return vector
+
+def embed_query(question):
+    """Embedding de la question, mis en cache (questions répétées ou issues de modèles de l'UI)"""
+    return _embed_query(question.strip())
+
+_search_buffers = threading.local()
+
+def search_buffers(dimension, k):
+    """Tampons numpy (requête, distances, ids) réutilisés d'une recherche à l'autre, un jeu par thread"""
+    buffers = getattr(_search_buffers, "value", None)
+    if buffers is None or buffers[0].shape[1] != dimension or buffers[2].shape[1] != k:
+        buffers = (
+            np.empty((1, dimension), dtype='float32'),
+            np.empty((1, k), dtype='float32'),
+            np.empty((1, k), dtype='int64')
+        )
+        _search_buffers.value = buffers
+    return buffers
+
+def retrieve(store, question, k=RETRIEVAL_K):
+    """Embedding + recherche FAISS (+ reclassement, + BM25 en mode hybrid) + lecture des k extraits.
+
+    Retourne (documents, durées en ms).
+    """
+    timings = {}
+    start = time.perf_counter()
+    vector = embed_query(question)
+    timings["embedding_ms"] = round((time.perf_counter() - start) * 1000, 2)
+
+    start = time.perf_counter()
+    bm25, raw_vectors = store.docstore.bm25, store.docstore.raw_vectors
+    candidates = max(k, HYBRID_CANDIDATES) if bm25 is not None else k
+    # Index quantifié : on élargit la recherche, puis on reclasse en pleine précision
+    depth = max(candidates, RERANK_CANDIDATES) if raw_vectors is not None else candidates
+    query, distances, labels = search_buffers(store.index.d, depth)
+    query[0] = vector
+    store.index.search(query, depth, D=distances, I=labels, params=store.docstore.search_params)
+    ids = [i for i in labels[0] if i != -1]
+    if raw_vectors is not None:
+        ids = rerank(raw_vectors, vector, ids, candidates)
+    if bm25 is not None:
+        # Positions au-delà de ntotal : textes déjà ajoutés au BM25 partagé mais pas à cet index
+        lexical, _ = bm25.search(question, candidates, limit=store.index.ntotal)
+        # BM25 sauvegardé avant une suppression (crash entre les deux checkpoints) : ids encore présents
+        lexical = lexical[~np.isin(lexical, store.docstore.deleted)]
+        ids = reciprocal_rank_fusion([ids, lexical], k)
+    docs = [doc for doc in (store.docstore.search(str(i)) for i in ids) if isinstance(doc, Document)]
+    timings["search_ms"] = round((time.perf_counter() - start) * 1000, 2)
+    return docs, timings
+
+def build_prompt(docs, question):
+    # Même mise en forme que la chaîne "stuff" : les extraits sont concaténés dans {context}
+    return QA_CHAIN_PROMPT.format(
+        context="\n\n".join(doc.page_content for doc in docs),
+        question=question
     )
-else:
-    qa_chain = None
+
+# Durées cumulées par étape, pour /health
+latency_totals = {"requests": 0, "embedding_ms": 0.0, "search_ms": 0.0, "generation_ms": 0.0}
+
+def record_timings(timings):
+    latency_totals["requests"] += 1
+    for step in ("embedding_ms", "search_ms", "generation_ms"):
+        latency_totals[step] += timings.get(step, 0.0)
+
+def reload_index():
+    """Détecte une nouvelle version de l'index et la charge (delta seul si possible)"""
+    global vector_store
+    if not os.path.exists(FAISS_PATH):
+        return False
+
+    size = log_size()
+    if (vector_store is None or checkpoint_signature() != index_version["checkpoint"]
+            or size < index_version["log_offset"]):
+        # Compaction côté indexeur (ou premier chargement) : rechargement complet
+        store, index_version["checkpoint"], offset = load_vector_store()
+    elif size > index_version["log_offset"]:
+        store, offset = load_vector_store_delta(vector_store, index_version["log_offset"])
+    else:
+        return False
+
+    # Remplacement atomique : les requêtes en cours gardent leur référence à l'ancien index
+    vector_store = store
+    index_version["log_offset"] = offset
+    index_version["generation"] += 1
+    print(f"🔄 Index rechargé (génération {index_version['generation']}, {store.index.ntotal} documents)")
+    return True
+
+def watch_index():
+    while True:
+        time.sleep(INDEX_RELOAD_INTERVAL)
+        try:
+            reload_index()
+        except Exception as e:
+            print(f"❌ ERREUR rechargement de l'index : {e}")
+
+if INDEX_RELOAD_INTERVAL > 0:
+    threading.Thread(target=watch_index, name="index-watcher", daemon=True).start()
 
 class Query(BaseModel):
     question: str
 
+def check_llm_queue():
+    """Rejette tout de suite (503) si la file d'attente est pleine, plutôt que de laisser la latence exploser"""
+    if llm_load["waiting"] >= LLM_MAX_QUEUE:
+        raise HTTPException(status_code=503, detail="Service saturé, réessayez dans quelques instants.")
+
+async def cache_lookup(question, version):
+    """Retourne (réponse en cache ou None, embedding de la question si le mode sémantique est actif)"""
+    embedding = None
+    if ANSWER_CACHE_SIMILARITY > 0:
+        embedding = await asyncio.to_thread(embed_query, question)
+    return answer_cache.get(question, version, embedding), embedding
+
+@asynccontextmanager
+async def llm_slot():
+    """Attend une place parmi LLM_MAX_CONCURRENCY (au plus LLM_QUEUE_TIMEOUT secondes)"""
+    if llm_slots.locked():
+        check_llm_queue()
+        llm_load["waiting"] += 1
+        try:
+            await asyncio.wait_for(llm_slots.acquire(), LLM_QUEUE_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise HTTPException(status_code=503, detail="Délai d'attente du LLM dépassé.")
+        finally:
+            llm_load["waiting"] -= 1
+    else:
+        # Place libre : acquisition immédiate, sans passer par la file
+        await llm_slots.acquire()
+
+    llm_load["active"] += 1
+    try:
+        yield
+    finally:
+        llm_load["active"] -= 1
+        llm_slots.release()
+
 @app.post("/ask/")
 async def ask_question(query: Query):
-    if not qa_chain:
+    # Version lue avant l'index : au pire une réponse du nouvel index est rangée sous l'ancienne version
+    version = index_version["generation"]
+    # Référence locale : un rechargement pendant l'appel n'affecte pas cette requête
+    store = vector_store
+    if not store:
         raise HTTPException(status_code=503, detail="Index non chargé.")
+
+    cached, embedding = await cache_lookup(query.question, version)
+    if cached:
+        return {**cached, "cached": True}
     
-    # L'appel peut prendre quelques secondes en local
-    result = qa_chain.invoke({"query": query.question})
+    # L'appel peut prendre quelques secondes en local : chemin asynchrone (aiohttp vers Ollama,
+    # embedding + FAISS dans un thread) pour ne pas bloquer la boucle ni /health
+    async with llm_slot():
+        docs, timings = await asyncio.to_thread(retrieve, store, query.question)
+        start = time.perf_counter()
+        message = await llm.ainvoke(build_prompt(docs, query.question))
+        timings["generation_ms"] = round((time.perf_counter() - start) * 1000, 2)
+    record_timings(timings)
     
-    return {
-        "answer": result["result"],
-        "sources": [doc.metadata.get("source") for doc in result["source_documents"]]
+    response = {
+        "answer": message.content,
+        "sources": [doc.metadata.get("source") for doc in docs]
     }
+    answer_cache.put(query.question, version, response, embedding)
+    return {**response, "cached": False, "timings": timings}
+
+async def stream_answer(store, question, version):
+    """Générateur NDJSON : d'abord les sources retrouvées, puis les tokens au fil de la génération"""
+    try:
+        cached, embedding = await cache_lookup(question, version)
+        if cached:
+            # Réponse déjà connue : envoyée d'un bloc, sans passer par la file du LLM
+            yield json.dumps({"type": "sources", "sources": cached["sources"], "cached": True}) + "\n"
+            yield json.dumps({"type": "token", "content": cached["answer"]}) + "\n"
+            yield json.dumps({"type": "done"}) + "\n"
+            return
+
+        async with llm_slot():
+            docs, timings = await asyncio.to_thread(retrieve, store, question)
+            sources = [doc.metadata.get("source") for doc in docs]
+            yield json.dumps({"type": "sources", "sources": sources}) + "\n"
+
+            start = time.perf_counter()
+            answer = ""
+            async for chunk in llm.astream(build_prompt(docs, question)):
+                if chunk.content:
+                    answer += chunk.content
+                    yield json.dumps({"type": "token", "content": chunk.content}) + "\n"
+            timings["generation_ms"] = round((time.perf_counter() - start) * 1000, 2)
+        record_timings(timings)
+        answer_cache.put(question, version, {"answer": answer, "sources": sources}, embedding)
+        yield json.dumps({"type": "done", "timings": timings}) + "\n"
+    except HTTPException as e:
+        yield json.dumps({"type": "error", "detail": e.detail}) + "\n"
+    except Exception as e:
+        # Les en-têtes sont déjà partis : l'erreur est transmise dans le flux
+        yield json.dumps({"type": "error", "detail": str(e)}) + "\n"
+
+@app.post("/ask/stream")
+async def ask_question_stream(query: Query):
+    version = index_version["generation"]
+    store = vector_store
+    if not store:
+        raise HTTPException(status_code=503, detail="Index non chargé.")
+    # File pleine : 503 immédiat, avant l'envoi des en-têtes du flux
+    check_llm_queue()
+
+    return StreamingResponse(stream_answer(store, query.question, version), media_type="application/x-ndjson")
 
 @app.get("/health")
 def health():
-    return {"status": "ok", "service": "llm-qa"}
+    return {
+        "status": "ok",
+        "service": "llm-qa",
+        "index_generation": index_version["generation"],
+        "retrieval_mode": RETRIEVAL_MODE,
+        "rerank": vector_store is not None and vector_store.docstore.raw_vectors is not None,
+        "documents": vector_store.index.ntotal if vector_store else 0,
+        "llm_active": llm_load["active"],
+        "llm_waiting": llm_load["waiting"],
+        "answer_cache": answer_cache.stats(),
+        "query_embedding_cache": _embed_query.cache_info()._asdict(),
+        # Temps moyen par étape (ms) sur les réponses générées
+        "avg_latency_ms": {
+            step: round(latency_totals[step] / latency_totals["requests"], 2) if latency_totals["requests"] else 0.0
+            for step in ("embedding_ms", "search_ms", "generation_ms")
+        }
+    }
@@ -0,0 +1,68 @@
+import unittest
+from unittest.mock import patch
+import sys
+import os
+
+# Add parent directory to path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from answer_cache import AnswerCache, normalize_question
+
+ANSWER = {"answer": "1. Ginseng (Score 10, Empereur)", "sources": ["matrice_plante_syndrome.csv"]}
+
+
+class TestAnswerCache(unittest.TestCase):
+
+    def test_normalize_question(self):
+        self.assertEqual(normalize_question("  Quelle plante   pour le Vide de Qi ?"), "quelle plante pour le vide de qi")
+
+    def test_hit_on_normalized_question(self):
+        cache = AnswerCache()
+        cache.put("Quelle plante ?", 1, ANSWER)
+
+        self.assertEqual(cache.get("quelle   PLANTE", 1), ANSWER)
+        self.assertIsNone(cache.get("autre question", 1))
+        self.assertEqual(cache.stats()["hits"], 1)
+        self.assertEqual(cache.stats()["misses"], 1)
+
+    def test_new_index_version_invalidates(self):
+        cache = AnswerCache()
+        cache.put("Quelle plante ?", 1, ANSWER)
+
+        self.assertIsNone(cache.get("Quelle plante ?", 2))
+        # Réponse calculée sur l'ancien index : ignorée
+        cache.put("Quelle plante ?", 1, ANSWER)
+        self.assertIsNone(cache.get("Quelle plante ?", 2))
+        self.assertEqual(cache.stats()["invalidations"], 1)
+
+    def test_lru_eviction(self):
+        cache = AnswerCache(max_size=2)
+        cache.put("q1", 0, ANSWER)
+        cache.put("q2", 0, ANSWER)
+        cache.get("q1", 0)
+        cache.put("q3", 0, ANSWER)
+
+        self.assertIsNotNone(cache.get("q1", 0))
+        self.assertIsNone(cache.get("q2", 0))
+
+    @patch('answer_cache.time.monotonic')
+    def test_ttl_expiration(self, mock_monotonic):
+        cache = AnswerCache(ttl=10)
+        mock_monotonic.return_value = 100
+        cache.put("q1", 0, ANSWER)
+
+        mock_monotonic.return_value = 109
+        self.assertIsNotNone(cache.get("q1", 0))
+        mock_monotonic.return_value = 111
+        self.assertIsNone(cache.get("q1", 0))
+
+    def test_semantic_hit_above_threshold(self):
+        cache = AnswerCache(similarity_threshold=0.95)
+        cache.put("Quelle plante pour le Vide de Qi ?", 0, ANSWER, embedding=[1.0, 0.0, 0.0])
+
+        self.assertEqual(cache.get("Plante recommandée : Vide de Qi", 0, embedding=[0.99, 0.05, 0.0]), ANSWER)
+        self.assertIsNone(cache.get("Posologie du Ginseng", 0, embedding=[0.0, 1.0, 0.0]))
+        self.assertEqual(cache.stats()["semantic_hits"], 1)
+
+if __name__ == '__main__':
+    unittest.main()
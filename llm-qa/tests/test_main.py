@@ -0,0 +1,207 @@
+import unittest
+from unittest.mock import patch
+import sys
+import os
+import json
+import asyncio
+import tempfile
+from types import SimpleNamespace
+import numpy as np
+
+# Add parent directory to path (et les modules de l'indexeur, comme le fait main.py)
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', 'semantic-indexer')))
+
+# Pas de thread de rechargement, ni de modèle d'embedding ou de connexion Ollama à l'import
+os.environ["INDEX_RELOAD_INTERVAL"] = "0"
+with patch('langchain_community.embeddings.HuggingFaceEmbeddings'), patch('langchain_community.chat_models.ChatOllama'):
+    import main
+
+from fastapi.testclient import TestClient
+from langchain_community.vectorstores import FAISS
+from langchain_community.docstore.document import Document
+from answer_cache import AnswerCache
+import index_factory
+import persistence
+import metadata_filter
+from index_factory import LayeredIndex
+from persistence import append_delta
+from bm25 import BM25Index
+from metadata_db import MetadataStore
+
+# Vrai faiss, même si les tests de l'indexeur (lancés dans la même session) ont remplacé le module par un mock
+faiss = index_factory.faiss
+
+# Ordre "dense" pour une requête en (0, 0) : 0, 1, 2, 3 ; seul le dernier texte contient "Astragalus"
+VECTORS = np.array([[0, 0], [1, 0], [2, 0], [3, 0]], dtype='float32')
+RECORDS = [
+    {"doc_id": str(i), "text_content": text, "source": f"src{i}", "type": "knowledge_base"}
+    for i, text in enumerate(["Vide de Qi.", "Vide de Yin.", "Vide de Yang.", "Astragalus membranaceus."])
+]
+
+
+def bm25_of(records):
+    bm25 = BM25Index()
+    bm25.add(record["text_content"] for record in records)
+    return bm25
+
+
+def make_store(count, bm25=None):
+    base = faiss.IndexFlatL2(2)
+    base.add(VECTORS[:count])
+    return FAISS(
+        embedding_function=main.embeddings,
+        index=LayeredIndex(base),
+        docstore=main.LazyDocstore(RECORDS[:count], bm25),
+        index_to_docstore_id=main.PositionIds()
+    )
+
+
+def contents(docs):
+    return [doc.page_content for doc in docs]
+
+
+class TestRetrieval(unittest.TestCase):
+
+    def setUp(self):
+        main._embed_query.cache_clear()
+        main.embeddings.embed_query.return_value = [0.0, 0.0]
+
+    def test_hybrid_fuses_dense_and_lexical_ranks(self):
+        store = make_store(4, bm25_of(RECORDS))
+
+        docs, _ = main.retrieve(store, "Astragalus", k=3)
+
+        # Dernier en dense, premier en BM25 : en tête après la fusion (RRF), puis l'ordre dense
+        self.assertEqual(contents(docs), [RECORDS[i]["text_content"] for i in (3, 0, 1)])
+
+    def test_hybrid_with_empty_bm25(self):
+        docs, _ = main.retrieve(make_store(4, BM25Index()), "Astragalus", k=3)
+        self.assertEqual(contents(docs), [RECORDS[i]["text_content"] for i in (0, 1, 2)])
+
+    def test_delta_reload_appends_to_layer(self):
+        store = make_store(2, bm25_of(RECORDS[:2]))
+        with tempfile.TemporaryDirectory() as tmp, patch.object(main, "LOG_PATH", os.path.join(tmp, "vector_store.log")):
+            append_delta(main.LOG_PATH, 2, VECTORS[2:], RECORDS[2:])
+
+            new_store, offset = main.load_vector_store_delta(store, 0)
+            # Nouvel essai après un échec avant le remplacement (structures partagées déjà complétées)
+            main.load_vector_store_delta(store, 0)
+
+            self.assertEqual(offset, os.path.getsize(main.LOG_PATH))
+        # Checkpoint partagé, l'ancien index ne voit pas les nouveaux vecteurs
+        self.assertIs(new_store.index.base, store.index.base)
+        self.assertEqual((store.index.ntotal, new_store.index.ntotal), (2, 4))
+        self.assertEqual(store.docstore.metadata, RECORDS)
+        self.assertEqual(len(store.docstore.bm25), 4)
+        docs, _ = main.retrieve(new_store, "Astragalus", k=1)
+        self.assertEqual(contents(docs), [RECORDS[3]["text_content"]])
+
+    def test_reload_after_delete(self):
+        with tempfile.TemporaryDirectory() as tmp, \
+                patch.multiple(main, FAISS_PATH=os.path.join(tmp, "vector_store.faiss"),
+                               META_PATH=os.path.join(tmp, "metadata_store.db"), LOG_PATH=os.path.join(tmp, "vector_store.log"),
+                               BM25_PATH=os.path.join(tmp, "bm25_index.pkl"), RETRIEVAL_MODE="hybrid", vector_store=None), \
+                patch.dict(main.index_version, {"generation": 0, "checkpoint": None, "log_offset": 0}), \
+                patch.object(persistence, "faiss", faiss), patch.object(metadata_filter, "faiss", faiss):
+            base = faiss.IndexFlatL2(2)
+            base.add(VECTORS)
+            faiss.write_index(base, main.FAISS_PATH)
+            writer = MetadataStore(main.META_PATH)
+            writer.extend(RECORDS)
+            writer.checkpoint()
+
+            self.assertTrue(main.reload_index())
+            docs, _ = main.retrieve(main.vector_store, "Astragalus", k=3)
+            self.assertEqual(contents(docs)[0], RECORDS[3]["text_content"])
+
+            # Suppression côté indexeur : métadonnées marquées, nouveau checkpoint de l'index
+            writer.delete([3])
+            writer.checkpoint()
+            writer.close()
+            faiss.write_index(base, main.FAISS_PATH + ".tmp")
+            os.replace(main.FAISS_PATH + ".tmp", main.FAISS_PATH)
+
+            self.assertTrue(main.reload_index())
+            docs, _ = main.retrieve(main.vector_store, "Astragalus", k=4)
+            # Écarté de la recherche FAISS comme du BM25
+            self.assertEqual(contents(docs), [RECORDS[i]["text_content"] for i in (0, 1, 2)])
+            self.assertEqual(main.index_version["generation"], 2)
+
+
+class StubLLM:
+    """LLM factice : astream renvoie les morceaux donnés, puis lève error s'il y en a une"""
+
+    def __init__(self, chunks, error=None):
+        self.chunks, self.error = chunks, error
+
+    async def astream(self, prompt):
+        for chunk in self.chunks:
+            yield SimpleNamespace(content=chunk)
+        if self.error is not None:
+            raise self.error
+
+
+def stream_records(response):
+    return [json.loads(line) for line in response.text.splitlines()]
+
+
+class TestAskEndpoints(unittest.TestCase):
+
+    def setUp(self):
+        docs = [Document(page_content="Vide de Qi.", metadata={"source": "matrice.csv"})]
+        self.patches = [
+            patch.object(main, "vector_store", make_store(4)),
+            patch.object(main, "answer_cache", AnswerCache()),
+            patch.object(main, "retrieve", lambda store, question: (docs, {"search_ms": 0.1})),
+        ]
+        for p in self.patches:
+            p.start()
+        self.client = TestClient(main.app)
+
+    def tearDown(self):
+        for p in reversed(self.patches):
+            p.stop()
+
+    def test_queue_full_returns_503(self):
+        with patch.dict(main.llm_load, {"waiting": main.LLM_MAX_QUEUE}):
+            # Flux : refusé avant l'envoi des en-têtes
+            self.assertEqual(self.client.post("/ask/stream", json={"question": "Vide de Qi ?"}).status_code, 503)
+            # Toutes les places occupées : pas de mise en file
+            with patch.object(main, "llm_slots", asyncio.Semaphore(0)):
+                self.assertEqual(self.client.post("/ask/", json={"question": "Vide de Qi ?"}).status_code, 503)
+
+    def test_stream_ndjson_framing(self):
+        with patch.object(main, "llm", StubLLM(["1. Ginseng", "", " (Score 10)"])):
+            response = self.client.post("/ask/stream", json={"question": "Vide de Qi ?"})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.headers["content-type"].startswith("application/x-ndjson"))
+        self.assertTrue(response.text.endswith("\n"))
+        records = stream_records(response)
+        # Sources, un enregistrement par morceau non vide, puis fin
+        self.assertEqual([record["type"] for record in records], ["sources", "token", "token", "done"])
+        self.assertEqual(records[0]["sources"], ["matrice.csv"])
+        self.assertEqual("".join(record["content"] for record in records[1:3]), "1. Ginseng (Score 10)")
+
+        # Question répétée : réponse du cache, d'un bloc
+        with patch.object(main, "llm", StubLLM([], RuntimeError("LLM appelé"))):
+            records = stream_records(self.client.post("/ask/stream", json={"question": "vide de qi"}))
+        self.assertEqual([record["type"] for record in records], ["sources", "token", "done"])
+        self.assertTrue(records[0]["cached"])
+
+    def test_stream_error_record(self):
+        with patch.object(main, "llm", StubLLM(["1. Ginseng"], ConnectionError("Ollama injoignable"))):
+            response = self.client.post("/ask/stream", json={"question": "Vide de Qi ?"})
+
+        # En-têtes déjà envoyés : l'erreur est le dernier enregistrement du flux
+        self.assertEqual(response.status_code, 200)
+        records = stream_records(response)
+        self.assertEqual([record["type"] for record in records], ["sources", "token", "error"])
+        self.assertEqual(records[-1]["detail"], "Ollama injoignable")
+        # Réponse incomplète : pas mise en cache
+        self.assertEqual(main.answer_cache.stats()["size"], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,25 @@
+"""Compare le rappel et la latence des différents types d'index sur le store actuel.
+
+Usage : python benchmark_index.py [k]
+"""
+import sys
+from persistence import load_state
+from index_factory import build_index, evaluate_index, extract_vectors
+
+INDEX_FILE = "vector_store.faiss"
+METADATA_FILE = "metadata_store.db"
+LOG_FILE = "vector_store.log"
+
+if __name__ == "__main__":
+    k = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    index, _, _ = load_state(INDEX_FILE, METADATA_FILE, LOG_FILE, readonly=True)
+    vectors = extract_vectors(index)
+    print(f"{len(vectors)} vecteurs, rappel@{k} mesuré contre une recherche exacte\n")
+    print(f"{'type':<10} {'rappel':>8} {'ms/requête':>12} {'exact ms':>10}")
+    for index_type in ("flat", "ivf_flat", "hnsw", "ivf_pq", "sq8", "fp16"):
+        try:
+            report = evaluate_index(build_index(index_type, vectors), vectors, k=k)
+        except Exception as e:
+            print(f"{index_type:<10} erreur : {e}")
+            continue
+        print(f"{index_type:<10} {report['recall']:>8.3f} {report['latency_ms']:>12.3f} {report['flat_latency_ms']:>10.3f}")
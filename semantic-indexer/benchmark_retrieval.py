@@ -0,0 +1,81 @@
+"""Compare le rappel@k et la latence de la recherche dense (FAISS, k=3 comme llm-qa),
+lexicale (BM25) et hybride (fusion RRF) sur la base MTC du store actuel.
+
+Les requêtes sont construites à partir des extraits MTC : "<plante> pour <syndrome>" ;
+un extrait est pertinent s'il cite la même plante et le même syndrome.
+
+Usage : python benchmark_retrieval.py [nb_requêtes] [k]
+"""
+import re
+import sys
+import time
+import numpy as np
+from sentence_transformers import SentenceTransformer
+from persistence import load_state
+from bm25 import load_bm25, reciprocal_rank_fusion
+
+INDEX_FILE = "vector_store.faiss"
+METADATA_FILE = "metadata_store.db"
+LOG_FILE = "vector_store.log"
+BM25_FILE = "bm25_index.pkl"
+HYBRID_CANDIDATES = 20
+
+_SYNDROME = re.compile(r"Syndrome '([^']+)'")
+_PLANT = re.compile(r"Plante(?: recommandée)? : ([^.(]+)")
+
+
+def build_queries(metadata_store, nb_queries):
+    """(requête, ids pertinents) tirés au hasard parmi les extraits MTC citant une plante et un syndrome"""
+    pairs = {}
+    for i, record in enumerate(metadata_store):
+        if record is None:
+            continue
+        text = record["text_content"]
+        syndrome, plant = _SYNDROME.search(text), _PLANT.search(text)
+        if syndrome and plant and plant.group(1).strip():
+            pairs.setdefault((plant.group(1).strip(), syndrome.group(1).strip()), []).append(i)
+    keys = sorted(pairs)
+    rng = np.random.default_rng(0)
+    rows = rng.choice(len(keys), min(nb_queries, len(keys)), replace=False)
+    return [(f"{keys[r][0]} pour {keys[r][1]}", set(pairs[keys[r]])) for r in rows]
+
+
+def evaluate(name, search, queries, k):
+    hits, start = 0, time.perf_counter()
+    for n, (_, relevant) in enumerate(queries):
+        hits += bool(relevant & set(search(n)[:k]))
+    latency = (time.perf_counter() - start) * 1000 / len(queries)
+    print(f"{name:<22} {hits / len(queries):>8.3f} {latency:>12.3f}")
+
+
+if __name__ == "__main__":
+    nb_queries = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    k = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    index, metadata_store, _ = load_state(INDEX_FILE, METADATA_FILE, LOG_FILE, readonly=True)
+    bm25 = load_bm25(BM25_FILE, metadata_store)
+    queries = build_queries(metadata_store, nb_queries)
+    if not queries:
+        sys.exit("Aucun extrait MTC (plante + syndrome) dans le store.")
+
+    model = SentenceTransformer('all-MiniLM-L6-v2')
+    start = time.perf_counter()
+    vectors = np.asarray(model.encode([query for query, _ in queries]), dtype='float32')
+    embedding_ms = (time.perf_counter() - start) * 1000 / len(queries)
+
+    def dense(n, depth=k):
+        _, labels = index.search(vectors[n:n + 1], depth)
+        return [int(i) for i in labels[0] if i != -1]
+
+    def lexical(n, depth=k):
+        return bm25.search(queries[n][0], depth)[0].tolist()
+
+    def hybrid(n):
+        depth = max(k, HYBRID_CANDIDATES)
+        return reciprocal_rank_fusion([dense(n, depth), lexical(n, depth)], k)
+
+    print(f"{len(queries)} requêtes, {index.ntotal} extraits, rappel@{k} = part des requêtes avec un extrait pertinent")
+    print(f"embedding : {embedding_ms:.3f} ms/requête (commun à dense et hybride)\n")
+    print(f"{'mode':<22} {'rappel':>8} {'ms/requête':>12}")
+    evaluate(f"dense (k={k})", dense, queries, k)
+    evaluate("bm25", lexical, queries, k)
+    evaluate(f"hybride RRF ({HYBRID_CANDIDATES} cand.)", hybrid, queries, k)
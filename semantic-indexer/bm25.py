@@ -0,0 +1,163 @@
+import os
+import re
+import pickle
+import unicodedata
+from array import array
+import numpy as np
+
+# Paramètres BM25 classiques (saturation du tf, normalisation par la longueur du texte)
+BM25_K1 = float(os.getenv("BM25_K1", "1.2"))
+BM25_B = float(os.getenv("BM25_B", "0.75"))
+# Constante de la fusion par rang (Reciprocal Rank Fusion), 60 dans l'article d'origine
+RRF_K = int(os.getenv("RRF_K", "60"))
+
+_WORD = re.compile(r"\w+")
+# Mots outils français : présents partout, ils n'apportent rien au score
+STOPWORDS = frozenset(
+    "a au aux avec ce ces dans de des du en est et il la le les leur mais ne ou par pas pour qu que qui "
+    "sa se ses son sur un une".split()
+)
+
+
+def tokenize(text):
+    """Termes d'un texte : minuscules, sans accents (é -> e), mots outils et lettres isolées retirés"""
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return [word for word in _WORD.findall(text) if len(word) > 1 and word not in STOPWORDS]
+
+
+class BM25Index:
+    """Index inversé BM25, aligné sur les positions de l'index FAISS (id = position du vecteur).
+
+    Chaque terme a sa liste d'ids croissants et de fréquences (array compacts) : un ajout
+    ne touche que les termes du nouveau texte, une recherche que les listes des termes de la requête.
+    """
+
+    def __init__(self):
+        self.postings = {} # terme -> (array ids, array tf)
+        self.lengths = array('I') # Nombre de termes de chaque texte
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def add(self, texts):
+        """Indexe les textes suivants (ids len(self), len(self) + 1, ...)"""
+        for text in texts:
+            i = len(self.lengths)
+            terms = tokenize(text)
+            counts = {}
+            for term in terms:
+                counts[term] = counts.get(term, 0) + 1
+            for term, tf in counts.items():
+                ids, tfs = self.postings.setdefault(term, (array('I'), array('H')))
+                ids.append(i)
+                tfs.append(min(tf, 0xFFFF))
+            self.lengths.append(len(terms))
+
+    def truncate(self, n):
+        """Retire les textes d'id >= n (état plus récent que le checkpoint FAISS)"""
+        if n >= len(self):
+            return
+        index = BM25Index()
+        for term, (ids, tfs) in self.postings.items():
+            keep = np.searchsorted(np.array(ids), n)
+            if keep:
+                index.postings[term] = (ids[:keep], tfs[:keep])
+        index.lengths = self.lengths[:n]
+        self.__dict__.update(index.__dict__)
+
+    def remove(self, ids):
+        """Retire des textes (documents supprimés) : leurs termes disparaissent, les ids restent réservés"""
+        removed = np.unique(np.asarray(ids, dtype='int64'))
+        if len(removed) == 0:
+            return
+        for term, (term_ids, tfs) in list(self.postings.items()):
+            keep = ~np.isin(np.array(term_ids, dtype='int64'), removed)
+            if keep.all():
+                continue
+            if keep.any():
+                self.postings[term] = (array('I', np.array(term_ids)[keep]), array('H', np.array(tfs)[keep]))
+            else:
+                del self.postings[term]
+        for i in removed[removed < len(self.lengths)]:
+            self.lengths[i] = 0
+
+    def search(self, query, k, limit=None):
+        """Ids des k textes les mieux notés pour query, et leurs scores (tableaux triés par score décroissant).
+
+        limit : nombre de textes visibles (ntotal de l'index FAISS servi), les ids au-delà sont ignorés.
+        """
+        n = len(self.lengths) if limit is None else min(limit, len(self.lengths))
+        if n == 0:
+            return np.empty(0, dtype='int64'), np.empty(0, dtype='float32')
+        lengths = np.array(self.lengths[:n], dtype='float32')
+        avg_length = max(float(lengths.mean()), 1.0)
+        norm = BM25_K1 * (1 - BM25_B + BM25_B * lengths / avg_length)
+
+        scores = np.zeros(n, dtype='float32')
+        for term in set(tokenize(query)):
+            if term not in self.postings:
+                continue
+            ids, tfs = self.postings[term]
+            # Copies : un ajout concurrent (rechargement llm-qa) ne doit pas modifier les listes lues
+            ids, tfs = np.array(ids, dtype='int64'), np.array(tfs, dtype='float32')
+            size = min(len(ids), len(tfs))
+            ids, tfs = ids[:size], tfs[:size]
+            visible = ids < n
+            ids, tfs = ids[visible], tfs[visible]
+            if len(ids) == 0:
+                continue
+            idf = np.log(1 + (n - len(ids) + 0.5) / (len(ids) + 0.5))
+            scores[ids] += idf * tfs * (BM25_K1 + 1) / (tfs + norm[ids])
+
+        matched = np.flatnonzero(scores)
+        if len(matched) > k:
+            matched = matched[np.argpartition(-scores[matched], k - 1)[:k]]
+        order = matched[np.argsort(-scores[matched], kind='stable')]
+        return order, scores[order]
+
+    def save(self, path):
+        """Écriture atomique (fichier temporaire puis os.replace), comme le checkpoint FAISS"""
+        with open(path + ".tmp", 'wb') as f:
+            pickle.dump(self.__dict__, f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, path):
+        index = cls()
+        with open(path, 'rb') as f:
+            index.__dict__.update(pickle.load(f))
+        return index
+
+
+def load_bm25(path, metadata_store):
+    """Index BM25 du checkpoint, complété par les textes rejoués depuis le journal.
+
+    Reconstruit depuis les métadonnées si le fichier est absent (store antérieur au BM25) ou illisible.
+    """
+    bm25 = None
+    if os.path.exists(path):
+        try:
+            bm25 = BM25Index.load(path)
+        except Exception as e:
+            print(f"⚠️ Index BM25 illisible, reconstruction : {e}")
+    if bm25 is None:
+        bm25 = BM25Index()
+    # Le BM25 est écrit après le checkpoint : il peut être en retard (complété ici), pas en avance,
+    # sauf fichier d'un autre store ; on le ramène alors à la taille des métadonnées
+    bm25.truncate(len(metadata_store))
+    # Enregistrement supprimé (None) : position conservée, sans terme
+    bm25.add(record["text_content"] if record else "" for record in metadata_store[len(bm25):])
+    return bm25
+
+
+def reciprocal_rank_fusion(rankings, k, rrf_k=RRF_K):
+    """Fusionne plusieurs classements d'ids (le meilleur en premier) : score = somme des 1 / (rrf_k + rang)"""
+    scores = {}
+    for ranking in rankings:
+        for rank, i in enumerate(ranking):
+            i = int(i)
+            scores[i] = scores.get(i, 0.0) + 1.0 / (rrf_k + rank + 1)
+    return sorted(scores, key=lambda i: -scores[i])[:k]
@@ -0,0 +1,83 @@
+import re
+
+# Fin de phrase (ponctuation suivie d'un blanc) ou saut de paragraphe
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s+|\n\s*\n")
+
+
+def approximate_tokens(text):
+    """Estimation sans tokenizer : ~1,3 sous-mot WordPiece par mot en français"""
+    return int(len(text.split()) * 1.3) + 1
+
+
+def iter_sentences(text):
+    """Phrases et paragraphes du texte, produits au fil de la lecture"""
+    start = 0
+    for match in _SENTENCE_END.finditer(text):
+        sentence = text[start:match.start()].strip()
+        if sentence:
+            yield sentence
+        start = match.end()
+    sentence = text[start:].strip()
+    if sentence:
+        yield sentence
+
+
+def _split_long_sentence(sentence, count_tokens, max_tokens):
+    # Phrase plus longue que le budget : coupure entre deux mots (le tokenizer découpe mot par mot)
+    words, budget = [], 0
+    for word in sentence.split():
+        tokens = count_tokens(word)
+        if words and budget + tokens > max_tokens:
+            yield " ".join(words), budget
+            words, budget = [], 0
+        words.append(word)
+        budget += tokens
+    if words:
+        yield " ".join(words), budget
+
+
+def fixed_chunks(text, size=500, **_):
+    """Découpage historique : tranches de size caractères, sans tenir compte des mots"""
+    for i in range(0, len(text), size):
+        yield text[i:i + size]
+
+
+def sentence_chunks(text, count_tokens=approximate_tokens, max_tokens=200, overlap_tokens=32):
+    """Regroupe des phrases entières tant que le chunk tient dans max_tokens tokens.
+
+    Chaque chunk reprend les dernières phrases du précédent, dans la limite de overlap_tokens,
+    pour qu'une information à cheval sur deux chunks reste lisible d'un seul tenant.
+    """
+    current, budget = [], 0 # [(phrase, tokens)]
+    for sentence in iter_sentences(text):
+        tokens = count_tokens(sentence)
+        pieces = [(sentence, tokens)] if tokens <= max_tokens else _split_long_sentence(sentence, count_tokens, max_tokens)
+        for piece, piece_tokens in pieces:
+            if current and budget + piece_tokens > max_tokens:
+                yield " ".join(p for p, _ in current)
+                # Recouvrement : dernières phrases du chunk émis, si la suivante tient encore
+                overlap, overlap_budget = [], 0
+                for previous, previous_tokens in reversed(current):
+                    if overlap_budget + previous_tokens > overlap_tokens:
+                        break
+                    overlap.insert(0, (previous, previous_tokens))
+                    overlap_budget += previous_tokens
+                if overlap_budget + piece_tokens > max_tokens:
+                    overlap, overlap_budget = [], 0
+                current, budget = overlap, overlap_budget
+            current.append((piece, piece_tokens))
+            budget += piece_tokens
+    if current:
+        yield " ".join(p for p, _ in current)
+
+
+CHUNKERS = {
+    "fixed": fixed_chunks,
+    "sentence": sentence_chunks,
+}
+
+
+def get_chunker(name):
+    if name not in CHUNKERS:
+        raise ValueError(f"CHUNKER inconnu : {name} (disponibles : {', '.join(CHUNKERS)})")
+    return CHUNKERS[name]
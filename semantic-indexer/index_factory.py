@@ -0,0 +1,261 @@
+import os
+import time
+import numpy as np
+import faiss
+
+# --- CONFIGURATION ---
+# Type d'index : "flat" (recherche exacte), "ivf_flat", "hnsw", "ivf_pq",
+# ou "sq8" / "fp16" (vecteurs quantifiés sur 1 / 2 octets par dimension au lieu de 4)
+INDEX_TYPE = os.getenv("INDEX_TYPE", "flat")
+IVF_NLIST = int(os.getenv("IVF_NLIST", "1024"))
+IVF_NPROBE = int(os.getenv("IVF_NPROBE", "16"))
+HNSW_M = int(os.getenv("HNSW_M", "32"))
+HNSW_EF_SEARCH = int(os.getenv("HNSW_EF_SEARCH", "64"))
+PQ_M = int(os.getenv("PQ_M", "48")) # Nombre de sous-quantificateurs, doit diviser la dimension
+# En dessous de ce nombre de vecteurs, un index IVF est mal entraîné : on reste en flat
+MIN_TRAIN_VECTORS = int(os.getenv("MIN_TRAIN_VECTORS", "1000"))
+TRAIN_SAMPLE_SIZE = int(os.getenv("TRAIN_SAMPLE_SIZE", "50000"))
+# Un index IVF est réentraîné quand le corpus permet un nlist au moins IVF_RETRAIN_GROWTH fois plus grand
+# (nlist est fixé à l'entraînement : sinon chaque liste grossit avec le corpus et nprobe en parcourt une part fixe)
+IVF_RETRAIN_GROWTH = int(os.getenv("IVF_RETRAIN_GROWTH", "4"))
+
+# Classes faiss correspondant à chaque type (faiss.read_index renvoie la classe concrète)
+_INDEX_CLASSES = {
+    "flat": ("IndexFlat", "IndexFlatL2"),
+    "ivf_flat": ("IndexIVFFlat",),
+    "hnsw": ("IndexHNSWFlat",),
+    "ivf_pq": ("IndexIVFPQ",),
+    "sq8": ("IndexScalarQuantizer",),
+    "fp16": ("IndexScalarQuantizer",),
+}
+# Index dont les vecteurs stockés sont approchés : les meilleurs candidats gagnent à être
+# reclassés sur les vecteurs pleine précision (fichier brut écrit par l'indexeur)
+QUANTIZED_TYPES = ("ivf_pq", "sq8", "fp16")
+# Distance renvoyée par faiss pour une place vide (moins de k résultats)
+_MISSING_DISTANCE = np.finfo('float32').max
+
+
+def index_type_of(index):
+    """Retrouve le type configuré ("flat", "hnsw", ...) d'un index faiss (celui de la base d'un LayeredIndex)"""
+    index = base_index(index)
+    name = type(index).__name__
+    if name == "IndexScalarQuantizer":
+        return "fp16" if index.sq.qtype == faiss.ScalarQuantizer.QT_fp16 else "sq8"
+    for index_type, classes in _INDEX_CLASSES.items():
+        if name in classes:
+            return index_type
+    return name
+
+
+def _nlist(nb_vectors):
+    # ~39 points par centroïde au minimum pour un k-means correct
+    return max(1, min(IVF_NLIST, nb_vectors // 39))
+
+
+def _factory_string(index_type, nb_vectors):
+    nlist = _nlist(nb_vectors)
+    if index_type == "flat":
+        return "Flat"
+    if index_type == "ivf_flat":
+        return f"IVF{nlist},Flat"
+    if index_type == "hnsw":
+        return f"HNSW{HNSW_M}"
+    if index_type == "ivf_pq":
+        return f"IVF{nlist},PQ{PQ_M}"
+    if index_type == "sq8":
+        return "SQ8"
+    if index_type == "fp16":
+        return "SQfp16"
+    raise ValueError(f"INDEX_TYPE inconnu : {index_type}")
+
+
+def configure_search(index, nprobe=IVF_NPROBE, ef_search=HNSW_EF_SEARCH):
+    """Applique les paramètres de recherche (compromis rappel / latence) selon le type d'index"""
+    base, index_type = base_index(index), index_type_of(index)
+    if index_type in ("ivf_flat", "ivf_pq"):
+        faiss.extract_index_ivf(base).nprobe = nprobe
+    elif index_type == "hnsw":
+        base.hnsw.efSearch = ef_search
+    return index
+
+
+def build_index(index_type, vectors):
+    """Crée un index du type demandé, l'entraîne sur un échantillon puis y ajoute les vecteurs"""
+    vectors = np.ascontiguousarray(vectors, dtype='float32')
+    index = faiss.index_factory(vectors.shape[1], _factory_string(index_type, len(vectors)), faiss.METRIC_L2)
+    if not index.is_trained:
+        sample = vectors
+        if len(vectors) > TRAIN_SAMPLE_SIZE:
+            rows = np.random.default_rng(0).choice(len(vectors), TRAIN_SAMPLE_SIZE, replace=False)
+            sample = vectors[rows]
+        index.train(sample)
+    index.add(vectors)
+    return configure_search(index)
+
+
+def enable_reconstruct(index):
+    """Les index IVF n'autorisent reconstruct qu'avec une table id -> liste inversée"""
+    if isinstance(index, LayeredIndex):
+        return index # Table construite à la demande sur la base (reconstruct_batch)
+    if index_type_of(index) in ("ivf_flat", "ivf_pq"):
+        ivf = faiss.extract_index_ivf(index)
+        if ivf.direct_map.type == faiss.DirectMap.NoMap:
+            ivf.make_direct_map()
+    return index
+
+
+def extract_vectors(index):
+    """Relit tous les vecteurs d'un index (approximatifs si l'index est quantifié, ex. PQ)"""
+    return enable_reconstruct(index).reconstruct_n(0, index.ntotal)
+
+
+class LayeredIndex:
+    """Index des lecteurs (llm-qa, API de recherche) : checkpoint de l'indexeur (base) + deltas du journal.
+
+    La base n'est jamais modifiée (elle peut donc rester mappée en lecture seule) ; les vecteurs
+    du journal forment une couche en mémoire, recherchée en force brute à côté de la base.
+    extended() renvoie un nouvel index qui partage la base : seule la couche, bornée par la compaction
+    de l'indexeur (nouveau checkpoint = nouvelle base), est recopiée. Les recherches en cours gardent
+    l'ancien objet.
+    """
+
+    def __init__(self, base, delta=None):
+        self.base = base
+        self.d = base.d
+        self.delta = np.empty((0, base.d), dtype='float32') if delta is None else delta
+        self.ntotal = base.ntotal + len(self.delta)
+        self._delta_norms = (self.delta ** 2).sum(axis=1)
+
+    def extended(self, vectors):
+        """Nouvel index avec les vecteurs suivants (ids ntotal, ntotal + 1, ...)"""
+        vectors = np.asarray(vectors, dtype='float32').reshape(-1, self.d)
+        if len(vectors) == 0:
+            return self
+        return LayeredIndex(self.base, np.vstack([self.delta, vectors]))
+
+    def _search_delta(self, x, k, selector):
+        # Distances L2 au carré, comme faiss ; ids de la couche décalés de base.ntotal
+        scores = np.maximum(self._delta_norms[None, :] - 2 * x @ self.delta.T + (x ** 2).sum(axis=1)[:, None], 0)
+        distances = np.full((len(x), k), _MISSING_DISTANCE, dtype='float32')
+        labels = np.full((len(x), k), -1, dtype='int64')
+        for q, row in enumerate(scores):
+            found = 0
+            for j in np.argsort(row, kind='stable'):
+                i = self.base.ntotal + int(j)
+                # Même sélecteur que la base (documents supprimés, candidats filtrés)
+                if selector is not None and not selector.is_member(i):
+                    continue
+                distances[q, found], labels[q, found] = row[j], i
+                found += 1
+                if found == k:
+                    break
+        return distances, labels
+
+    def search(self, x, k, params=None, D=None, I=None):
+        x = np.ascontiguousarray(x, dtype='float32').reshape(-1, self.d)
+        distances, labels = self.base.search(x, k, params=params)
+        if len(self.delta):
+            delta_distances, delta_labels = self._search_delta(x, k, getattr(params, "sel", None))
+            distances, labels = np.hstack([distances, delta_distances]), np.hstack([labels, delta_labels])
+            # Fusion des deux listes ; les places vides (-1) en dernier
+            order = np.argsort(np.where(labels < 0, np.inf, distances), axis=1, kind='stable')[:, :k]
+            distances, labels = np.take_along_axis(distances, order, 1), np.take_along_axis(labels, order, 1)
+        if D is not None:
+            D[:], I[:] = distances, labels
+            return D, I
+        return distances, labels
+
+    def reconstruct_batch(self, ids):
+        ids = np.asarray(ids, dtype='int64')
+        vectors = np.empty((len(ids), self.d), dtype='float32')
+        in_base = ids < self.base.ntotal
+        if in_base.any():
+            vectors[in_base] = enable_reconstruct(self.base).reconstruct_batch(ids[in_base])
+        vectors[~in_base] = self.delta[ids[~in_base] - self.base.ntotal]
+        return vectors
+
+    def reconstruct_n(self, start, n):
+        return self.reconstruct_batch(np.arange(start, start + n))
+
+
+def base_index(index):
+    """Index faiss d'un LayeredIndex (sa base), ou l'index lui-même"""
+    return index.base if isinstance(index, LayeredIndex) else index
+
+
+def rerank(raw_vectors, query, ids, k):
+    """Reclasse des candidats par distance L2 exacte sur les vecteurs pleine précision.
+
+    Seules les lignes des candidats sont lues (raw_vectors est un memmap). Si un candidat n'a pas
+    encore sa ligne (fichier en retard sur l'index), l'ordre de l'index est conservé.
+    """
+    ids = np.asarray(ids, dtype='int64')
+    if len(ids) == 0 or ids.max() >= len(raw_vectors):
+        return ids[:k].tolist()
+    scores = ((np.asarray(raw_vectors[ids], dtype='float32') - np.asarray(query, dtype='float32')) ** 2).sum(axis=1)
+    return ids[np.argsort(scores, kind='stable')[:k]].tolist()
+
+
+def needs_migration(index, index_type=INDEX_TYPE):
+    current = index_type_of(index)
+    if current == index_type and index_type in ("ivf_flat", "ivf_pq"):
+        # Entraîné sur un corpus plus petit : trop peu de listes pour la taille actuelle
+        return _nlist(index.ntotal) >= IVF_RETRAIN_GROWTH * faiss.extract_index_ivf(index).nlist
+    # Un index d'un type non géré ici (construit à la main) est laissé tel quel
+    if current == index_type or current not in _INDEX_CLASSES:
+        return False
+    # Les index IVF ne sont construits qu'avec assez de vecteurs pour l'entraînement
+    # (le PQ entraîne en plus 256 centroïdes par sous-quantificateur)
+    if index_type == "ivf_pq":
+        return index.ntotal >= max(MIN_TRAIN_VECTORS, 39 * 256)
+    # Le SQ n'apprend que les bornes de chaque dimension : pas de minimum de vecteurs
+    return index_type in ("flat", "hnsw", "sq8", "fp16") or index.ntotal >= MIN_TRAIN_VECTORS
+
+
+def migrate_index(index, index_type=INDEX_TYPE, vectors=None):
+    """Reconstruit l'index existant (ex. IndexFlatL2 historique) dans le type configuré,
+    ou réentraîne un index IVF devenu trop petit pour le corpus (voir IVF_RETRAIN_GROWTH).
+
+    Les positions des vecteurs sont conservées, les métadonnées restent donc alignées.
+    vectors : vecteurs pleine précision s'ils sont disponibles (sinon relus dans l'index, approchés s'il est quantifié).
+    """
+    if not needs_migration(index, index_type):
+        return index
+    if vectors is None or len(vectors) != index.ntotal:
+        vectors = extract_vectors(index)
+    print(f"Migration de l'index {index_type_of(index)} -> {index_type} ({len(vectors)} vecteurs)...")
+    new_index = build_index(index_type, vectors)
+    report = evaluate_index(new_index, vectors)
+    print(
+        f" -> Rappel@{report['k']} = {report['recall']:.3f}, "
+        f"latence {report['latency_ms']:.2f} ms/requête (exact : {report['flat_latency_ms']:.2f} ms)"
+    )
+    return new_index
+
+
+def evaluate_index(index, vectors, k=10, nb_queries=100):
+    """Mesure le rappel@k et la latence de l'index par rapport à une recherche exacte (IndexFlatL2)"""
+    vectors = np.ascontiguousarray(vectors, dtype='float32')
+    k = min(k, len(vectors))
+    rng = np.random.default_rng(0)
+    rows = rng.choice(len(vectors), min(nb_queries, len(vectors)), replace=False)
+    # Requêtes proches des données stockées, sans être des copies exactes
+    queries = vectors[rows] + rng.normal(0, 0.01, (len(rows), vectors.shape[1])).astype('float32')
+
+    exact = faiss.IndexFlatL2(vectors.shape[1])
+    exact.add(vectors)
+    start = time.perf_counter()
+    _, truth = exact.search(queries, k)
+    flat_latency = (time.perf_counter() - start) * 1000 / len(queries)
+
+    start = time.perf_counter()
+    _, found = index.search(queries, k)
+    latency = (time.perf_counter() - start) * 1000 / len(queries)
+
+    hits = sum(len(set(t) & set(f)) for t, f in zip(truth, found))
+    return {
+        "k": k,
+        "recall": hits / (k * len(queries)),
+        "latency_ms": latency,
+        "flat_latency_ms": flat_latency,
+    }
@@ -1,51 +1,176 @@
 import pika
 import json
 import os
+import time
 import glob
 import csv
+import sys
 import numpy as np
-import pickle
 from sentence_transformers import SentenceTransformer
 import faiss
+from persistence import append_delta, write_checkpoint, load_state, checkpoint_exists
+from persistence import append_raw_vectors, open_raw_vectors, sync_raw_vectors
+from index_factory import needs_migration, migrate_index, INDEX_TYPE, QUANTIZED_TYPES
+# Claim-check commun aux services, maintenu dans doc-ingestor (producteur des références)
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "doc-ingestor"))
+from blob_store import unpack_text, release_text
+from chunking import get_chunker
+from bm25 import BM25Index, load_bm25
+from metadata_db import MetadataStore, text_hash
 
 # --- CONFIGURATION ---
 RABBITMQ_HOST = os.getenv("RABBITMQ_HOST", "localhost")
 INPUT_QUEUE = 'clean_documents_queue'
 DEFAULT_DATA_DIR = "default_data"
+# Nombre de textes encodés par passe du modèle (CSV MTC et chunks patients)
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "64"))
+# Consommateur : "batch" (micro-lots de messages) ou "single" (un message par callback)
+CONSUMER_MODE = os.getenv("CONSUMER_MODE", "batch")
+BATCH_MAX_MESSAGES = int(os.getenv("BATCH_MAX_MESSAGES", "32"))
+BATCH_MAX_WAIT_MS = int(os.getenv("BATCH_MAX_WAIT_MS", "500"))
+# Découpage des textes patients : "sentence" (phrases entières, budget en tokens MiniLM) ou "fixed" (500 caractères)
+CHUNKER = os.getenv("CHUNKER", "sentence")
+CHUNK_MAX_TOKENS = int(os.getenv("CHUNK_MAX_TOKENS", "200")) # all-MiniLM-L6-v2 tronque au-delà de 256
+CHUNK_OVERLAP_TOKENS = int(os.getenv("CHUNK_OVERLAP_TOKENS", "32"))
+# Déduplication des chunks avant encodage (hash du texte normalisé) :
+# "source" = même texte dans un même document (redélivrance RabbitMQ, CSV relu...),
+# "global" = même texte quelle que soit la source, "off" = désactivée
+CHUNK_DEDUP_SCOPE = os.getenv("CHUNK_DEDUP_SCOPE", "source")
 
 # Fichiers de stockage
 INDEX_FILE = "vector_store.faiss"
-METADATA_FILE = "metadata_store.pkl"
+METADATA_FILE = "metadata_store.db" # SQLite (WAL) indexée par position FAISS (anciens : metadata_store.bin / .pkl)
+# Journal append-only des deltas, compacté dans le checkpoint toutes les COMPACT_EVERY entrées
+LOG_FILE = "vector_store.log"
+# Vecteurs float32 pleine précision, sur disque : reclassement des candidats et migrations exactes.
+# Tenu à jour seulement si l'index est quantifié (un index flat contient déjà les vecteurs exacts)
+RAW_VECTORS_FILE = "vector_store.f32"
+KEEP_RAW_VECTORS = INDEX_TYPE in QUANTIZED_TYPES
+# Index lexical BM25 (noms latins, syndromes...) aligné sur les positions FAISS, écrit à chaque checkpoint
+BM25_FILE = "bm25_index.pkl"
+COMPACT_EVERY = int(os.getenv("COMPACT_EVERY", "100"))
 
 print("Chargement du modèle d'embedding...")
 model = SentenceTransformer('all-MiniLM-L6-v2') 
 dimension = 384
 index = None
 metadata_store = []
+pending_vectors = [] # Vecteurs indexés mais pas encore écrits sur disque
+log_entries = 0
+bm25 = BM25Index()
 
 def save_state():
-    faiss.write_index(index, INDEX_FILE)
-    with open(METADATA_FILE, 'wb') as f:
-        pickle.dump(metadata_store, f)
+    """Checkpoint complet (compaction) : réécrit l'index, reporte le WAL des métadonnées et vide le journal"""
+    global index, pending_vectors, log_entries
+    # Vecteurs jamais journalisés (ingestion CSV initiale) : au fichier brut avant le checkpoint
+    if KEEP_RAW_VECTORS and pending_vectors:
+        append_raw_vectors(RAW_VECTORS_FILE, np.vstack(pending_vectors))
+    # Passage au type d'index configuré (INDEX_TYPE) dès qu'il y a assez de vecteurs,
+    # reconstruit depuis les vecteurs pleine précision (l'index actuel peut être quantifié)
+    index = migrate_index(index, vectors=open_raw_vectors(RAW_VECTORS_FILE, dimension))
+    write_checkpoint(index, metadata_store, INDEX_FILE, LOG_FILE)
+    # Après le checkpoint : un BM25 en retard est complété au chargement depuis les métadonnées
+    bm25.save(BM25_FILE)
+    pending_vectors = []
+    log_entries = 0
     print(" -> Index sauvegardé.")
 
-def add_to_index(text, source_name, doc_type="knowledge_base"):
-    """Ajoute un texte vectorisé à l'index"""
+def persist_delta():
+    """Ajoute au journal uniquement les vecteurs indexés depuis la dernière écriture"""
+    global pending_vectors, log_entries
+    if not pending_vectors: return
+
+    vectors = np.vstack(pending_vectors)
+    start_id = len(metadata_store) - len(vectors)
+    # Lignes brutes d'abord : un lecteur qui voit le delta trouve aussi ses vecteurs pleine précision
+    if KEEP_RAW_VECTORS:
+        append_raw_vectors(RAW_VECTORS_FILE, vectors)
+    append_delta(LOG_FILE, start_id, vectors, metadata_store[start_id:])
+    pending_vectors = []
+    log_entries += 1
+
+    if log_entries >= COMPACT_EVERY:
+        # Le delta est déjà durable : un échec de compaction (ex. fichier mappé par llm-qa
+        # sous Windows) ne doit pas faire rejeter le message, on réessaiera au prochain delta
+        try:
+            save_state()
+        except Exception as e:
+            print(f"⚠️ Compaction reportée : {e}")
+    else:
+        print(f" -> Delta journalisé ({len(vectors)} vecteurs).")
+
+def make_records(texts, source_name, doc_type="knowledge_base", doc_id="KB_MTC", fields=None):
+    """Construit les métadonnées associées à chaque texte à indexer.
+
+    fields (patient_id, doc_type, date...) alimentent les listes inversées de la recherche filtrée.
+    """
+    return [{
+        "doc_id": doc_id,
+        "text_content": text,
+        "source": source_name,
+        "type": doc_type,
+        **(fields or {})
+    } for text in texts]
+
+def count_tokens(text):
+    """Nombre de tokens WordPiece vus par le modèle d'embedding (sans [CLS] / [SEP])"""
+    return len(model.tokenizer.tokenize(text))
+
+def chunk_text(text):
+    """Générateur des chunks d'un texte selon le découpeur configuré (CHUNKER)"""
+    return get_chunker(CHUNKER)(
+        text,
+        count_tokens=count_tokens,
+        max_tokens=CHUNK_MAX_TOKENS,
+        overlap_tokens=CHUNK_OVERLAP_TOKENS
+    )
+
+def dedup_records(records):
+    """Écarte les chunks vides ou déjà indexés (y compris les doublons internes au lot).
+
+    Les empreintes des chunks indexés sont une colonne indexée de la base (text_hash) :
+    une requête par lot, rien à reconstruire au démarrage. Les chunks supprimés n'y comptent plus.
+    """
+    records = [record for record in records if record["text_content"].strip()]
+    if CHUNK_DEDUP_SCOPE == "off":
+        return records
+    by_source = CHUNK_DEDUP_SCOPE == "source"
+    hashes = [text_hash(record["text_content"]) for record in records]
+    seen = {(h, source if by_source else None) for h, source in metadata_store.indexed_chunks(hashes)}
+    kept = []
+    for record, h in zip(records, hashes):
+        key = (h, record["source"] if by_source else None)
+        if key in seen:
+            continue
+        seen.add(key)
+        kept.append(record)
+    if len(kept) < len(records):
+        print(f" -> {len(records) - len(kept)} chunks déjà indexés ignorés.")
+    return kept
+
+def index_records(records):
+    """Vectorise les textes des métadonnées par lots et les ajoute à l'index en un seul appel"""
     global index
-    if not text.strip(): return
+    records = dedup_records(records)
+    if not records: return
 
-    embeddings = model.encode([text])
+    embeddings = model.encode([record["text_content"] for record in records], batch_size=EMBED_BATCH_SIZE)
     if index is None:
         index = faiss.IndexFlatL2(dimension)
-    
-    index.add(np.array(embeddings).astype('float32'))
-    
-    metadata_store.append({
-        "doc_id": "KB_MTC",
-        "text_content": text,
-        "source": source_name,
-        "type": doc_type
-    })
+
+    vectors = np.array(embeddings).astype('float32')
+    index.add(vectors)
+    pending_vectors.append(vectors)
+    metadata_store.extend(records)
+    bm25.add(record["text_content"] for record in records)
+
+def add_batch_to_index(texts, source_name, doc_type="knowledge_base"):
+    """Vectorise une liste de textes par lots et les ajoute à l'index en un seul appel"""
+    index_records(make_records(texts, source_name, doc_type))
+
+def add_to_index(text, source_name, doc_type="knowledge_base"):
+    """Ajoute un texte vectorisé à l'index"""
+    add_batch_to_index([text], source_name, doc_type)
 
 def ingest_csv_data():
     """Traite intelligemment vos CSV MTC"""
@@ -60,7 +185,7 @@ def ingest_csv_data():
         try:
             with open(file_path, 'r', encoding='utf-8') as f:
                 reader = csv.DictReader(f)
-                count = 0
+                texts = []
                 
                 for row in reader:
                     # CAS 1 : Matrice de Ranking (Scores)
@@ -72,8 +197,7 @@ def ingest_csv_data():
                             f"Plante recommandée : {row.get('nom_latin', '')} ({row.get('nom_chinois', '')}). "
                             f"Score de pertinence : {row.get('score_role', '0')}."
                         )
-                        add_to_index(text, filename)
-                        count += 1
+                        texts.append(text)
 
                     # CAS 2 : Base de Connaissance (Détails)
                     elif "base" in filename or "connaissance" in filename:
@@ -85,58 +209,200 @@ def ingest_csv_data():
                             f"Rôle : {row.get('role_formule', 'Inconnu')} (Score {row.get('score_role', '')}). "
                             f"Description : {row.get('description', '')}"
                         )
-                        add_to_index(text, filename)
-                        count += 1
-                        
-                print(f"   -> {count} entrées indexées pour {filename}")
+                        texts.append(text)
+
+                # Un seul encodage par lots et un seul index.add pour tout le fichier
+                add_batch_to_index(texts, filename)
+                print(f"   -> {len(texts)} entrées indexées pour {filename}")
 
         except Exception as e:
             print(f"⚠️ Erreur lecture CSV {filename}: {e}")
 
+def delete_document(doc_id):
+    """Supprime les chunks d'un document : métadonnées effacées, termes retirés du BM25,
+    vecteurs écartés des recherches (llm-qa, API de recherche).
+
+    Exécuté par le consommateur, seul écrivain du store, à réception d'un message
+    {"action": "delete", "doc_id": ...} (publié par request_delete).
+
+    Les positions FAISS ne sont pas réattribuées (elles servent de clé aux métadonnées, au BM25
+    et au fichier brut). Un seul checkpoint, une fois les suppressions appliquées : il vide le journal
+    (son rejeu ne peut plus faire réapparaître les chunks), sauvegarde le BM25 et publie un nouvel index
+    que les lecteurs rechargent avec la liste des ids supprimés. Un crash avant ce checkpoint laisse
+    le message non acquitté : la suppression est rejouée à sa redélivrance.
+    """
+    ids = metadata_store.ids_where(doc_id=str(doc_id))
+    if ids:
+        # Lignes marquées supprimées : ignorées par la déduplication, le document pourra être réindexé
+        metadata_store.delete(ids)
+        bm25.remove(ids)
+        save_state()
+    print(f" -> Document {doc_id} supprimé ({len(ids)} chunks).")
+    return len(ids)
+
 # --- DÉMARRAGE ---
-if os.path.exists(INDEX_FILE) and os.path.exists(METADATA_FILE):
-    print("Chargement de l'index existant...")
-    index = faiss.read_index(INDEX_FILE)
-    with open(METADATA_FILE, 'rb') as f:
-        metadata_store = pickle.load(f)
-else:
-    print("Création d'un nouvel index MTC...")
-    index = faiss.IndexFlatL2(dimension)
-    metadata_store = []
-    ingest_csv_data() # Scan et ingestion des CSV
-    save_state()
-
-print(f"Index prêt ({index.ntotal} vecteurs). En attente RabbitMQ...")
-
-# --- PARTIE RABBITMQ (Ne change pas) ---
+def load_store():
+    """Charge le checkpoint et rejoue le journal, ou crée l'index à partir des CSV MTC.
+
+    Appelé au lancement du script (pas à l'import : les tests importent le module sans store).
+    """
+    global index, metadata_store, log_entries, bm25
+    if checkpoint_exists(INDEX_FILE, METADATA_FILE):
+        print("Chargement de l'index existant...")
+        index, metadata_store, log_entries = load_state(INDEX_FILE, METADATA_FILE, LOG_FILE)
+        if KEEP_RAW_VECTORS:
+            sync_raw_vectors(RAW_VECTORS_FILE, index, LOG_FILE)
+        bm25 = load_bm25(BM25_FILE, metadata_store)
+        if needs_migration(index):
+            save_state()
+    else:
+        print("Création d'un nouvel index MTC...")
+        # Fichiers d'un ancien store : vecteurs bruts, base de métadonnées sans index
+        for path in (RAW_VECTORS_FILE, METADATA_FILE, METADATA_FILE + "-wal", METADATA_FILE + "-shm"):
+            if os.path.exists(path):
+                os.remove(path)
+        index = faiss.IndexFlatL2(dimension)
+        metadata_store = MetadataStore(METADATA_FILE)
+        ingest_csv_data() # Scan et ingestion des CSV
+        save_state()
+
+    print(f"Index prêt ({index.ntotal} vecteurs). En attente RabbitMQ...")
+
+# --- PARTIE RABBITMQ ---
+def patient_records(message):
+    """Découpe le texte patient d'un message de la queue en chunks"""
+    doc_id = message.get("doc_id")
+    # Texte en clair, compressé, ou lu dans le store de blobs (claim-check)
+    text = unpack_text(message, "original_text_masked")
+    print(f" [->] Reçu Doc Patient {doc_id}")
+
+    # Un document sans patient_id explicite constitue à lui seul le dossier du patient
+    metadata = message.get("metadata") or {}
+    date = metadata.get("date") or time.strftime("%Y-%m-%d", time.localtime(message.get("processed_at", time.time())))
+    return make_records(
+        chunk_text(text), f"Dossier Patient {doc_id}", "patient_file",
+        doc_id=str(doc_id),
+        fields={
+            "patient_id": str(metadata.get("patient_id") or doc_id),
+            "doc_type": metadata.get("type"),
+            "date": date
+        }
+    )
+
+def request_delete(doc_id):
+    """Publie une demande de suppression dans la queue du consommateur.
+
+    Le consommateur est le seul processus qui écrit l'index et le journal : un second écrivain
+    (checkpoint concurrent) effacerait ses deltas non compactés.
+    """
+    connection = pika.BlockingConnection(pika.ConnectionParameters(host=RABBITMQ_HOST))
+    try:
+        channel = connection.channel()
+        channel.confirm_delivery()
+        channel.queue_declare(queue=INPUT_QUEUE, durable=True)
+        channel.basic_publish(
+            exchange='',
+            routing_key=INPUT_QUEUE,
+            body=json.dumps({"action": "delete", "doc_id": str(doc_id)}),
+            properties=pika.BasicProperties(delivery_mode=2)
+        )
+    finally:
+        connection.close()
+    print(f"Suppression du document {doc_id} demandée (appliquée par le consommateur).")
+
+def is_delete_request(message):
+    return message.get("action") == "delete"
+
 def callback(ch, method, properties, body):
     try:
         message = json.loads(body)
-        doc_id = message.get("doc_id")
-        text = message.get("original_text_masked")
-        print(f" [->] Reçu Doc Patient {doc_id}")
-        
-        # Découpage simple pour le texte patient
-        chunks = [text[i:i+500] for i in range(0, len(text), 500)]
-        
-        for chunk in chunks:
-            add_to_index(chunk, f"Dossier Patient {doc_id}", "patient_file")
-            
-        save_state()
+        if is_delete_request(message):
+            delete_document(message["doc_id"])
+        else:
+            index_records(patient_records(message))
+            persist_delta()
         ch.basic_ack(delivery_tag=method.delivery_tag)
+        release_text(message, "original_text_masked")
     except Exception as e:
         print(f"Erreur: {e}")
         ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
 
+def handle_batch(ch, deliveries):
+    """Indexe un micro-lot de messages : un seul encodage, une seule écriture, un seul ack.
+
+    Les demandes de suppression sont appliquées à leur place dans le lot : les chunks reçus avant
+    sont indexés d'abord, ceux reçus après ne sont pas supprimés.
+    """
+    segments = [[]] # Chunks à indexer entre deux suppressions
+    deletions = [] # doc_id supprimé à la fin de chaque segment
+    messages = []
+    last_tag = None
+    for method, body in deliveries:
+        try:
+            message = json.loads(body)
+            if is_delete_request(message):
+                deletions.append(str(message["doc_id"]))
+                segments.append([])
+            else:
+                segments[-1].extend(patient_records(message))
+            messages.append(message)
+            last_tag = method.delivery_tag
+        except Exception as e:
+            print(f"Erreur message {method.delivery_tag}: {e}")
+            ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
+
+    # Le dernier tag valide sert au ack multiple (un tag déjà rejeté ne peut pas être acquitté)
+    if last_tag is None: return
+    try:
+        for records, doc_id in zip(segments, deletions):
+            index_records(records)
+            # Checkpoint de delete_document (s'il supprime) : couvre aussi les chunks qui viennent d'être indexés
+            delete_document(doc_id)
+        index_records(segments[-1])
+        persist_delta()
+        # Acquitte d'un coup tous les messages encore en attente jusqu'au dernier du lot
+        ch.basic_ack(delivery_tag=last_tag, multiple=True)
+        for message in messages:
+            release_text(message, "original_text_masked")
+        print(f" [<-] Lot de {len(deliveries)} messages indexé ({sum(map(len, segments))} chunks).")
+    except Exception as e:
+        print(f"Erreur lot: {e}")
+        ch.basic_nack(delivery_tag=last_tag, multiple=True, requeue=False)
+
+def consume_batches(channel):
+    """Regroupe jusqu'à BATCH_MAX_MESSAGES messages, ou ce qui est arrivé en BATCH_MAX_WAIT_MS"""
+    max_wait = BATCH_MAX_WAIT_MS / 1000
+    deliveries = []
+    deadline = 0
+    for method, properties, body in channel.consume(INPUT_QUEUE, inactivity_timeout=max_wait):
+        if method is not None:
+            if not deliveries:
+                deadline = time.monotonic() + max_wait
+            deliveries.append((method, body))
+
+        if deliveries and (method is None or len(deliveries) >= BATCH_MAX_MESSAGES or time.monotonic() >= deadline):
+            handle_batch(channel, deliveries)
+            deliveries = []
+
 def start_consuming():
     connection = pika.BlockingConnection(pika.ConnectionParameters(host=RABBITMQ_HOST))
     channel = connection.channel()
     channel.queue_declare(queue=INPUT_QUEUE, durable=True)
-    channel.basic_qos(prefetch_count=1)
-    channel.basic_consume(queue=INPUT_QUEUE, on_message_callback=callback)
-    channel.start_consuming()
+    if CONSUMER_MODE == "single":
+        channel.basic_qos(prefetch_count=1)
+        channel.basic_consume(queue=INPUT_QUEUE, on_message_callback=callback)
+        channel.start_consuming()
+    else:
+        # Le prefetch doit couvrir un lot complet, sinon le broker limite la taille des lots
+        channel.basic_qos(prefetch_count=BATCH_MAX_MESSAGES)
+        consume_batches(channel)
 
 if __name__ == "__main__":
+    # python indexer.py --delete <doc_id> : demande transmise au consommateur, sans charger le store
+    if len(sys.argv) == 3 and sys.argv[1] == "--delete":
+        request_delete(sys.argv[2])
+        sys.exit(0)
+    load_store()
     try:
         start_consuming()
     except KeyboardInterrupt:
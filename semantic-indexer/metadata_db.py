@@ -0,0 +1,361 @@
+import os
+import json
+import hashlib
+import sqlite3
+import threading
+import zlib
+from datetime import date, timedelta
+import numpy as np
+
+# Compression du texte des chunks : "none" ou "zlib" (deflate avec un dictionnaire commun,
+# tiré du premier lot indexé : vocabulaire répété "Syndrome", "Plante recommandée"...)
+METADATA_COMPRESSION = os.getenv("METADATA_COMPRESSION", "none")
+_ZDICT_MAX = 32768 # Fenêtre zlib : au-delà, le début du dictionnaire serait ignoré
+_ZWBITS = -15 # Deflate brut : sans en-tête ni somme de contrôle, 6 octets de moins par enregistrement
+
+# Champs d'un enregistrement stockés en colonnes ; les autres vont dans extra (JSON).
+# Colonnes TEXT : un doc_id entier (anciens stores) est lu "7", comme ceux écrits par patient_records.
+COLUMNS = ("doc_id", "source", "type", "patient_id", "doc_type", "date")
+# Toujours présents dans un enregistrement, même à None
+_BASE_FIELDS = ("doc_id", "source", "type")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS chunks (
+    id INTEGER PRIMARY KEY, -- position du vecteur dans l'index FAISS
+    doc_id TEXT, source TEXT, type TEXT, patient_id TEXT, doc_type TEXT, date TEXT,
+    text_content, -- TEXT, ou BLOB deflate si compressé
+    extra TEXT,
+    deleted INTEGER NOT NULL DEFAULT 0,
+    text_hash BLOB -- Empreinte du texte normalisé (text_hash), pour la déduplication des chunks
+);
+CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value);
+"""
+# Créés après l'ajout des colonnes manquantes d'une base plus ancienne (text_hash)
+_INDEXES = """
+CREATE INDEX IF NOT EXISTS ix_chunks_doc_id ON chunks(doc_id);
+CREATE INDEX IF NOT EXISTS ix_chunks_source ON chunks(source);
+CREATE INDEX IF NOT EXISTS ix_chunks_type ON chunks(type);
+CREATE INDEX IF NOT EXISTS ix_chunks_patient_id ON chunks(patient_id);
+CREATE INDEX IF NOT EXISTS ix_chunks_doc_type ON chunks(doc_type);
+CREATE INDEX IF NOT EXISTS ix_chunks_date ON chunks(date);
+CREATE INDEX IF NOT EXISTS ix_chunks_text_hash ON chunks(text_hash);
+"""
+# Paramètres par requête IN (...) : sous la limite de variables des anciennes versions de SQLite (999)
+_IN_BATCH = 500
+_SELECT = f"SELECT id, {', '.join(COLUMNS)}, text_content, extra, deleted FROM chunks"
+
+
+def text_hash(text):
+    """Empreinte d'un texte aux espaces près (déduplication des chunks)"""
+    return hashlib.sha1(" ".join(text.split()).encode('utf-8')).digest()
+
+
+def _day_after(value):
+    return (date.fromisoformat(str(value)) + timedelta(days=1)).isoformat()
+
+
+def _matches(record, filters, from_date, to_date):
+    """Même condition que ids_where, pour un enregistrement en mémoire"""
+    if record is None or any(str(record.get(column)) != str(value) for column, value in filters.items()):
+        return False
+    day = record.get("date")
+    if from_date is not None and (day is None or str(day) < str(from_date)):
+        return False
+    return to_date is None or (day is not None and str(day) < _day_after(to_date))
+
+
+def build_zdict(encoded):
+    """Dictionnaire zlib : échantillon régulier des textes.
+
+    Limité à la fenêtre de 32 Ko et à ~1/10 des données, pour rester rentable sur un petit lot.
+    """
+    size = min(_ZDICT_MAX, sum(len(text) for text in encoded) // 10)
+    if size == 0:
+        return b""
+    step = max(1, len(encoded) // 256)
+    return b"".join(encoded[::step])[-size:]
+
+
+def compress(data, zdict):
+    compressor = zlib.compressobj(9, zlib.DEFLATED, _ZWBITS, zdict=zdict)
+    return compressor.compress(data) + compressor.flush()
+
+
+def decompress(data, zdict):
+    return zlib.decompressobj(_ZWBITS, zdict=zdict).decompress(data)
+
+
+class MetadataStore:
+    """Métadonnées des vecteurs dans SQLite (WAL), indexées par position FAISS.
+
+    S'utilise comme l'ancienne liste (len, store[i], store[a:b], extend, del store[n:], itération)
+    sans la charger en mémoire. Un enregistrement supprimé garde son id (les positions FAISS
+    ne bougent pas) mais n'est plus renvoyé : store[i] vaut None.
+
+    readonly : lecteur (llm-qa, API de recherche) ; la base n'est jamais modifiée, la taille visible
+    suit l'index que le lecteur a chargé (l'indexeur écrit les lignes avant de journaliser le delta).
+    """
+
+    def __init__(self, path, readonly=False, compression=None):
+        self.path = path
+        self.readonly = readonly
+        self.compression = compression or METADATA_COMPRESSION
+        self._local = threading.local() # Une connexion par thread (lectures concurrentes en WAL)
+        self._extra = {} # Lecteur : enregistrements du journal absents de la base
+        if not readonly:
+            db = self._db()
+            db.executescript(_SCHEMA)
+            if "text_hash" not in {row[1] for row in db.execute("PRAGMA table_info(chunks)")}:
+                db.execute("ALTER TABLE chunks ADD COLUMN text_hash BLOB")
+            db.executescript(_INDEXES)
+            db.commit()
+        self._zdict = self._setting("zdict")
+        self._size = self._db().execute("SELECT COALESCE(MAX(id) + 1, 0) FROM chunks").fetchone()[0]
+        if not readonly:
+            self._backfill_text_hashes()
+
+    def _db(self):
+        db = getattr(self._local, "db", None)
+        if db is None:
+            if self.readonly:
+                db = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, check_same_thread=False)
+            else:
+                db = sqlite3.connect(self.path, check_same_thread=False)
+                db.execute("PRAGMA journal_mode=WAL")
+                # En WAL, NORMAL ne synchronise qu'aux checkpoints : le journal des deltas reste la référence
+                db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    def _setting(self, key):
+        row = self._db().execute("SELECT value FROM settings WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    # --- Conversion enregistrement <-> ligne ---
+
+    def _encode_text(self, text):
+        if self._zdict is None:
+            return text
+        return compress(text.encode('utf-8'), self._zdict)
+
+    def _decode_text(self, text):
+        if isinstance(text, bytes):
+            if self._zdict is None:
+                # Lecteur ouvert avant la création du dictionnaire par l'indexeur (premier lot compressé)
+                self._zdict = self._setting("zdict")
+            text = decompress(text, self._zdict).decode('utf-8')
+        return text
+
+    def _row(self, i, record):
+        extra = {k: v for k, v in record.items() if k not in COLUMNS and k != "text_content"}
+        text = record.get("text_content", "")
+        return (
+            i, *(record.get(column) for column in COLUMNS),
+            self._encode_text(text),
+            json.dumps(extra, ensure_ascii=False) if extra else None,
+            text_hash(text)
+        )
+
+    def _record(self, row):
+        if row[-1]:
+            return None
+        record = {}
+        for column, value in zip(COLUMNS, row[1:1 + len(COLUMNS)]):
+            if value is not None or column in _BASE_FIELDS:
+                record[column] = value
+        record["text_content"] = self._decode_text(row[1 + len(COLUMNS)])
+        if row[-2]:
+            record.update(json.loads(row[-2]))
+        return record
+
+    # --- Interface de liste ---
+
+    def __len__(self):
+        return self._size
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self._size)
+            if step != 1:
+                raise TypeError("MetadataStore ne supporte que les tranches contiguës")
+            return self.get_range(start, stop)
+        if key < 0:
+            key += self._size
+        if not 0 <= key < self._size:
+            raise IndexError(key)
+        row = self._db().execute(f"{_SELECT} WHERE id = ?", (key,)).fetchone()
+        if row is None:
+            if key in self._extra:
+                return self._extra[key]
+            raise IndexError(key)
+        return self._record(row)
+
+    def get_range(self, start, stop):
+        """Enregistrements d'ids start..stop-1, en une requête (None pour les supprimés)"""
+        rows = {row[0]: row for row in self._db().execute(f"{_SELECT} WHERE id >= ? AND id < ?", (start, stop))}
+        return [self._record(rows[i]) if i in rows else self._extra.get(i) for i in range(start, stop)]
+
+    def get_many(self, ids):
+        """Enregistrements d'ids quelconques (résultats d'une recherche), dans l'ordre demandé"""
+        ids = [int(i) for i in ids]
+        placeholders = ",".join("?" * len(ids))
+        rows = {row[0]: row for row in self._db().execute(f"{_SELECT} WHERE id IN ({placeholders})", ids)}
+        return [self._record(rows[i]) if i in rows else self._extra.get(i) for i in ids]
+
+    def __iter__(self, batch_size=1000):
+        for start in range(0, self._size, batch_size):
+            yield from self.get_range(start, min(start + batch_size, self._size))
+
+    def extend(self, records):
+        """Ajoute les enregistrements des vecteurs suivants (ids len(self), len(self) + 1, ...)"""
+        records = list(records)
+        if self.readonly:
+            # Lignes déjà écrites par l'indexeur ; gardées en mémoire seulement si absentes
+            present = self._db().execute(
+                "SELECT COUNT(*) FROM chunks WHERE id >= ? AND id < ?", (self._size, self._size + len(records))
+            ).fetchone()[0]
+            if present < len(records):
+                self._extra.update(zip(range(self._size, self._size + len(records)), records))
+            self._size += len(records)
+            return
+        if records and self._zdict is None and self.compression == "zlib":
+            self._init_zdict(records)
+        db = self._db()
+        with db:
+            db.executemany(
+                f"INSERT OR REPLACE INTO chunks (id, {', '.join(COLUMNS)}, text_content, extra, text_hash) "
+                f"VALUES ({', '.join('?' * (len(COLUMNS) + 4))})",
+                [self._row(self._size + n, record) for n, record in enumerate(records)]
+            )
+        self._size += len(records)
+
+    def _init_zdict(self, records):
+        zdict = build_zdict([record.get("text_content", "").encode('utf-8') for record in records])
+        if not zdict:
+            return
+        db = self._db()
+        with db:
+            db.execute("INSERT INTO settings (key, value) VALUES ('zdict', ?)", (zdict,))
+        self._zdict = zdict
+
+    def _backfill_text_hashes(self, batch_size=1000):
+        # Base antérieure à la colonne text_hash : empreintes calculées une fois, par lots
+        db = self._db()
+        while True:
+            rows = db.execute(
+                "SELECT id, text_content FROM chunks WHERE text_hash IS NULL AND deleted = 0 LIMIT ?", (batch_size,)
+            ).fetchall()
+            if not rows:
+                return
+            with db:
+                db.executemany(
+                    "UPDATE chunks SET text_hash = ? WHERE id = ?",
+                    [(text_hash(self._decode_text(text) or ""), i) for i, text in rows]
+                )
+
+    def __delitem__(self, key):
+        # Seule la troncature (del store[n:]) est supportée, comme pour l'ancienne liste dans load_state
+        if not isinstance(key, slice) or key.stop is not None or key.step is not None:
+            raise TypeError("MetadataStore ne supporte que la troncature del store[n:]")
+        start = max(0, key.start or 0)
+        if start >= self._size:
+            return
+        if not self.readonly:
+            db = self._db()
+            with db:
+                db.execute("DELETE FROM chunks WHERE id >= ?", (start,))
+        self._extra = {i: record for i, record in self._extra.items() if i < start}
+        self._size = start
+
+    # --- Requêtes ---
+
+    def ids_where(self, from_date=None, to_date=None, **filters):
+        """Ids (croissants) des enregistrements non supprimés dont les colonnes valent filters.
+
+        from_date / to_date : bornes incluses sur la date (ISO) ; les enregistrements sans date sont alors exclus.
+        """
+        unknown = [column for column in filters if column not in COLUMNS]
+        if unknown:
+            raise ValueError(f"Colonnes inconnues : {', '.join(unknown)}")
+        where, params = [f"{column} = ?" for column in filters], [str(value) for value in filters.values()]
+        if from_date is not None:
+            where.append("date >= ?")
+            params.append(str(from_date))
+        if to_date is not None:
+            where.append("date < ?")
+            params.append(_day_after(to_date))
+        where += ["deleted = 0", "id < ?"]
+        rows = self._db().execute(f"SELECT id FROM chunks WHERE {' AND '.join(where)} ORDER BY id", (*params, self._size))
+        ids = [row[0] for row in rows]
+        if self._extra:
+            # Lecteur : enregistrements du journal absents de la base, filtrés ici
+            extra = [i for i, record in self._extra.items() if _matches(record, filters, from_date, to_date)]
+            ids = sorted(set(ids).union(extra))
+        return ids
+
+    def dates_of(self, ids):
+        """Date (ISO, None si inconnue) de chaque id, dans l'ordre demandé"""
+        dates = {}
+        ids = [int(i) for i in ids]
+        for start in range(0, len(ids), _IN_BATCH):
+            batch = ids[start:start + _IN_BATCH]
+            dates.update(self._db().execute(f"SELECT id, date FROM chunks WHERE id IN ({','.join('?' * len(batch))})", batch))
+        return [dates[i] if i in dates else (self._extra.get(i) or {}).get("date") for i in ids]
+
+    def patient_count(self):
+        return self._db().execute(
+            "SELECT COUNT(DISTINCT patient_id) FROM chunks WHERE deleted = 0 AND id < ?", (self._size,)
+        ).fetchone()[0]
+
+    def indexed_chunks(self, hashes):
+        """Couples (empreinte, source) des chunks non supprimés dont le texte a l'une des empreintes hashes"""
+        hashes, found = list(set(hashes)), set()
+        for start in range(0, len(hashes), _IN_BATCH):
+            batch = hashes[start:start + _IN_BATCH]
+            found.update(self._db().execute(
+                f"SELECT text_hash, source FROM chunks WHERE text_hash IN ({','.join('?' * len(batch))}) "
+                "AND deleted = 0 AND id < ?", (*batch, self._size)
+            ))
+        return found
+
+    def deleted_ids(self):
+        """Ids supprimés (triés), à écarter des recherches : leurs vecteurs restent dans l'index"""
+        rows = self._db().execute("SELECT id FROM chunks WHERE deleted = 1 AND id < ? ORDER BY id", (self._size,))
+        return np.array([row[0] for row in rows], dtype='int64')
+
+    def delete(self, ids):
+        """Supprime des enregistrements : le texte est effacé, l'id reste réservé (position FAISS)"""
+        if self.readonly:
+            raise PermissionError("MetadataStore ouvert en lecture seule")
+        db = self._db()
+        with db:
+            db.executemany(
+                "UPDATE chunks SET deleted = 1, text_content = NULL, extra = NULL WHERE id = ?",
+                [(int(i),) for i in ids]
+            )
+
+    def checkpoint(self):
+        """Reporte le WAL dans la base (appelé à chaque checkpoint de l'index).
+
+        SQLite attend déjà les lecteurs en cours (délai de la connexion). Lève RuntimeError si le WAL
+        n'a toujours pas pu être reporté en entier : l'appelant ne doit alors ni remplacer l'index
+        ni vider le journal des deltas (la compaction est retentée au delta suivant).
+        """
+        if self.readonly:
+            return
+        busy, _, _ = self._db().execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()
+        if busy:
+            raise RuntimeError(f"Checkpoint du WAL de {self.path} bloqué par un lecteur")
+
+    def close(self):
+        db = getattr(self._local, "db", None)
+        if db is not None:
+            db.close()
+            self._local.db = None
+
+
+def deleted_ids(metadata_store):
+    """Ids supprimés d'un store : base SQLite, ou enregistrements None d'une liste (ancien fichier chargé)"""
+    if isinstance(metadata_store, MetadataStore):
+        return metadata_store.deleted_ids()
+    return np.array([i for i, record in enumerate(metadata_store) if record is None], dtype='int64')
@@ -0,0 +1,171 @@
+import os
+import numpy as np
+import faiss
+from index_factory import index_type_of, enable_reconstruct, base_index
+from metadata_db import MetadataStore
+
+# En dessous de ce nombre d'ids candidats, les vecteurs sont relus et comparés directement
+# (recherche exacte sur les seuls vecteurs du patient) ; au-delà, FAISS filtre via un IDSelector
+EXACT_SCAN_MAX_IDS = int(os.getenv("EXACT_SCAN_MAX_IDS", "4096"))
+
+# Champs des métadonnées indexés en listes inversées (valeur -> ids FAISS)
+FILTER_KEYS = ("patient_id", "doc_id", "doc_type", "type")
+
+
+class MetadataIndex:
+    """Listes inversées valeur -> ids FAISS, plus la date de chaque vecteur.
+
+    Les ids sont ajoutés dans l'ordre de l'index : chaque liste reste triée, ce qui permet
+    des intersections sans tri (np.intersect1d) et une lecture séquentielle des vecteurs.
+    """
+
+    def __init__(self, records=()):
+        self.postings = {key: {} for key in FILTER_KEYS}
+        self.dates = [] # Date ISO (AAAA-MM-JJ) par id, None si inconnue
+        self._date_array = None
+        self.extend(records)
+
+    def __len__(self):
+        return len(self.dates)
+
+    def extend(self, records):
+        """Ajoute les métadonnées des vecteurs suivants (ids len(self), len(self) + 1, ...)"""
+        for record in records:
+            i = len(self.dates)
+            if record is None: # Enregistrement supprimé : ne passe aucun filtre
+                self.dates.append(None)
+                continue
+            for key in FILTER_KEYS:
+                value = record.get(key)
+                if value is not None:
+                    self.postings[key].setdefault(str(value), []).append(i)
+            self.dates.append(record.get("date"))
+        self._date_array = None
+
+    def ids_for(self, key, value):
+        return np.asarray(self.postings[key].get(str(value), []), dtype='int64')
+
+    def _dates(self):
+        # Tableau numpy construit à la demande (NaT pour les vecteurs sans date)
+        if self._date_array is None:
+            self._date_array = np.array(self.dates, dtype='datetime64[D]')
+        return self._date_array
+
+    def select(self, patient_id=None, doc_id=None, doc_type=None, record_type=None, from_date=None, to_date=None):
+        """Ids (triés) des vecteurs respectant tous les filtres ; None si aucun filtre n'est donné"""
+        ids = None
+        for key, value in (("patient_id", patient_id), ("doc_id", doc_id), ("doc_type", doc_type), ("type", record_type)):
+            if value is None:
+                continue
+            matches = self.ids_for(key, value)
+            ids = matches if ids is None else np.intersect1d(ids, matches, assume_unique=True)
+
+        if from_date is None and to_date is None:
+            return ids
+        dates = self._dates()
+        if ids is None:
+            ids = np.arange(len(dates), dtype='int64')
+        candidate_dates = dates[ids]
+        # Bornes incluses ; les vecteurs sans date sont exclus dès qu'une borne est donnée
+        keep = ~np.isnat(candidate_dates)
+        if from_date is not None:
+            keep &= candidate_dates >= np.datetime64(from_date, 'D')
+        if to_date is not None:
+            keep &= candidate_dates <= np.datetime64(to_date, 'D')
+        return ids[keep]
+
+    def dates_of(self, ids):
+        return [self.dates[i] for i in ids]
+
+    def patient_count(self):
+        return len(self.postings["patient_id"])
+
+
+class StoreFilters:
+    """Mêmes filtres que MetadataIndex, évalués par la base SQLite (colonnes indexées).
+
+    Rien n'est parcouru au chargement : chaque requête lit ses ids dans la base (ids_where),
+    ou dans les enregistrements du journal que le lecteur garde en mémoire.
+    """
+
+    def __init__(self, store):
+        self.store = store
+
+    def __len__(self):
+        return len(self.store)
+
+    def extend(self, records):
+        pass # Les nouvelles lignes sont lues dans la base à la requête suivante
+
+    def select(self, patient_id=None, doc_id=None, doc_type=None, record_type=None, from_date=None, to_date=None):
+        """Ids (triés) des vecteurs respectant tous les filtres ; None si aucun filtre n'est donné"""
+        filters = {key: value for key, value in (
+            ("patient_id", patient_id), ("doc_id", doc_id), ("doc_type", doc_type), ("type", record_type)
+        ) if value is not None}
+        if not filters and from_date is None and to_date is None:
+            return None
+        return np.asarray(self.store.ids_where(from_date=from_date, to_date=to_date, **filters), dtype='int64')
+
+    def dates_of(self, ids):
+        return self.store.dates_of(ids)
+
+    def patient_count(self):
+        return self.store.patient_count()
+
+
+def metadata_filters(metadata):
+    """Filtres d'un store : requêtes SQL sur la base, listes inversées pour une liste (ancien fichier chargé)"""
+    if isinstance(metadata, MetadataStore):
+        return StoreFilters(metadata)
+    return MetadataIndex(metadata)
+
+
+def reconstruct_ids(index, ids, raw_vectors=None):
+    """Vecteurs d'ids donnés : pleine précision si le fichier brut les contient, sinon relus dans l'index"""
+    if raw_vectors is not None and len(ids) and ids[-1] < len(raw_vectors):
+        return np.asarray(raw_vectors[ids], dtype='float32')
+    return enable_reconstruct(index).reconstruct_batch(ids)
+
+
+def _search_parameters(index, selector):
+    # Les paramètres de recherche de l'index (nprobe, efSearch) sont repris avec le sélecteur
+    base, index_type = base_index(index), index_type_of(index)
+    if index_type in ("ivf_flat", "ivf_pq"):
+        return faiss.SearchParametersIVF(sel=selector, nprobe=faiss.extract_index_ivf(base).nprobe)
+    if index_type == "hnsw":
+        return faiss.SearchParametersHNSW(sel=selector, efSearch=base.hnsw.efSearch)
+    return faiss.SearchParameters(sel=selector)
+
+
+def exclusion_parameters(index, excluded):
+    """Paramètres de recherche qui écartent les ids excluded (documents supprimés) ; None s'il n'y en a pas"""
+    if excluded is None or len(excluded) == 0:
+        return None
+    return _search_parameters(index, faiss.IDSelectorNot(faiss.IDSelectorBatch(excluded)))
+
+
+def filtered_search(index, query, k, ids=None, raw_vectors=None, excluded=None):
+    """Recherche des k plus proches voisins de query parmi ids (tous les vecteurs si ids est None).
+
+    raw_vectors : vecteurs pleine précision (memmap), pour un calcul exact malgré un index quantifié.
+    excluded : ids triés à écarter pendant la recherche (documents supprimés, vecteurs encore dans l'index).
+
+    Retourne (distances, ids) sous forme de tableaux 1D, triés par distance croissante.
+    """
+    query = np.asarray(query, dtype='float32').reshape(1, -1)
+    if ids is not None and excluded is not None and len(excluded):
+        ids = np.setdiff1d(ids, excluded, assume_unique=True)
+    if ids is None:
+        distances, labels = index.search(query, k, params=exclusion_parameters(index, excluded))
+    elif len(ids) == 0:
+        return np.empty(0, dtype='float32'), np.empty(0, dtype='int64')
+    elif len(ids) <= EXACT_SCAN_MAX_IDS:
+        # Peu de candidats (un patient) : distance L2 exacte, sans parcourir le reste de l'index
+        vectors = reconstruct_ids(index, ids, raw_vectors)
+        scores = ((vectors - query) ** 2).sum(axis=1)
+        top = np.argsort(scores)[:k]
+        return scores[top], np.asarray(ids)[top]
+    else:
+        distances, labels = index.search(query, k, params=_search_parameters(index, faiss.IDSelectorBatch(ids)))
+    found = labels[0] != -1
+    return distances[0][found], labels[0][found]
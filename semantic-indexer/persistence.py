@@ -0,0 +1,265 @@
+import os
+import json
+import pickle
+import struct
+import zlib
+import numpy as np
+import faiss
+from index_factory import enable_reconstruct, LayeredIndex
+from metadata_db import MetadataStore, decompress
+
+# Chaque entrée du journal : [longueur (uint32)][crc32 (uint32)][payload pickle]
+# Le payload contient le delta ajouté par un message : vecteurs + métadonnées.
+_HEADER = struct.Struct("<II")
+
+# Ancien fichier de métadonnées (metadata_store.bin) : [magic][nombre N][N+1 offsets uint64][enregistrements JSON],
+# variante compressée : [magic][N][taille du dictionnaire (uint32)][dictionnaire][offsets][enregistrements deflate].
+# Relu uniquement pour l'import dans la base SQLite (metadata_db.MetadataStore).
+_BLOB_MAGIC = b"DQMB"
+_BLOB_HEADER = struct.Struct("<4sQ")
+_ZBLOB_MAGIC = b"DQMZ"
+_ZDICT_SIZE = struct.Struct("<I")
+
+
+def _fsync_write(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _blob_layout(data):
+    """(nombre d'enregistrements, dictionnaire zlib ou None, position de la table d'offsets)"""
+    magic, count = _BLOB_HEADER.unpack_from(data, 0)
+    if magic == _BLOB_MAGIC:
+        return count, None, _BLOB_HEADER.size
+    if magic == _ZBLOB_MAGIC:
+        (size,) = _ZDICT_SIZE.unpack_from(data, _BLOB_HEADER.size)
+        start = _BLOB_HEADER.size + _ZDICT_SIZE.size
+        return count, bytes(data[start:start + size]), start + size
+    raise ValueError("Format de métadonnées inconnu")
+
+
+def _legacy_metadata_files(metadata_file):
+    # Anciens formats : blob à offsets (metadata_store.bin), liste de dicts picklée (metadata_store.pkl)
+    base = os.path.splitext(metadata_file)[0]
+    return [path for path in (base + ".bin", base + ".pkl") if os.path.exists(path)]
+
+
+def checkpoint_exists(index_file, metadata_file):
+    return os.path.exists(index_file) and (
+        os.path.exists(metadata_file) or bool(_legacy_metadata_files(metadata_file)))
+
+
+def read_metadata(metadata_file):
+    """Charge en mémoire des métadonnées à l'ancien format (blob à offsets, ou pickle)"""
+    with open(metadata_file, 'rb') as f:
+        data = f.read()
+    if data[:len(_BLOB_MAGIC)] not in (_BLOB_MAGIC, _ZBLOB_MAGIC):
+        return pickle.loads(data)
+    count, zdict, table = _blob_layout(data)
+    offsets = np.frombuffer(data, dtype='<u8', count=count + 1, offset=table)
+    start = table + offsets.nbytes
+    records = (data[start + offsets[i]:start + offsets[i + 1]] for i in range(count))
+    if zdict is not None:
+        records = (decompress(record, zdict) for record in records)
+    return [json.loads(record) for record in records]
+
+
+def open_metadata(metadata_file, readonly=False):
+    """Ouvre la base de métadonnées, en y important au besoin un ancien fichier (.bin ou .pkl).
+
+    Un lecteur ne modifie rien : tant que l'indexeur n'a pas fait l'import, il charge l'ancien fichier en mémoire.
+    """
+    if os.path.exists(metadata_file):
+        return MetadataStore(metadata_file, readonly=readonly)
+    legacy = _legacy_metadata_files(metadata_file)
+    if readonly:
+        return read_metadata(legacy[0])
+    # Import dans un fichier temporaire puis os.replace : un crash ne laisse pas de base partielle
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(metadata_file + ".tmp" + suffix):
+            os.remove(metadata_file + ".tmp" + suffix)
+    store = MetadataStore(metadata_file + ".tmp")
+    if legacy:
+        records = read_metadata(legacy[0])
+        store.extend(records)
+        print(f"Métadonnées importées de {legacy[0]} ({len(records)} enregistrements).")
+    store.checkpoint()
+    store.close()
+    os.replace(metadata_file + ".tmp", metadata_file)
+    return MetadataStore(metadata_file)
+
+
+def read_index(index_file, use_mmap=False):
+    """Lit l'index faiss ; avec use_mmap, le fichier est mappé en lecture seule au lieu d'être copié en RAM.
+
+    IO_FLAG_MMAP_IFC mappe les vecteurs (flat, SQ) comme les listes inversées (IVF) ; le graphe HNSW
+    reste chargé. Les pages ne sont lues qu'au fil des recherches. Un index mappé refuse add() :
+    il ne sert que de base à un LayeredIndex (load_state avec readonly).
+    """
+    if not use_mmap:
+        return faiss.read_index(index_file)
+    return faiss.read_index(index_file, faiss.IO_FLAG_MMAP_IFC)
+
+
+def append_delta(log_file, start_id, vectors, records):
+    """Ajoute un delta (vecteurs + métadonnées) à la fin du journal, sans réécrire l'existant"""
+    payload = pickle.dumps({
+        "start_id": start_id,
+        "vectors": np.asarray(vectors, dtype='float32'),
+        "metadata": records
+    }, protocol=pickle.HIGHEST_PROTOCOL)
+    with open(log_file, 'ab') as f:
+        f.write(_HEADER.pack(len(payload), zlib.crc32(payload)))
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def read_deltas(log_file, offset=0):
+    """Relit le journal à partir de l'octet offset.
+
+    Chaque delta porte "end_offset", position de fin de l'entrée, pour reprendre la lecture plus tard.
+    S'arrête à la première entrée tronquée ou corrompue (crash ou écriture en cours).
+    """
+    if not os.path.exists(log_file):
+        return
+    with open(log_file, 'rb') as f:
+        f.seek(offset)
+        while True:
+            header = f.read(_HEADER.size)
+            if len(header) < _HEADER.size:
+                return
+            length, crc = _HEADER.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                print(f"⚠️ Journal {log_file} tronqué, entrées suivantes ignorées.")
+                return
+            delta = pickle.loads(payload)
+            delta["end_offset"] = f.tell()
+            yield delta
+
+
+def delta_tail(ntotal, delta):
+    """Partie d'un delta absente d'un index de ntotal vecteurs : (vecteurs, métadonnées).
+
+    Retourne None si le delta commence après ntotal (trou dans le journal).
+    """
+    skip = ntotal - delta["start_id"]
+    if skip < 0:
+        return None
+    return delta["vectors"][skip:], delta["metadata"][skip:]
+
+
+def collect_deltas(ntotal, deltas):
+    """Parties des deltas absentes d'un index de ntotal vecteurs, mises bout à bout : (vecteurs, métadonnées).
+
+    Retourne None en cas de trou dans le journal.
+    """
+    vectors, records = [], []
+    for delta in deltas:
+        tail = delta_tail(ntotal + len(records), delta)
+        if tail is None:
+            return None
+        vectors.append(tail[0])
+        records.extend(tail[1])
+    return (np.concatenate(vectors) if vectors else np.empty((0, 0), dtype='float32')), records
+
+
+def append_raw_vectors(raw_file, vectors):
+    """Ajoute des vecteurs float32 pleine précision au fichier brut (une ligne par position FAISS).
+
+    Ce fichier reste sur disque (relu en memmap) : il sert au reclassement des candidats
+    d'un index quantifié et aux migrations, sans garder les vecteurs complets en RAM.
+    """
+    with open(raw_file, 'ab') as f:
+        f.write(np.ascontiguousarray(vectors, dtype='<f4').tobytes())
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def open_raw_vectors(raw_file, dimension):
+    """Vecteurs bruts mappés en lecture seule (lignes complètes uniquement), None si le fichier est absent"""
+    if not os.path.exists(raw_file):
+        return None
+    rows = os.path.getsize(raw_file) // (4 * dimension)
+    if rows == 0:
+        return np.empty((0, dimension), dtype='float32')
+    return np.memmap(raw_file, dtype='<f4', mode='r', shape=(rows, dimension))
+
+
+def sync_raw_vectors(raw_file, index, log_file):
+    """Aligne le fichier brut sur l'index chargé : exactement index.ntotal lignes.
+
+    Lignes en trop (crash avant checkpoint) ou incomplètes : tronquées. Lignes manquantes :
+    reprises du journal (pleine précision), à défaut relues dans l'index (exactes pour un flat,
+    approchées sinon, ex. store antérieur au fichier brut déjà migré en SQ8).
+    """
+    row_size = 4 * index.d
+    size = os.path.getsize(raw_file) if os.path.exists(raw_file) else 0
+    rows = min(size // row_size, index.ntotal)
+    if size != rows * row_size:
+        with open(raw_file, 'r+b') as f:
+            f.truncate(rows * row_size)
+    if rows == index.ntotal:
+        return
+
+    missing = enable_reconstruct(index).reconstruct_n(rows, index.ntotal - rows)
+    for delta in read_deltas(log_file):
+        start, vectors = delta["start_id"], delta["vectors"]
+        lo, hi = max(rows, start), min(index.ntotal, start + len(vectors))
+        if lo < hi:
+            missing[lo - rows:hi - rows] = vectors[lo - start:hi - start]
+    append_raw_vectors(raw_file, missing)
+
+
+def write_checkpoint(index, metadata_store, index_file, log_file):
+    """Checkpoint atomique de l'index (fichier temporaire + os.replace), puis vidage du journal.
+
+    Les métadonnées sont déjà dans la base SQLite, écrites au fil de l'eau : seul le WAL y est reporté.
+    Après un crash avant le remplacement de l'index, load_state tronque la base à index.ntotal
+    et rejoue le journal, encore intact.
+    """
+    metadata_store.checkpoint()
+    faiss.write_index(index, index_file + ".tmp")
+    os.replace(index_file + ".tmp", index_file)
+    # Les entrées déjà couvertes par le checkpoint sont ignorées au rejeu,
+    # un crash avant cette troncature ne duplique donc rien.
+    _fsync_write(log_file, b"")
+
+
+def load_state(index_file, metadata_file, log_file, use_mmap=False, readonly=False):
+    """Charge le dernier checkpoint puis rejoue les deltas du journal qui ne s'y trouvent pas encore.
+
+    Avec use_mmap (lecteurs seulement), l'index est mappé au lieu d'être chargé. Avec readonly (llm-qa, API de recherche),
+    la base de métadonnées n'est pas modifiée : les lignes en avance sur l'index sont seulement masquées,
+    et l'index renvoyé est un LayeredIndex (checkpoint intact + deltas du journal en mémoire).
+    Retourne (index, metadata_store, nombre d'entrées présentes dans le journal).
+    """
+    if use_mmap and not readonly:
+        raise ValueError("use_mmap suppose readonly : un index mappé ne peut pas recevoir le journal")
+    index = read_index(index_file, use_mmap)
+    metadata_store = open_metadata(metadata_file, readonly)
+    del metadata_store[index.ntotal:]
+
+    entries, ntotal, layer = 0, index.ntotal, []
+    for delta in read_deltas(log_file):
+        entries += 1
+        tail = delta_tail(ntotal, delta)
+        if tail is None:
+            print(f"⚠️ Trou dans le journal (id {delta['start_id']}, attendu {ntotal}), rejeu interrompu.")
+            break
+        vectors, records = tail
+        if records:
+            if readonly:
+                layer.append(vectors)
+            else:
+                index.add(vectors)
+            metadata_store.extend(records)
+            ntotal += len(records)
+    if readonly:
+        index = LayeredIndex(index)
+        if layer:
+            index = index.extended(np.concatenate(layer))
+    return index, metadata_store, entries
@@ -0,0 +1,212 @@
+import os
+import time
+import threading
+from datetime import date
+from itertools import islice
+from typing import Optional
+import numpy as np
+from fastapi import FastAPI, HTTPException, Query
+from sentence_transformers import SentenceTransformer
+from persistence import load_state, read_deltas, collect_deltas, checkpoint_exists, open_raw_vectors
+from index_factory import configure_search, index_type_of, QUANTIZED_TYPES
+from metadata_filter import metadata_filters, filtered_search
+from metadata_db import deleted_ids
+
+# API de recherche filtrée (patient, type, dates) sur l'index construit par indexer.py.
+# Lancement : uvicorn search_api:app --port 8003
+app = FastAPI(title="Semantic Indexer - Recherche")
+
+# Mêmes fichiers que l'indexeur (checkpoint + journal de deltas)
+INDEX_FILE = "vector_store.faiss"
+METADATA_FILE = "metadata_store.db"
+LOG_FILE = "vector_store.log"
+RAW_VECTORS_FILE = "vector_store.f32"
+# Période (s) minimale entre deux vérifications du journal de l'indexeur
+INDEX_RELOAD_INTERVAL = float(os.getenv("INDEX_RELOAD_INTERVAL", "5"))
+# Checkpoint mappé en lecture seule (voir persistence.read_index), deltas du journal en mémoire
+INDEX_MMAP = os.getenv("INDEX_MMAP", "true").lower() in ("1", "true", "yes")
+SEARCH_K = int(os.getenv("SEARCH_K", "8"))
+MAX_RESULTS = 100
+# Nombre d'extraits renvoyés par /api/search/patient-snippets
+PATIENT_SNIPPETS_LIMIT = int(os.getenv("PATIENT_SNIPPETS_LIMIT", "20"))
+
+
+class SearchState:
+    """Index, métadonnées et filtres, tenus à jour depuis le checkpoint et le journal de l'indexeur.
+
+    Les filtres sont des requêtes sur la base SQLite (metadata_filters) : rien n'est parcouru au chargement.
+    Comme dans llm-qa, les deltas forment un nouvel index qui partage le checkpoint (LayeredIndex.extended) :
+    les recherches en cours gardent l'ancien, les métadonnées ne reçoivent que des ids qu'il ne connaît pas encore.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.checked_at = 0.0
+        self.load()
+
+    def _signature(self):
+        st = os.stat(INDEX_FILE)
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def _log_size(self):
+        return os.path.getsize(LOG_FILE) if os.path.exists(LOG_FILE) else 0
+
+    def _open_raw_vectors(self, index):
+        # Index quantifié : les distances exactes (scan d'un patient) se calculent sur le fichier brut
+        if index_type_of(index) in QUANTIZED_TYPES:
+            return open_raw_vectors(RAW_VECTORS_FILE, index.d)
+        return None
+
+    def load(self):
+        signature, offset = self._signature(), self._log_size()
+        index, metadata, _ = load_state(INDEX_FILE, METADATA_FILE, LOG_FILE, use_mmap=INDEX_MMAP, readonly=True)
+        self.index = configure_search(index)
+        self.metadata = metadata
+        self.filters = metadata_filters(metadata)
+        # Documents supprimés : vecteurs encore dans l'index, écartés pendant la recherche.
+        # Une suppression réécrit l'index : la liste est relue au rechargement qui suit.
+        self.deleted = deleted_ids(metadata)
+        self.raw_vectors = self._open_raw_vectors(index)
+        self.signature, self.offset = signature, offset
+        print(f"Index chargé ({index.ntotal} vecteurs, {self.filters.patient_count()} patients).")
+
+    def refresh(self):
+        """Recharge tout après une compaction, sinon n'applique que les deltas ajoutés au journal"""
+        if time.monotonic() - self.checked_at < INDEX_RELOAD_INTERVAL:
+            return
+        with self.lock:
+            self.checked_at = time.monotonic()
+            if self._signature() != self.signature:
+                self.load()
+                return
+            deltas = list(read_deltas(LOG_FILE, self.offset))
+            if not deltas:
+                return
+            start = self.index.ntotal
+            batch = collect_deltas(start, deltas)
+            if batch is None:
+                self.load()
+                return
+            vectors, records = batch
+            index = self.index.extended(vectors)
+            # Index construit avant de toucher aux structures partagées ; après un échec à mi-chemin,
+            # seules les positions qui leur manquent encore sont ajoutées (pas de décalage au nouvel essai)
+            self.metadata.extend(records[len(self.metadata) - start:])
+            self.filters.extend(records[len(self.filters) - start:])
+            self.raw_vectors = self._open_raw_vectors(index)
+            self.index = index
+            self.offset = deltas[-1]["end_offset"]
+
+
+model = None
+state = None
+
+
+@app.on_event("startup")
+def startup():
+    global model, state
+    print("Chargement du modèle d'embedding...")
+    model = SentenceTransformer('all-MiniLM-L6-v2')
+    if not checkpoint_exists(INDEX_FILE, METADATA_FILE):
+        raise FileNotFoundError(f"Index introuvable : {INDEX_FILE} (lancer indexer.py d'abord)")
+    state = SearchState()
+
+
+def parse_date(value, name):
+    """Date d'un paramètre de requête ; vide = absente (httpx envoie None sous la forme "from_date=")"""
+    if value is None or not value.strip():
+        return None
+    try:
+        return date.fromisoformat(value.strip())
+    except ValueError:
+        raise HTTPException(status_code=422, detail=f"{name} : date invalide (AAAA-MM-JJ attendue)")
+
+
+def visible_ids(ids, index):
+    # Les filtres peuvent déjà renvoyer des ids ajoutés à un index plus récent
+    if ids is None:
+        return None
+    return ids[:np.searchsorted(ids, index.ntotal)]
+
+
+def snippet(i, distance=None):
+    meta = state.metadata[int(i)]
+    if meta is None: # Document supprimé, vecteur encore dans l'index
+        return None
+    result = {
+        "doc_id": meta["doc_id"],
+        "text": meta["text_content"],
+        "source": meta["source"],
+        "type": meta["type"],
+        "patient_id": meta.get("patient_id"),
+        "doc_type": meta.get("doc_type"),
+        "date": meta.get("date"),
+    }
+    if distance is not None:
+        result["distance"] = float(distance)
+    return result
+
+
+def search_snippets(question, k, **filters):
+    """Recherche vectorielle limitée aux vecteurs qui passent les filtres (patient, type, dates)"""
+    state.refresh()
+    index = state.index
+    ids = visible_ids(state.filters.select(**filters), index)
+    query = model.encode([question])[0]
+    distances, labels = filtered_search(index, query, k, ids, state.raw_vectors, state.deleted)
+    return [result for result in (snippet(i, d) for d, i in zip(distances, labels)) if result is not None]
+
+
+@app.get("/api/search")
+def search(
+    q: str,
+    k: int = Query(SEARCH_K, ge=1, le=MAX_RESULTS),
+    patient_id: Optional[str] = None,
+    doc_type: Optional[str] = None,
+    type: Optional[str] = Query(None, description="knowledge_base ou patient_file"),
+    from_date: Optional[str] = Query(None, description="AAAA-MM-JJ"),
+    to_date: Optional[str] = Query(None, description="AAAA-MM-JJ")
+):
+    """Extraits les plus proches de q, pré-filtrés par patient, type de document et période"""
+    if not q.strip():
+        raise HTTPException(status_code=400, detail="Requête vide")
+    return search_snippets(
+        q, k, patient_id=patient_id, doc_type=doc_type, record_type=type,
+        from_date=parse_date(from_date, "from_date"), to_date=parse_date(to_date, "to_date")
+    )
+
+
+@app.get("/api/search/patient-snippets")
+def patient_snippets(
+    patient_id: str,
+    from_date: Optional[str] = Query(None, description="AAAA-MM-JJ"),
+    to_date: Optional[str] = Query(None, description="AAAA-MM-JJ"),
+    focus: Optional[str] = None,
+    limit: int = Query(PATIENT_SNIPPETS_LIMIT, ge=1, le=MAX_RESULTS)
+):
+    """Extraits du dossier d'un patient (format attendu par le RetrievalClient de synthese-comparative).
+
+    Avec focus : les plus proches du thème ; sans focus : les premiers extraits par ordre chronologique.
+    Le client envoie toujours from_date, to_date et focus : une valeur vide vaut absence de filtre.
+    """
+    from_date, to_date = parse_date(from_date, "from_date"), parse_date(to_date, "to_date")
+    if focus and focus.strip():
+        return search_snippets(focus, limit, patient_id=patient_id, from_date=from_date, to_date=to_date)
+
+    state.refresh()
+    ids = visible_ids(state.filters.select(patient_id=patient_id, from_date=from_date, to_date=to_date), state.index)
+    # Ancien fichier chargé en liste : listes inversées construites avant une suppression, ids encore présents
+    ids = np.setdiff1d(ids, state.deleted, assume_unique=True)
+    dates = [day or "" for day in state.filters.dates_of(ids)]
+    # Tri stable : à date égale, ordre d'indexation (ordre des chunks dans le document)
+    ordered = sorted(range(len(ids)), key=dates.__getitem__)
+    return list(islice(filter(None, (snippet(ids[n]) for n in ordered)), limit))
+
+
+@app.get("/health")
+def health():
+    return {
+        "status": "ok",
+        "vectors": state.index.ntotal,
+        "patients": state.filters.patient_count(),
+    }
@@ -0,0 +1,73 @@
+import unittest
+import sys
+import os
+import tempfile
+
+# Add parent directory to path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from bm25 import BM25Index, load_bm25, reciprocal_rank_fusion, tokenize
+
+TEXTS = [
+    "ANALYSE SCORE MTC : Syndrome 'Vide de Qi'. Plante recommandée : Panax ginseng.",
+    "ANALYSE SCORE MTC : Syndrome 'Stase de Sang'. Plante recommandée : Angelica sinensis.",
+    "DÉTAIL CLINIQUE : Syndrome 'Vide de Yang du Rein'. Plante : Cordyceps sinensis.",
+]
+
+
+class TestBM25(unittest.TestCase):
+
+    def setUp(self):
+        self.bm25 = BM25Index()
+        self.bm25.add(TEXTS)
+
+    def test_tokenize(self):
+        self.assertEqual(tokenize("DÉTAIL : le Vide de Qi"), ["detail", "vide", "qi"])
+
+    def test_exact_latin_name_ranks_first(self):
+        ids, scores = self.bm25.search("angelica sinensis", k=3)
+
+        # "sinensis" seul suffit pour le texte 2, mais "angelica" départage
+        self.assertEqual(ids.tolist(), [1, 2])
+        self.assertGreater(scores[0], scores[1])
+        self.assertEqual(len(self.bm25.search("inconnu", k=3)[0]), 0)
+
+    def test_incremental_add_and_visible_limit(self):
+        self.bm25.add(["Plante : Angelica dahurica."])
+
+        self.assertIn(3, self.bm25.search("angelica", k=5)[0].tolist())
+        # Index FAISS servi plus ancien que le BM25 partagé : position 3 invisible
+        self.assertNotIn(3, self.bm25.search("angelica", k=5, limit=3)[0].tolist())
+
+    def test_load_completes_from_metadata(self):
+        metadata = [{"text_content": text} for text in TEXTS + ["Plante : Angelica dahurica."]]
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "bm25_index.pkl")
+            self.bm25.save(path)
+
+            # Checkpoint en retard d'un texte (rejoué depuis le journal)
+            bm25 = load_bm25(path, metadata)
+            self.assertEqual(len(bm25), 4)
+            self.assertEqual(bm25.search("dahurica", k=1)[0].tolist(), [3])
+
+            # Plus de textes que de métadonnées : tronqué
+            bm25 = load_bm25(path, metadata[:2])
+            self.assertEqual(bm25.search("cordyceps", k=1)[0].tolist(), [])
+
+    def test_reciprocal_rank_fusion(self):
+        # 7 est bien classé par les deux moteurs, il passe devant les premiers de chaque liste
+        self.assertEqual(reciprocal_rank_fusion([[1, 7, 3], [2, 7, 4]], k=2)[0], 7)
+        self.assertEqual(reciprocal_rank_fusion([[1], []], k=5), [1])
+
+
+    def test_remove_deleted_texts(self):
+        self.bm25.remove([1])
+
+        # Ids conservés (positions FAISS), termes du texte supprimé introuvables
+        self.assertEqual(len(self.bm25), 3)
+        self.assertEqual(self.bm25.search("angelica", k=3)[0].tolist(), [])
+        self.assertEqual(self.bm25.search("sinensis", k=3)[0].tolist(), [2])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+import unittest
+import sys
+import os
+
+# Add parent directory to path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from chunking import sentence_chunks, fixed_chunks, get_chunker, iter_sentences
+
+# Un token par mot : budget facile à vérifier
+count_words = lambda text: len(text.split())
+
+TEXT = (
+    "Patient de 54 ans. Fatigue chronique depuis trois mois.\n\n"
+    "Pouls faible et profond. Langue pâle avec enduit blanc. "
+    "Conclusion : Vide de Qi de la Rate."
+)
+
+class TestChunking(unittest.TestCase):
+
+    def test_iter_sentences(self):
+        self.assertEqual(list(iter_sentences(TEXT)), [
+            "Patient de 54 ans.",
+            "Fatigue chronique depuis trois mois.",
+            "Pouls faible et profond.",
+            "Langue pâle avec enduit blanc.",
+            "Conclusion : Vide de Qi de la Rate.",
+        ])
+
+    def test_sentence_chunks_respect_budget_without_cutting_words(self):
+        chunks = list(sentence_chunks(TEXT, count_tokens=count_words, max_tokens=10, overlap_tokens=0))
+
+        self.assertEqual(chunks[0], "Patient de 54 ans. Fatigue chronique depuis trois mois.")
+        for chunk in chunks:
+            self.assertLessEqual(count_words(chunk), 10)
+        self.assertEqual(" ".join(chunks).split(), TEXT.split())
+
+    def test_overlap_repeats_last_sentence(self):
+        chunks = list(sentence_chunks(TEXT, count_tokens=count_words, max_tokens=12, overlap_tokens=5))
+
+        self.assertTrue(chunks[1].startswith("Fatigue chronique depuis trois mois."))
+        for chunk in chunks:
+            self.assertLessEqual(count_words(chunk), 12)
+
+    def test_long_sentence_split_between_words(self):
+        sentence = " ".join(f"mot{i}" for i in range(25)) + "."
+
+        chunks = list(sentence_chunks(sentence, count_tokens=count_words, max_tokens=10, overlap_tokens=0))
+
+        self.assertEqual([count_words(c) for c in chunks], [10, 10, 5])
+
+    def test_get_chunker(self):
+        self.assertIs(get_chunker("fixed"), fixed_chunks)
+        self.assertEqual(list(fixed_chunks("a" * 600)), ["a" * 500, "a" * 100])
+        with self.assertRaises(ValueError):
+            get_chunker("inconnu")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+import unittest
+from unittest.mock import MagicMock, patch
+import sys
+import os
+from types import SimpleNamespace
+import numpy as np
+
+# Add parent directory to path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import index_factory
+
+
+def fake_index(class_name, ntotal):
+    """Objet dont le nom de classe imite celui renvoyé par faiss.read_index"""
+    return type(class_name, (), {"ntotal": ntotal})()
+
+
+class TestIndexFactory(unittest.TestCase):
+
+    def test_index_type_of(self):
+        self.assertEqual(index_factory.index_type_of(fake_index("IndexFlatL2", 0)), "flat")
+        self.assertEqual(index_factory.index_type_of(fake_index("IndexHNSWFlat", 0)), "hnsw")
+        self.assertEqual(index_factory.index_type_of(fake_index("IndexIVFPQ", 0)), "ivf_pq")
+
+    def test_factory_string_bounds_nlist(self):
+        # Peu de vecteurs : nlist réduit pour garder ~39 points par centroïde
+        self.assertEqual(index_factory._factory_string("ivf_flat", 3900), "IVF100,Flat")
+        self.assertEqual(index_factory._factory_string("ivf_pq", 10), f"IVF1,PQ{index_factory.PQ_M}")
+        self.assertEqual(index_factory._factory_string("hnsw", 10), f"HNSW{index_factory.HNSW_M}")
+        self.assertEqual(index_factory._factory_string("sq8", 10), "SQ8")
+        self.assertEqual(index_factory._factory_string("fp16", 10), "SQfp16")
+        with self.assertRaises(ValueError):
+            index_factory._factory_string("annoy", 10)
+
+    def test_needs_migration(self):
+        small_flat = fake_index("IndexFlatL2", 10)
+        big_flat = fake_index("IndexFlatL2", index_factory.MIN_TRAIN_VECTORS)
+
+        self.assertFalse(index_factory.needs_migration(small_flat, "flat"))
+        self.assertTrue(index_factory.needs_migration(small_flat, "hnsw"))
+        # IVF : on attend d'avoir assez de vecteurs pour entraîner les centroïdes
+        self.assertFalse(index_factory.needs_migration(small_flat, "ivf_flat"))
+        self.assertTrue(index_factory.needs_migration(big_flat, "ivf_flat"))
+        # Type inconnu (ex. index mocké) : jamais migré
+        self.assertFalse(index_factory.needs_migration(MagicMock(), "hnsw"))
+        # Quantification scalaire : pas de seuil d'entraînement
+        self.assertTrue(index_factory.needs_migration(small_flat, "sq8"))
+
+    def test_needs_migration_retrains_outgrown_ivf(self):
+        # IVF entraîné à MIN_TRAIN_VECTORS vecteurs : 25 listes
+        nlist = index_factory.MIN_TRAIN_VECTORS // 39
+        with patch.object(index_factory.faiss, "extract_index_ivf", return_value=SimpleNamespace(nlist=nlist)):
+            self.assertFalse(index_factory.needs_migration(fake_index("IndexIVFFlat", 2 * index_factory.MIN_TRAIN_VECTORS), "ivf_flat"))
+            # Corpus assez grand pour 4 fois plus de listes : réentraînement
+            grown = fake_index("IndexIVFFlat", 39 * nlist * index_factory.IVF_RETRAIN_GROWTH)
+            self.assertTrue(index_factory.needs_migration(grown, "ivf_flat"))
+        # Déjà au plafond IVF_NLIST : plus de réentraînement
+        with patch.object(index_factory.faiss, "extract_index_ivf", return_value=SimpleNamespace(nlist=index_factory.IVF_NLIST)):
+            self.assertFalse(index_factory.needs_migration(fake_index("IndexIVFPQ", 10 ** 8), "ivf_pq"))
+
+    def test_rerank_uses_full_precision_vectors(self):
+        raw = np.array([[0, 0], [1, 0], [3, 0], [2, 0]], dtype='float32')
+
+        # Ordre approché de l'index : 2, 3, 1 ; ordre exact : 1, 3, 2
+        self.assertEqual(index_factory.rerank(raw, [1.1, 0], [2, 3, 1], k=2), [1, 3])
+        # Candidat absent du fichier brut : ordre de l'index conservé
+        self.assertEqual(index_factory.rerank(raw, [1.1, 0], [2, 3, 9], k=2), [2, 3])
+    def test_layered_index_matches_single_index(self):
+        rng = np.random.default_rng(0)
+        vectors = rng.random((60, 8), dtype='float32')
+        queries = rng.random((3, 8), dtype='float32')
+        base = index_factory.faiss.IndexFlatL2(8)
+        base.add(vectors[:40])
+        reference = index_factory.faiss.IndexFlatL2(8)
+        reference.add(vectors)
+
+        layered = index_factory.LayeredIndex(base).extended(vectors[40:50])
+        extended = layered.extended(vectors[50:])
+        # Le nouvel index partage la base ; l'ancien ne voit pas les derniers vecteurs
+        self.assertIs(extended.base, base)
+        self.assertEqual((base.ntotal, layered.ntotal, extended.ntotal), (40, 50, 60))
+
+        distances, labels = extended.search(queries, 5)
+        expected_distances, expected_labels = reference.search(queries, 5)
+        np.testing.assert_array_equal(labels, expected_labels)
+        np.testing.assert_allclose(distances, expected_distances, rtol=1e-4, atol=1e-4)
+        np.testing.assert_array_equal(extended.reconstruct_batch([3, 45, 59]), vectors[[3, 45, 59]])
+
+    def test_layered_index_applies_selector_to_delta(self):
+        vectors = np.arange(12, dtype='float32').reshape(6, 2)
+        base = index_factory.faiss.IndexFlatL2(2)
+        base.add(vectors[:3])
+        layered = index_factory.LayeredIndex(base).extended(vectors[3:])
+        excluded = index_factory.faiss.IDSelectorBatch(np.array([1, 4], dtype='int64'))
+        params = index_factory.faiss.SearchParameters(sel=index_factory.faiss.IDSelectorNot(excluded))
+
+        D = np.empty((1, 6), dtype='float32')
+        I = np.empty((1, 6), dtype='int64')
+        layered.search(vectors[4:5], 6, params=params, D=D, I=I)
+        # Ids exclus écartés dans la base comme dans la couche, places vides (-1) en dernier
+        self.assertEqual(I[0].tolist(), [3, 5, 2, 0, -1, -1])
+
+if __name__ == '__main__':
+    unittest.main()
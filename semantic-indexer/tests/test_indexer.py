@@ -2,6 +2,8 @@ import unittest
 from unittest.mock import MagicMock, patch
 import sys
 import os
+import json
+import tempfile
 import numpy as np
 
 # Add parent directory to path
@@ -19,18 +21,28 @@ sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')
 sys.modules['sentence_transformers'] = MagicMock()
 sys.modules['faiss'] = MagicMock()
 
-# Now import the module under test
+# Now import the module under test (le store n'est chargé que par load_store(), au lancement du script)
 import indexer
+from metadata_db import MetadataStore
 
 class TestIndexer(unittest.TestCase):
 
     def setUp(self):
         # Reset global variables in indexer module for each test
         indexer.index = None
-        indexer.metadata_store = []
+        # Base SQLite comme en production : la déduplication y interroge les empreintes des chunks
+        self.tmp = tempfile.TemporaryDirectory()
+        self.store = indexer.metadata_store = MetadataStore(os.path.join(self.tmp.name, "metadata_store.db"))
+        indexer.pending_vectors = []
+        indexer.log_entries = 0
+        indexer.bm25 = indexer.BM25Index()
         # Mock the model instance already created in indexer
         indexer.model = MagicMock()
 
+    def tearDown(self):
+        self.store.close()
+        self.tmp.cleanup()
+
     def test_add_to_index(self):
         # Setup
         text = "Test sentence"
@@ -45,7 +57,7 @@ class TestIndexer(unittest.TestCase):
         indexer.add_to_index(text, source)
         
         # Verify
-        indexer.model.encode.assert_called_with([text])
+        indexer.model.encode.assert_called_with([text], batch_size=indexer.EMBED_BATCH_SIZE)
         indexer.faiss.IndexFlatL2.assert_called_once() # Should be called to create index
         mock_faiss_index.add.assert_called_once()
         
@@ -58,5 +70,187 @@ class TestIndexer(unittest.TestCase):
         indexer.add_to_index("   ", "source")
         self.assertEqual(len(indexer.metadata_store), 0)
 
+    def test_add_batch_to_index_single_add(self):
+        texts = ["chunk 1", "   ", "chunk 2", "chunk 3"]
+        indexer.model.encode.return_value = np.zeros((3, 384))
+        mock_faiss_index = MagicMock()
+        indexer.index = mock_faiss_index
+
+        indexer.add_batch_to_index(texts, "Dossier Patient 1", "patient_file")
+
+        # Les textes vides sont ignorés, le reste est encodé en un seul appel
+        indexer.model.encode.assert_called_once_with(["chunk 1", "chunk 2", "chunk 3"], batch_size=indexer.EMBED_BATCH_SIZE)
+        mock_faiss_index.add.assert_called_once()
+        self.assertEqual(mock_faiss_index.add.call_args[0][0].shape, (3, 384))
+        self.assertEqual([m['text_content'] for m in indexer.metadata_store], ["chunk 1", "chunk 2", "chunk 3"])
+        self.assertTrue(all(m['type'] == "patient_file" for m in indexer.metadata_store))
+        # Index BM25 mis à jour au même rythme que FAISS
+        self.assertEqual(sorted(indexer.bm25.search("chunk", k=5)[0].tolist()), [0, 1, 2])
+
+    @patch('indexer.KEEP_RAW_VECTORS', True)
+    @patch('indexer.append_raw_vectors')
+    @patch('indexer.append_delta')
+    @patch('indexer.save_state')
+    def test_persist_delta_appends_only_new_vectors(self, mock_save_state, mock_append_delta, mock_append_raw):
+        indexer.metadata_store = [{"text_content": "ancien"}, {"text_content": "nouveau"}]
+        indexer.pending_vectors = [np.ones((1, 384), dtype='float32')]
+
+        indexer.persist_delta()
+
+        args = mock_append_delta.call_args[0]
+        self.assertEqual(args[1], 1) # start_id = position du premier nouveau vecteur
+        self.assertEqual(args[2].shape, (1, 384))
+        self.assertEqual(args[3], [{"text_content": "nouveau"}])
+        # Mêmes vecteurs, pleine précision, dans le fichier brut
+        self.assertIs(mock_append_raw.call_args[0][1], args[2])
+        self.assertEqual(indexer.pending_vectors, [])
+        mock_save_state.assert_not_called()
+
+    @patch('indexer.append_raw_vectors')
+    @patch('indexer.append_delta')
+    @patch('indexer.save_state')
+    def test_persist_delta_compacts_periodically(self, mock_save_state, mock_append_delta, mock_append_raw):
+        indexer.metadata_store = [{"text_content": "x"}]
+        indexer.pending_vectors = [np.ones((1, 384), dtype='float32')]
+        indexer.log_entries = indexer.COMPACT_EVERY - 1
+
+        indexer.persist_delta()
+
+        mock_save_state.assert_called_once()
+
+    @patch('indexer.CHUNK_MAX_TOKENS', 8)
+    @patch('indexer.CHUNK_OVERLAP_TOKENS', 0)
+    @patch('indexer.persist_delta')
+    def test_handle_batch_single_encode_and_multiple_ack(self, mock_persist_delta):
+        indexer.model.encode.return_value = np.zeros((3, 384))
+        indexer.model.tokenizer.tokenize.side_effect = str.split
+        indexer.index = MagicMock()
+        channel = MagicMock()
+        deliveries = [
+            (MagicMock(delivery_tag=1), json.dumps({"doc_id": 1, "original_text_masked": "Pouls faible et rapide. Langue pâle, enduit blanc épais."})),
+            (MagicMock(delivery_tag=2), "pas du json"),
+            (MagicMock(delivery_tag=3), json.dumps({"doc_id": 3, "original_text_masked": "b" * 10})),
+        ]
+
+        indexer.handle_batch(channel, deliveries)
+
+        # 2 chunks pour le doc 1 + 1 chunk pour le doc 3, encodés en un seul appel
+        indexer.model.encode.assert_called_once()
+        self.assertEqual(len(indexer.model.encode.call_args[0][0]), 3)
+        mock_persist_delta.assert_called_once()
+        channel.basic_nack.assert_called_once_with(delivery_tag=2, requeue=False)
+        channel.basic_ack.assert_called_once_with(delivery_tag=3, multiple=True)
+        self.assertEqual(indexer.metadata_store[-1]['source'], "Dossier Patient 3")
+
+    def test_patient_records_carry_filter_fields(self):
+        indexer.model.tokenizer.tokenize.side_effect = str.split
+        message = {
+            "doc_id": 7,
+            "original_text_masked": "Pouls faible.",
+            "metadata": {"patient_id": "P42", "type": "ordonnance", "date": "2024-05-02"}
+        }
+
+        record = indexer.patient_records(message)[0]
+
+        self.assertEqual(
+            {key: record[key] for key in ("doc_id", "patient_id", "doc_type", "date", "type")},
+            {"doc_id": "7", "patient_id": "P42", "doc_type": "ordonnance", "date": "2024-05-02", "type": "patient_file"}
+        )
+        # Sans patient_id, le document constitue le dossier du patient
+        message["metadata"] = {}
+        self.assertEqual(indexer.patient_records(message)[0]["patient_id"], "7")
+
+    def test_duplicate_chunks_not_reembedded(self):
+        indexer.model.encode.side_effect = lambda texts, batch_size: np.ones((len(texts), 3))
+        indexer.faiss.IndexFlatL2.return_value = MagicMock()
+
+        indexer.add_batch_to_index(["Pouls faible.", "Langue  pâle.", "Pouls faible."], "Dossier Patient 1")
+        # Redélivrance du même message : rien n'est réencodé
+        indexer.add_batch_to_index(["Pouls faible.", "Langue pâle."], "Dossier Patient 1")
+        # Même texte, autre document : conservé avec la portée "source"
+        indexer.add_batch_to_index(["Pouls faible."], "Dossier Patient 2")
+
+        self.assertEqual(indexer.model.encode.call_count, 2)
+        self.assertEqual([m["source"] for m in indexer.metadata_store],
+                         ["Dossier Patient 1", "Dossier Patient 1", "Dossier Patient 2"])
+
+    @patch('indexer.save_state')
+    def test_delete_document(self, mock_save_state):
+        indexer.model.encode.side_effect = lambda texts, batch_size: np.ones((len(texts), 3))
+        indexer.index = MagicMock()
+        indexer.index_records(indexer.make_records(["Pouls faible.", "Langue pâle."], "Dossier Patient 7", "patient_file", doc_id="7"))
+        indexer.add_batch_to_index(["Vide de Qi."], "matrice.csv")
+
+        self.assertEqual(indexer.delete_document(7), 2)
+
+        # Un seul checkpoint, une fois les suppressions appliquées
+        mock_save_state.assert_called_once()
+        self.assertEqual([r and r["source"] for r in indexer.metadata_store], [None, None, "matrice.csv"])
+        self.assertEqual(indexer.bm25.search("pouls", k=5)[0].tolist(), [])
+        # Réindexation possible
+        indexer.index_records(indexer.make_records(["Pouls faible."], "Dossier Patient 7", "patient_file", doc_id="7"))
+        self.assertEqual(indexer.metadata_store.ids_where(doc_id="7"), [3])
+        # Document inconnu : pas de réécriture de l'index
+        self.assertEqual(indexer.delete_document("inconnu"), 0)
+        mock_save_state.assert_called_once()
+
+    @patch('blob_store.CLAIM_CHECK_THRESHOLD', 16)
+    @patch('indexer.persist_delta')
+    def test_handle_batch_reads_and_releases_claim_check(self, mock_persist_delta):
+        from blob_store import pack_text, unpack_text
+        indexer.model.encode.side_effect = lambda texts, batch_size: np.ones((len(texts), 3))
+        indexer.model.tokenizer.tokenize.side_effect = str.split
+        indexer.index = MagicMock()
+        channel = MagicMock()
+        with tempfile.TemporaryDirectory() as tmp, patch('blob_store.BLOB_STORE_DIR', tmp):
+            message = {"doc_id": 5, **pack_text("original_text_masked", "Pouls faible et rapide.")}
+
+            indexer.handle_batch(channel, [(MagicMock(delivery_tag=1), json.dumps(message))])
+
+            self.assertEqual(indexer.metadata_store[0]["text_content"], "Pouls faible et rapide.")
+            channel.basic_ack.assert_called_once_with(delivery_tag=1, multiple=True)
+            # Blob supprimé une fois le message acquitté
+            with self.assertRaises(FileNotFoundError):
+                unpack_text(message, "original_text_masked")
+
+    @patch('indexer.persist_delta')
+    @patch('indexer.delete_document')
+    @patch('indexer.index_records')
+    def test_handle_batch_applies_deletions_in_order(self, mock_index_records, mock_delete_document, mock_persist_delta):
+        calls = MagicMock()
+        calls.attach_mock(mock_index_records, "index_records")
+        calls.attach_mock(mock_delete_document, "delete_document")
+        indexer.model.tokenizer.tokenize.side_effect = str.split
+        channel = MagicMock()
+        deliveries = [
+            (MagicMock(delivery_tag=1), json.dumps({"doc_id": 7, "original_text_masked": "Pouls faible."})),
+            (MagicMock(delivery_tag=2), json.dumps({"action": "delete", "doc_id": 7})),
+            (MagicMock(delivery_tag=3), json.dumps({"doc_id": 7, "original_text_masked": "Langue pâle."})),
+        ]
+
+        indexer.handle_batch(channel, deliveries)
+
+        # Chunks reçus avant la suppression indexés d'abord, ceux reçus après conservés
+        self.assertEqual([c[0] for c in calls.mock_calls], ["index_records", "delete_document", "index_records"])
+        self.assertEqual(mock_delete_document.call_args[0][0], "7")
+        self.assertEqual([r["text_content"] for r in mock_index_records.call_args_list[1][0][0]], ["Langue pâle."])
+        channel.basic_ack.assert_called_once_with(delivery_tag=3, multiple=True)
+
+
+    @patch('indexer.delete_document')
+    @patch('indexer.pika.BlockingConnection')
+    def test_request_delete_publishes_to_consumer(self, mock_connection, mock_delete_document):
+        channel = mock_connection.return_value.channel.return_value
+
+        indexer.request_delete(7)
+
+        # Le CLI n'écrit pas le store : la suppression passe par la queue du consommateur
+        mock_delete_document.assert_not_called()
+        kwargs = channel.basic_publish.call_args.kwargs
+        self.assertEqual(kwargs["routing_key"], indexer.INPUT_QUEUE)
+        self.assertEqual(json.loads(kwargs["body"]), {"action": "delete", "doc_id": "7"})
+        mock_connection.return_value.close.assert_called_once()
+
+
 if __name__ == '__main__':
     unittest.main()
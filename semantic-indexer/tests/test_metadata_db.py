@@ -0,0 +1,148 @@
+import unittest
+import sys
+import os
+import sqlite3
+import tempfile
+
+# Add parent directory to path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from metadata_db import MetadataStore, text_hash
+
+
+def record(i, doc_id="KB_MTC", **fields):
+    return {"doc_id": doc_id, "text_content": f"Syndrome 'Vide de Qi' n°{i}", "source": "src", "type": "knowledge_base", **fields}
+
+
+class TestMetadataStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "metadata_store.db")
+        self.store = MetadataStore(self.path)
+
+    def tearDown(self):
+        self.store.close()
+        self.tmp.cleanup()
+
+    def test_list_protocol(self):
+        records = [record(0), record(1, "7", patient_id="7", date="2024-05-02", page=3), record(2)]
+        self.store.extend(records)
+
+        self.assertEqual(len(self.store), 3)
+        self.assertEqual(self.store[1], records[1]) # Champ hors colonnes (page) conservé
+        self.assertEqual(self.store[-1], records[2])
+        self.assertEqual(self.store[1:], records[1:])
+        self.assertEqual(list(self.store), records)
+        with self.assertRaises(IndexError):
+            self.store[3]
+
+        # Troncature (load_state) puis ajout à la suite
+        del self.store[1:]
+        self.store.extend([record(9)])
+        self.assertEqual([r["text_content"] for r in self.store], [records[0]["text_content"], record(9)["text_content"]])
+
+    def test_ids_where_and_delete(self):
+        self.store.extend([record(0), record(1, "7"), record(2, "7"), record(3, "8")])
+
+        self.assertEqual(self.store.ids_where(doc_id="7"), [1, 2])
+        # doc_id entier d'un ancien store : même valeur que sa forme texte
+        self.assertEqual(self.store.ids_where(doc_id=8), [3])
+        self.assertEqual(self.store.ids_where(type="knowledge_base", doc_id="KB_MTC"), [0])
+
+        self.store.delete([1, 2])
+
+        # Les ids restent réservés (positions FAISS), les enregistrements ne sont plus renvoyés
+        self.assertEqual(len(self.store), 4)
+        self.assertIsNone(self.store[1])
+        self.assertEqual(self.store.get_many([3, 2]), [self.store[3], None])
+        self.assertEqual(self.store.ids_where(doc_id="7"), [])
+        self.assertEqual(self.store.deleted_ids().tolist(), [1, 2])
+        with self.assertRaises(ValueError):
+            self.store.ids_where(text_content="x")
+
+    def test_reader_sees_only_its_index(self):
+        self.store.extend([record(0), record(1)])
+        reader = MetadataStore(self.path, readonly=True)
+        del reader[1:] # Index du lecteur plus ancien que la base
+
+        self.store.extend([record(2)])
+        # Delta relu depuis le journal : lignes déjà présentes dans la base
+        reader.extend([record(1), record(2)])
+
+        self.assertEqual(len(reader), 3)
+        self.assertEqual(reader[2], record(2))
+        self.assertEqual(len(MetadataStore(self.path)), 3)
+        with self.assertRaises(PermissionError):
+            reader.delete([0])
+        reader.close()
+
+    def test_compressed_text(self):
+        records = [record(i) for i in range(50)]
+        plain = MetadataStore(os.path.join(self.tmp.name, "plain.db"), compression="none")
+        plain.extend(records)
+        plain.checkpoint()
+        compressed = MetadataStore(os.path.join(self.tmp.name, "zlib.db"), compression="zlib")
+        compressed.extend(records)
+        compressed.checkpoint()
+
+        # Dictionnaire conservé dans la base : relu à la réouverture
+        reopened = MetadataStore(compressed.path, readonly=True)
+        self.assertEqual(list(reopened), records)
+        self.assertIsInstance(compressed._db().execute("SELECT text_content FROM chunks").fetchone()[0], bytes)
+        for store in (plain, compressed, reopened):
+            store.close()
+
+    def test_reader_opened_before_compression(self):
+        # Lecteur ouvert sur une base encore sans dictionnaire (base MTC vide, compression activée ensuite)
+        reader = MetadataStore(self.path, readonly=True)
+        writer = MetadataStore(self.path, compression="zlib")
+        records = [record(i) for i in range(20)]
+        writer.extend(records)
+
+        reader.extend(records) # Delta relu depuis le journal
+        self.assertEqual(reader[3], records[3])
+        self.assertEqual(reader.get_many([0, 19]), [records[0], records[19]])
+        for store in (reader, writer):
+            store.close()
+
+    def test_ids_where_date_bounds(self):
+        self.store.extend([record(0), record(1, "7", date="2024-01-15"), record(2, "7", date="2024-03-01"), record(3, "8", date="2024-03-01")])
+
+        # Bornes incluses ; sans date, exclus dès qu'une borne est donnée
+        self.assertEqual(self.store.ids_where(from_date="2024-01-15", to_date="2024-03-01", doc_id="7"), [1, 2])
+        self.assertEqual(self.store.ids_where(to_date="2024-02-01"), [1])
+        self.assertEqual(self.store.dates_of([3, 0, 1]), ["2024-03-01", None, "2024-01-15"])
+
+        # Lecteur : enregistrements du journal absents de la base, filtrés en mémoire
+        reader = MetadataStore(self.path, readonly=True)
+        reader.extend([record(4, "7", date="2024-02-10")])
+        self.assertEqual(reader.ids_where(doc_id="7", from_date="2024-02-01"), [2, 4])
+        self.assertEqual(reader.dates_of([4]), ["2024-02-10"])
+        reader.close()
+
+    def test_indexed_chunks(self):
+        self.store.extend([record(0), record(1, "7"), {**record(2, "8"), "source": "autre"}])
+        self.store.delete([1])
+
+        # Même texte aux espaces près ; les chunks supprimés ne comptent plus
+        hashes = [text_hash("Syndrome  'Vide de Qi' n°0 "), text_hash(record(1)["text_content"]), text_hash(record(2)["text_content"])]
+        self.assertEqual(self.store.indexed_chunks(hashes), {(hashes[0], "src"), (hashes[2], "autre")})
+
+    def test_text_hash_backfilled_on_old_database(self):
+        path = os.path.join(self.tmp.name, "old.db")
+        db = sqlite3.connect(path)
+        db.executescript("""
+            CREATE TABLE chunks (id INTEGER PRIMARY KEY, doc_id TEXT, source TEXT, type TEXT, patient_id TEXT,
+                                 doc_type TEXT, date TEXT, text_content, extra TEXT, deleted INTEGER NOT NULL DEFAULT 0);
+            INSERT INTO chunks (id, doc_id, source, type, text_content) VALUES (0, 'KB_MTC', 'src', 'knowledge_base', 'Vide de Qi');
+        """)
+        db.close()
+
+        store = MetadataStore(path)
+        self.assertEqual(store.indexed_chunks([text_hash("Vide de Qi")]), {(text_hash("Vide de Qi"), "src")})
+        store.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
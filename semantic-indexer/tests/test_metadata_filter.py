@@ -0,0 +1,134 @@
+import unittest
+from unittest.mock import patch
+import sys
+import os
+import tempfile
+from datetime import date
+import numpy as np
+
+# Add parent directory to path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from metadata_filter import MetadataIndex, StoreFilters, metadata_filters, filtered_search
+from metadata_db import MetadataStore
+
+
+class IndexFlatL2:
+    """Index exact minimal (même nom de classe que faiss) pour tester la recherche filtrée sans faiss"""
+
+    def __init__(self, vectors):
+        self.vectors = np.asarray(vectors, dtype='float32')
+        self.ntotal = len(self.vectors)
+        self.searched = False
+
+    def reconstruct_batch(self, ids):
+        return self.vectors[ids]
+
+    def search(self, query, k, params=None):
+        self.searched = True
+        scores = ((self.vectors - query) ** 2).sum(axis=1)
+        top = np.argsort(scores)[:k]
+        return scores[top][None, :], top[None, :]
+
+
+RECORDS = [
+    {"doc_id": "KB_MTC", "type": "knowledge_base"},
+    {"doc_id": "1", "patient_id": "P1", "doc_type": "ordonnance", "type": "patient_file", "date": "2024-01-10"},
+    {"doc_id": "2", "patient_id": "P2", "doc_type": "ordonnance", "type": "patient_file", "date": "2024-02-01"},
+    {"doc_id": "3", "patient_id": "P1", "doc_type": "compte-rendu", "type": "patient_file", "date": "2024-03-15"},
+    {"doc_id": "3", "patient_id": "P1", "doc_type": "compte-rendu", "type": "patient_file", "date": "2024-03-15"},
+]
+
+
+class TestMetadataFilter(unittest.TestCase):
+
+    def setUp(self):
+        self.filters = MetadataIndex(RECORDS)
+
+    def test_select_by_key(self):
+        self.assertIsNone(self.filters.select())
+        self.assertEqual(self.filters.select(patient_id="P1").tolist(), [1, 3, 4])
+        self.assertEqual(self.filters.select(patient_id="P1", doc_type="ordonnance").tolist(), [1])
+        self.assertEqual(self.filters.select(record_type="knowledge_base").tolist(), [0])
+        self.assertEqual(self.filters.select(patient_id="inconnu").tolist(), [])
+
+    def test_select_by_date_range(self):
+        ids = self.filters.select(patient_id="P1", from_date=date(2024, 2, 1), to_date="2024-03-15")
+        self.assertEqual(ids.tolist(), [3, 4])
+        # Sans autre filtre, les vecteurs sans date (base MTC) sont exclus
+        self.assertEqual(self.filters.select(to_date="2024-02-01").tolist(), [1, 2])
+
+    def test_extend_continues_ids(self):
+        self.filters.extend([{"doc_id": "4", "patient_id": "P2", "date": "2024-04-01"}])
+        self.assertEqual(self.filters.select(patient_id="P2").tolist(), [2, 5])
+
+    def test_store_filters_match_inverted_lists(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            store = MetadataStore(os.path.join(tmp, "metadata_store.db"))
+            store.extend([{"text_content": "", "source": "src", **record} for record in RECORDS])
+            filters = metadata_filters(store)
+            self.assertIsInstance(filters, StoreFilters)
+
+            for query in ({}, {"patient_id": "P1"}, {"patient_id": "P1", "doc_type": "ordonnance"},
+                          {"record_type": "knowledge_base"}, {"patient_id": "inconnu"},
+                          {"patient_id": "P1", "from_date": date(2024, 2, 1), "to_date": "2024-03-15"},
+                          {"to_date": "2024-02-01"}):
+                expected = self.filters.select(**query)
+                found = filters.select(**query)
+                self.assertEqual(None if found is None else found.tolist(), None if expected is None else expected.tolist())
+            self.assertEqual(filters.dates_of([2, 0]), self.filters.dates_of([2, 0]))
+            self.assertEqual(filters.patient_count(), self.filters.patient_count())
+            store.close()
+
+    def test_filtered_search_only_reads_candidates(self):
+        vectors = np.eye(5, dtype='float32')
+        index = IndexFlatL2(vectors)
+        ids = self.filters.select(patient_id="P1")
+
+        distances, labels = filtered_search(index, vectors[2], k=2, ids=ids)
+
+        # Le vecteur 2 (patient P2) est le plus proche mais hors filtre
+        self.assertEqual(len(labels), 2)
+        self.assertTrue(set(labels.tolist()) <= {1, 3, 4})
+        self.assertFalse(index.searched)
+        self.assertEqual(distances.tolist(), [2.0, 2.0])
+
+    def test_filtered_search_without_filter_or_match(self):
+        index = IndexFlatL2(np.eye(5, dtype='float32'))
+
+        _, labels = filtered_search(index, np.eye(5)[2], k=1)
+        self.assertEqual(labels.tolist(), [2])
+
+        _, labels = filtered_search(index, np.eye(5)[2], k=1, ids=np.array([], dtype='int64'))
+        self.assertEqual(labels.tolist(), [])
+
+    @patch('metadata_filter.EXACT_SCAN_MAX_IDS', 1)
+    @patch('metadata_filter._search_parameters')
+    def test_large_candidate_list_uses_selector(self, mock_params):
+        index = IndexFlatL2(np.eye(5, dtype='float32'))
+        with patch.object(index, 'search', return_value=(np.array([[0.0, 2.0]]), np.array([[3, -1]]))) as mock_search:
+            distances, labels = filtered_search(index, np.eye(5)[3], k=2, ids=np.array([1, 3, 4]))
+
+        mock_search.assert_called_once()
+        self.assertIs(mock_search.call_args.kwargs["params"], mock_params.return_value)
+        self.assertEqual(labels.tolist(), [3])
+
+
+    @patch('metadata_filter.exclusion_parameters')
+    def test_deleted_ids_excluded_during_search(self, mock_exclusion):
+        index = IndexFlatL2(np.eye(5, dtype='float32'))
+        deleted = np.array([3], dtype='int64')
+
+        # Avec filtre : ids supprimés retirés des candidats avant le scan
+        _, labels = filtered_search(index, np.eye(5)[3], k=3, ids=self.filters.select(patient_id="P1"), excluded=deleted)
+        self.assertEqual(sorted(labels.tolist()), [1, 4])
+
+        # Sans filtre : sélecteur passé à la recherche FAISS (k résultats malgré les suppressions)
+        with patch.object(index, 'search', return_value=(np.array([[2.0]]), np.array([[4]]))) as mock_search:
+            filtered_search(index, np.eye(5)[3], k=1, excluded=deleted)
+        mock_exclusion.assert_called_once_with(index, deleted)
+        self.assertIs(mock_search.call_args.kwargs["params"], mock_exclusion.return_value)
+
+
+if __name__ == '__main__':
+    unittest.main()
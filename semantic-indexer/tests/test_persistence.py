@@ -0,0 +1,255 @@
+import unittest
+from unittest.mock import patch
+import sys
+import os
+import pickle
+import sqlite3
+import tempfile
+import numpy as np
+
+# Add parent directory to path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import persistence
+import index_factory
+from metadata_db import MetadataStore
+
+
+class FakeIndex:
+    """Index minimal (ntotal + add) pour tester le rejeu sans dépendre de faiss"""
+
+    def __init__(self, ntotal=0, d=3):
+        self.ntotal = ntotal
+        self.d = d
+        self.added = []
+
+    def add(self, vectors):
+        self.added.append(vectors)
+        self.ntotal += len(vectors)
+
+
+def meta(i):
+    return {"doc_id": str(i), "text_content": f"chunk {i}", "source": "src", "type": "patient_file"}
+
+
+class TestPersistence(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.index_file = os.path.join(self.tmp.name, "vector_store.faiss")
+        self.metadata_file = os.path.join(self.tmp.name, "metadata_store.db")
+        self.log_file = os.path.join(self.tmp.name, "vector_store.log")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write_metadata(self, records):
+        store = MetadataStore(self.metadata_file)
+        store.extend(records)
+        store.close()
+
+    def test_read_deltas_ignores_torn_tail(self):
+        persistence.append_delta(self.log_file, 0, np.zeros((2, 4)), [meta(0), meta(1)])
+        persistence.append_delta(self.log_file, 2, np.ones((1, 4)), [meta(2)])
+        # Simule un crash au milieu de l'écriture d'une troisième entrée
+        with open(self.log_file, 'ab') as f:
+            f.write(b"\x10\x00\x00\x00garbage")
+
+        deltas = list(persistence.read_deltas(self.log_file))
+
+        self.assertEqual([d["start_id"] for d in deltas], [0, 2])
+        self.assertEqual(deltas[1]["vectors"].dtype, np.float32)
+        self.assertEqual(deltas[1]["metadata"], [meta(2)])
+
+    def test_read_deltas_resumes_from_offset(self):
+        persistence.append_delta(self.log_file, 0, np.zeros((1, 4)), [meta(0)])
+        first = list(persistence.read_deltas(self.log_file))
+        persistence.append_delta(self.log_file, 1, np.ones((1, 4)), [meta(1)])
+
+        # Lecture incrémentale : seul le delta ajouté depuis la dernière lecture est relu
+        deltas = list(persistence.read_deltas(self.log_file, first[-1]["end_offset"]))
+
+        self.assertEqual([d["start_id"] for d in deltas], [1])
+        self.assertEqual(deltas[0]["end_offset"], os.path.getsize(self.log_file))
+
+    def test_collect_deltas(self):
+        deltas = [
+            {"start_id": 0, "vectors": np.zeros((2, 2)), "metadata": [meta(0), meta(1)]},
+            {"start_id": 2, "vectors": np.ones((1, 2)), "metadata": [meta(2)]},
+        ]
+        vectors, records = persistence.collect_deltas(1, deltas)
+        self.assertEqual(records, [meta(1), meta(2)])
+        np.testing.assert_array_equal(vectors, [[0, 0], [1, 1]])
+        # Trou : le delta commence après l'index
+        self.assertIsNone(persistence.collect_deltas(0, deltas[1:]))
+
+    def test_delta_tail(self):
+        delta = {"start_id": 2, "vectors": np.zeros((3, 4)), "metadata": [meta(2), meta(3), meta(4)]}
+
+        vectors, records = persistence.delta_tail(3, delta)
+
+        self.assertEqual(len(vectors), 2)
+        self.assertEqual([m["doc_id"] for m in records], ["3", "4"])
+        self.assertIsNone(persistence.delta_tail(1, delta))
+
+    @patch('persistence.faiss')
+    def test_load_state_replays_only_missing_deltas(self, mock_faiss):
+        # Checkpoint contenant déjà les 2 premiers vecteurs, journal non vidé (crash avant troncature)
+        mock_faiss.read_index.return_value = FakeIndex(ntotal=2)
+        self.write_metadata([meta(0), meta(1)])
+        persistence.append_delta(self.log_file, 0, np.zeros((2, 4)), [meta(0), meta(1)])
+        persistence.append_delta(self.log_file, 2, np.ones((1, 4)), [meta(2)])
+
+        index, metadata_store, entries = persistence.load_state(self.index_file, self.metadata_file, self.log_file)
+
+        self.assertEqual(entries, 2)
+        self.assertEqual(index.ntotal, 3)
+        self.assertEqual(len(index.added), 1)
+        self.assertEqual([m["doc_id"] for m in metadata_store], ["0", "1", "2"])
+
+    @patch('persistence.faiss')
+    def test_readonly_load_keeps_deltas_out_of_checkpoint(self, mock_faiss):
+        base = FakeIndex(ntotal=1, d=2)
+        mock_faiss.read_index.return_value = base
+        self.write_metadata([meta(0)])
+        persistence.append_delta(self.log_file, 1, np.ones((2, 2)), [meta(1), meta(2)])
+
+        index, metadata_store, _ = persistence.load_state(self.index_file, self.metadata_file, self.log_file, readonly=True)
+
+        # Base (éventuellement mappée) jamais modifiée : les deltas sont dans la couche en mémoire
+        self.assertEqual(base.added, [])
+        self.assertIs(index.base, base)
+        self.assertEqual(index.ntotal, 3)
+        self.assertEqual(len(metadata_store), 3)
+
+    @patch('persistence.faiss')
+    def test_load_state_truncates_metadata_ahead_of_index(self, mock_faiss):
+        # Crash après l'écriture des métadonnées, avant le checkpoint de l'index
+        mock_faiss.read_index.return_value = FakeIndex(ntotal=1)
+        self.write_metadata([meta(0), meta(1)])
+        persistence.append_delta(self.log_file, 1, np.ones((1, 4)), [meta(1)])
+
+        index, metadata_store, _ = persistence.load_state(self.index_file, self.metadata_file, self.log_file)
+
+        self.assertEqual(index.ntotal, 2)
+        self.assertEqual([m["doc_id"] for m in metadata_store], ["0", "1"])
+
+    @patch('persistence.faiss')
+    def test_write_checkpoint_empties_log(self, mock_faiss):
+        mock_faiss.write_index.side_effect = lambda index, path: open(path, 'wb').close()
+        persistence.append_delta(self.log_file, 0, np.zeros((1, 4)), [meta(0)])
+        store = MetadataStore(self.metadata_file)
+        store.extend([meta(0)])
+
+        persistence.write_checkpoint(FakeIndex(1), store, self.index_file, self.log_file)
+
+        self.assertTrue(os.path.exists(self.index_file))
+        self.assertEqual(list(persistence.read_deltas(self.log_file)), [])
+        self.assertEqual(list(MetadataStore(self.metadata_file, readonly=True)), [meta(0)])
+
+    @patch('persistence.faiss')
+    def test_write_checkpoint_keeps_log_when_wal_busy(self, mock_faiss):
+        persistence.append_delta(self.log_file, 0, np.zeros((1, 4)), [meta(0)])
+        store = MetadataStore(self.metadata_file)
+        store._local.db = sqlite3.connect(self.metadata_file, timeout=0) # Sans attente des lecteurs
+        store.extend([meta(0)])
+        # Lecteur au milieu d'une transaction : le WAL ne peut pas être reporté en entier
+        reader = sqlite3.connect(self.metadata_file)
+        reader.execute("BEGIN")
+        reader.execute("SELECT COUNT(*) FROM chunks").fetchone()
+        store.extend([meta(1)])
+
+        with self.assertRaises(RuntimeError):
+            persistence.write_checkpoint(FakeIndex(2), store, self.index_file, self.log_file)
+
+        # Ni index remplacé ni journal vidé : le rejeu reste possible
+        mock_faiss.write_index.assert_not_called()
+        self.assertEqual(len(list(persistence.read_deltas(self.log_file))), 1)
+        reader.rollback()
+        reader.close()
+        store.checkpoint()
+        store.close()
+
+    @patch('persistence.faiss')
+    def test_legacy_pickle_imported_once(self, mock_faiss):
+        mock_faiss.read_index.return_value = FakeIndex(ntotal=1)
+        with open(os.path.join(self.tmp.name, "metadata_store.pkl"), 'wb') as f:
+            pickle.dump([meta(0)], f)
+        open(self.index_file, 'wb').close()
+        self.assertTrue(persistence.checkpoint_exists(self.index_file, self.metadata_file))
+
+        # Un lecteur n'écrit rien : ancien fichier chargé en mémoire
+        _, metadata_store, _ = persistence.load_state(self.index_file, self.metadata_file, self.log_file, readonly=True)
+        self.assertEqual(metadata_store, [meta(0)])
+        self.assertFalse(os.path.exists(self.metadata_file))
+
+        # L'indexeur importe l'ancien fichier dans la base
+        _, metadata_store, _ = persistence.load_state(self.index_file, self.metadata_file, self.log_file)
+        self.assertIsInstance(metadata_store, MetadataStore)
+        self.assertEqual(list(metadata_store), [meta(0)])
+        self.assertTrue(os.path.exists(self.metadata_file))
+
+    @patch('persistence.faiss')
+    def test_readonly_load_does_not_modify_store(self, mock_faiss):
+        # L'indexeur a déjà écrit les lignes d'un delta que le lecteur ne voit pas encore
+        mock_faiss.read_index.return_value = FakeIndex(ntotal=1)
+        self.write_metadata([meta(0), meta(1)])
+
+        _, metadata_store, _ = persistence.load_state(self.index_file, self.metadata_file, self.log_file, readonly=True)
+
+        self.assertEqual(len(metadata_store), 1)
+        with self.assertRaises(IndexError):
+            metadata_store[1]
+        self.assertEqual(len(MetadataStore(self.metadata_file)), 2)
+
+    def test_readonly_load_maps_checkpoint(self):
+        # Vrai faiss (test_indexer remplace le module par un mock avant l'import de persistence)
+        faiss = index_factory.faiss
+        vectors = np.arange(20, dtype='float32').reshape(10, 2)
+        for index_type in ("flat", "ivf_flat"):
+            base = faiss.index_factory(2, "IVF2,Flat" if index_type == "ivf_flat" else "Flat")
+            base.train(vectors)
+            base.add(vectors[:8])
+            faiss.write_index(base, self.index_file)
+            self.write_metadata([meta(i) for i in range(8)])
+            persistence.append_delta(self.log_file, 8, vectors[8:], [meta(8), meta(9)])
+
+            with patch.object(persistence, "faiss", faiss):
+                index, _, _ = persistence.load_state(self.index_file, self.metadata_file, self.log_file, use_mmap=True, readonly=True)
+            index_factory.configure_search(index, nprobe=2)
+
+            # Fichier mappé (jamais modifié), deltas dans la couche : recherche sur les 10 vecteurs
+            self.assertEqual((index.base.ntotal, index.ntotal), (8, 10))
+            self.assertEqual(index.search(vectors[[3, 9]], 1)[1][:, 0].tolist(), [3, 9])
+            os.remove(self.metadata_file)
+            os.remove(self.log_file)
+
+    def test_mmap_requires_readonly(self):
+        with self.assertRaises(ValueError):
+            persistence.load_state(self.index_file, self.metadata_file, self.log_file, use_mmap=True)
+
+    def test_sync_raw_vectors(self):
+        raw_file = os.path.join(self.tmp.name, "vector_store.f32")
+        vectors = np.arange(12, dtype='float32').reshape(4, 3)
+        index = FakeIndex(4)
+        index.d = 3
+        # Vecteurs relus dans l'index quantifié : approchés
+        index.reconstruct_n = lambda start, n: vectors[start:start + n].round(-1)
+        persistence.append_raw_vectors(raw_file, vectors[:1])
+        # Le journal contient les vecteurs exacts à partir de l'id 2
+        persistence.append_delta(self.log_file, 2, vectors[2:], [meta(2), meta(3)])
+
+        persistence.sync_raw_vectors(raw_file, index, self.log_file)
+
+        raw = persistence.open_raw_vectors(raw_file, 3)
+        np.testing.assert_array_equal(raw[[0, 2, 3]], vectors[[0, 2, 3]])
+        np.testing.assert_array_equal(raw[1], vectors[1].round(-1))
+
+        # Lignes en avance sur l'index (crash avant checkpoint) : tronquées
+        persistence.append_raw_vectors(raw_file, vectors[:1])
+        persistence.sync_raw_vectors(raw_file, index, self.log_file)
+        self.assertEqual(len(persistence.open_raw_vectors(raw_file, 3)), 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
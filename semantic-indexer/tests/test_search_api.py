@@ -0,0 +1,93 @@
+import unittest
+from unittest.mock import MagicMock, patch
+import sys
+import os
+import tempfile
+import threading
+from types import SimpleNamespace
+import numpy as np
+
+# Add parent directory to path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+# Le modèle et l'index ne sont chargés qu'au démarrage de l'application (startup), pas à l'import
+sys.modules['sentence_transformers'] = MagicMock()
+
+from fastapi.testclient import TestClient
+import search_api
+from metadata_filter import MetadataIndex
+from index_factory import LayeredIndex
+from persistence import append_delta
+
+
+def patient_record(i, patient_id, date):
+    return {"doc_id": str(i), "text_content": f"chunk {i}", "source": f"Dossier Patient {i}", "type": "patient_file",
+            "patient_id": patient_id, "doc_type": "ordonnance", "date": date}
+
+
+class TestSearchApi(unittest.TestCase):
+
+    def setUp(self):
+        records = [
+            patient_record(0, "P1", "2024-03-01"),
+            patient_record(1, "P2", "2024-01-01"),
+            patient_record(2, "P1", "2024-01-15"),
+        ]
+        # État chargé simulé (TestClient sans "with" : l'événement startup n'est pas déclenché)
+        search_api.state = SimpleNamespace(
+            refresh=lambda: None,
+            index=SimpleNamespace(ntotal=len(records)),
+            metadata=records,
+            filters=MetadataIndex(records),
+            deleted=np.empty(0, dtype='int64'),
+        )
+        self.client = TestClient(search_api.app)
+
+    def test_patient_snippets_empty_params_as_sent_by_httpx(self):
+        # RetrievalClient de synthese-comparative : None est encodé en valeur vide
+        response = self.client.get("/api/search/patient-snippets?patient_id=P1&from_date=&to_date=&focus=")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([snippet["doc_id"] for snippet in response.json()], ["2", "0"])
+
+    def test_patient_snippets_date_filter(self):
+        response = self.client.get("/api/search/patient-snippets", params={"patient_id": "P1", "from_date": "2024-02-01"})
+        self.assertEqual([snippet["doc_id"] for snippet in response.json()], ["0"])
+
+        response = self.client.get("/api/search/patient-snippets", params={"patient_id": "P1", "from_date": "01/02/2024"})
+        self.assertEqual(response.status_code, 422)
+
+    def test_patient_snippets_skip_deleted_records(self):
+        # Document supprimé après la construction des listes inversées (avant le rechargement)
+        search_api.state.metadata[2] = None
+
+        response = self.client.get("/api/search/patient-snippets", params={"patient_id": "P1", "limit": 1})
+
+        self.assertEqual([snippet["doc_id"] for snippet in response.json()], ["0"])
+
+    def test_refresh_appends_deltas_without_duplicates(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            log_file = os.path.join(tmp, "vector_store.log")
+            records = [patient_record(i, "P1", "2024-01-01") for i in range(3)]
+            base = SimpleNamespace(d=2, ntotal=1)
+            state = search_api.SearchState.__new__(search_api.SearchState)
+            state.lock, state.checked_at, state.signature, state.offset = threading.Lock(), 0.0, "v1", 0
+            state.index = LayeredIndex(base)
+            # Échec d'un rafraîchissement précédent : métadonnées déjà complétées, pas l'index
+            state.metadata = records[:2]
+            state.filters = MetadataIndex(records[:1])
+            append_delta(log_file, 1, np.ones((2, 2)), records[1:])
+
+            with patch.object(search_api, "LOG_FILE", log_file), patch.object(search_api, "INDEX_RELOAD_INTERVAL", 0), \
+                    patch.object(search_api.SearchState, "_signature", return_value="v1"):
+                state.refresh()
+
+            self.assertIs(state.index.base, base)
+            self.assertEqual(state.index.ntotal, 3)
+            self.assertEqual(state.metadata, records)
+            self.assertEqual(len(state.filters), 3)
+            self.assertEqual(state.offset, os.path.getsize(log_file))
+
+
+if __name__ == '__main__':
+    unittest.main()
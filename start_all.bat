@@ -24,6 +24,7 @@ start "Service 2: DeID Anonymizer" cmd /k "cd deid-service && venv\Scripts\activ
 :: 4. Lancement Service 3 : Semantic Indexer
 echo [4/6] Démarrage Semantic Indexer...
 start "Service 3: Semantic Indexer" cmd /k "cd semantic-indexer && .venv\Scripts\activate && python indexer.py"
+start "Service 3b: Recherche filtree" cmd /k "cd semantic-indexer && .venv\Scripts\activate && uvicorn search_api:app --port 8003"
 
 :: 5. Lancement Service 4 : LLM QA
 echo [5/6] Démarrage LLM QA (RAG)...
@@ -39,6 +40,7 @@ echo ========================================================
 echo   TOUT EST LANCE !
 echo   - Swagger Ingestion : http://localhost:8000/docs
 echo   - Swagger LLM       : http://localhost:8001/docs
+echo   - Swagger Recherche : http://localhost:8003/docs
 echo   - Interface UI      : http://localhost:8501
 echo   - RabbitMQ Admin    : http://localhost:15672
 echo ========================================================